@@ -0,0 +1,372 @@
+"""
+Recording and offline replay of the WebDriver commands. The recorder sits between the driver and its command
+executor, so every command sent to chromedriver (find, click, execute_script, ...) is written to a gzipped json lines
+trace with its start time, duration, parameters and raw response. The replay driver answers the commands from the
+trace instead of a browser: SeleniumDriver and WebInterations run the same code with the same responses, which
+makes their python side deterministic and profilable without the site.
+
+The error responses (no such element, stale element, ...) are recorded like the others and raised again by the
+replay driver. Screenshots are replaced by a 1x1 png unless keep_screenshots is set.
+
+SeleniumDriver and Navigator branch on time.monotonic() (negative cache TTL, polling deadlines), so the replay
+controls the clock too: inside replay_clock, time.monotonic, time.time and time.sleep of these modules follow a
+ReplayClock that moves to the recorded end of every replayed command and by the slept seconds. A poll or a cache
+entry expires after as many commands as when it was recorded, whatever the speed of the python side.
+
+Example:
+    recorder = CommandRecorder.attach(driver, "trace_2020-10-22.jsonl.gz")
+    mark(driver, "process_inbox", last_mail_date="2020-10-22 10:15")
+    ...
+    driver.quit()  # closes the trace
+
+    python -m app.base.command_trace summary trace_2020-10-22.jsonl.gz
+    python -m app.base.command_trace replay trace_2020-10-22.jsonl.gz --labels Rotulos.xlsx --clients Clientes.xlsx
+"""
+import argparse
+import base64
+import gzip
+import importlib
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from selenium.common.exceptions import WebDriverException
+
+import app.utilities.custom_logger as cl
+
+# Commands whose value is a base64 screenshot
+_SCREENSHOT_COMMANDS = ("screenshot", "elementScreenshot")
+# base64 of a 1x1 transparent png
+_PNG_PIXEL = base64.b64encode(bytes.fromhex(
+    "89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c489"
+    "0000000d4944415478da63f8ffff3f0005fe02fea7d6a4bd0000000049454e44ae426082")).decode("ascii")
+
+log = cl.customLogger(logging.INFO)
+
+# Modules whose time functions are replaced by the ReplayClock during a replay
+CLOCK_MODULES = ("app.base.selenium_driver", "app.base.navigation", "app.pages.main_page",
+                 "selenium.webdriver.support.wait", "retrying")
+
+
+class ReplayMismatch(WebDriverException):
+    """The replayed code sent a command different from the recorded one"""
+
+
+class CommandRecorder(object):
+    """
+    Command executor that records the commands of the wrapped executor
+
+    Parameters
+    ----------
+    executor : RemoteConnection
+        The executor of the driver (driver.command_executor)
+    path : str
+        Trace file (gzipped json lines)
+    header : dict
+        Written in the first line (session, capabilities)
+    keep_screenshots : bool
+        Record the screenshots. They are replaced by a 1x1 png by default
+    flush_every : int
+        The trace is flushed after this many commands, so a crashed run keeps most of its trace
+    """
+
+    def __init__(self, executor, path, header=None, keep_screenshots=False, flush_every=50):
+        self.executor = executor
+        self.path = path
+        self.keep_screenshots = keep_screenshots
+        self.flush_every = flush_every
+        self.commands = 0
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, "wt", encoding="utf-8")
+        self._write(dict(header or {}, type="header", started=time.time()))
+
+    @classmethod
+    def attach(cls, driver, path, keep_screenshots=False):
+        """Records the commands of driver in path. Returns the recorder"""
+        header = {"session_id": getattr(driver, "session_id", None), "w3c": getattr(driver, "w3c", False),
+                  "capabilities": getattr(driver, "capabilities", {})}
+        recorder = cls(driver.command_executor, path, header, keep_screenshots)
+        driver.command_executor = recorder
+        log.info("Recording the WebDriver commands in " + path)
+        return recorder
+
+    def _write(self, entry):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":"), default=str) + "\n")
+            self.commands += 1
+            if self.commands % self.flush_every == 0:
+                self._file.flush()
+
+    def execute(self, command, params):
+        recorded_params = {key: value for key, value in (params or {}).items() if key != "sessionId"}
+        start = time.monotonic()
+        entry = {"c": command, "p": recorded_params, "t": round(start - self._start, 6)}
+        try:
+            response = self.executor.execute(command, params)
+        except Exception as e:
+            entry["d"] = round(time.monotonic() - start, 6)
+            entry["x"] = repr(e)
+            self._write(entry)
+            raise
+        entry["d"] = round(time.monotonic() - start, 6)
+        if command in _SCREENSHOT_COMMANDS and not self.keep_screenshots and isinstance(response, dict):
+            response = dict(response, value=_PNG_PIXEL)
+        entry["r"] = response
+        self._write(entry)
+        if command == "quit":
+            self.close()
+        return response
+
+    def mark(self, name, **data):
+        """Writes a mark (e.g. the start of a step and the data needed to replay it)"""
+        self._write({"type": "mark", "name": name, "data": data, "t": round(time.monotonic() - self._start, 6)})
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __getattr__(self, name):
+        # Other attributes of the executor (e.g. _url, keep_alive)
+        return getattr(self.executor, name)
+
+
+def mark(driver, name, **data):
+    """Writes a mark in the trace of driver. Does nothing if the driver is not recorded"""
+    executor = getattr(driver, "command_executor", None)
+    if isinstance(executor, CommandRecorder):
+        executor.mark(name, **data)
+
+
+def read_trace(path):
+    """Returns (header, entries) of a trace. Marks are entries with "type": "mark\""""
+    header, entries = {}, []
+    with gzip.open(path, "rt", encoding="utf-8") as rf:
+        for line in rf:
+            entry = json.loads(line)
+            if entry.get("type") == "header":
+                header = entry
+            else:
+                entries.append(entry)
+    return header, entries
+
+
+class ReplayClock(object):
+    """
+    Virtual time for the replay, in seconds from the start of the recording. It replaces the time module of
+    CLOCK_MODULES (see replay_clock): monotonic, time and sleep are virtual, the other attributes are the time module
+    ones
+
+    Parameters
+    ----------
+    started : float
+        Wall clock time of the start of the recording (trace header), used by time()
+    """
+
+    def __init__(self, started=0.0):
+        self.started = started
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.started + self.now
+
+    def sleep(self, seconds):
+        """Moves the clock, without waiting"""
+        self.now += max(0.0, seconds)
+
+    def advance_to(self, seconds):
+        """Moves the clock to a recorded time. The clock never goes back"""
+        self.now = max(self.now, seconds)
+
+    def __getattr__(self, name):
+        # strftime, perf_counter ... of the time module
+        return getattr(time, name)
+
+
+@contextmanager
+def replay_clock(clock, modules=CLOCK_MODULES):
+    """Replaces the time module of modules by clock while the block runs"""
+    replaced = []
+    try:
+        for name in modules:
+            try:
+                module = importlib.import_module(name)
+            except ImportError:
+                continue
+            if getattr(module, "time", None) is time:
+                module.time = clock
+                replaced.append(module)
+        yield clock
+    finally:
+        for module in replaced:
+            module.time = time
+
+
+class ReplayExecutor(object):
+    """
+    Command executor answering the commands from a trace, in order
+
+    Parameters
+    ----------
+    entries : list
+        Trace entries (read_trace)
+    speed : float
+        The recorded command durations are slept times speed (0: no wait, 1: the recorded browser latency)
+    check_params : bool
+        Raise ReplayMismatch if the parameters of a command differ from the recorded ones
+    clock : ReplayClock
+        Moved to the recorded end of every replayed command. Used with replay_clock
+    """
+
+    def __init__(self, entries, speed=0.0, check_params=False, clock=None):
+        self.entries = entries
+        self.speed = speed
+        self.check_params = check_params
+        self.clock = clock or ReplayClock()
+        self.position = 0
+        self.replayed = 0
+
+    def seek(self, name):
+        """Moves after the mark name. Returns the mark data"""
+        for position in range(self.position, len(self.entries)):
+            entry = self.entries[position]
+            if entry.get("type") == "mark" and entry["name"] == name:
+                self.position = position + 1
+                self.clock.advance_to(entry.get("t", 0.0))
+                return entry.get("data", {})
+        raise ValueError("Mark {} not found in the trace".format(name))
+
+    def _next(self):
+        while self.position < len(self.entries) and self.entries[self.position].get("type") == "mark":
+            self.position += 1
+        if self.position >= len(self.entries):
+            raise ReplayMismatch("The trace ended after {} commands".format(self.replayed))
+        entry = self.entries[self.position]
+        self.position += 1
+        return entry
+
+    def execute(self, command, params):
+        entry = self._next()
+        if entry["c"] != command:
+            raise ReplayMismatch("Command {} at position {}: {} was recorded".format(command, self.position - 1,
+                                                                                   entry["c"]))
+        params = {key: value for key, value in (params or {}).items() if key != "sessionId"}
+        if self.check_params and json.loads(json.dumps(params, default=str)) != entry["p"]:
+            raise ReplayMismatch("Parameters of {} at position {} differ: {} != {}".format(
+                command, self.position - 1, params, entry["p"]))
+        self.replayed += 1
+        self.clock.advance_to(entry.get("t", 0.0) + entry.get("d", 0.0))
+        if self.speed:
+            time.sleep(entry.get("d", 0) * self.speed)
+        if "x" in entry:
+            raise WebDriverException("Replayed error: " + entry["x"])
+        return entry.get("r")
+
+
+def replay_driver(path, speed=0.0, check_params=False):
+    """
+    Returns a WebDriver answering the commands from a trace (see ReplayExecutor). The driver is a remote WebDriver,
+    so its elements, switch_to, execute_script ... are the selenium ones. Run the replayed code inside
+    replay_clock(driver.command_executor.clock) so its timeouts follow the trace
+    """
+    from selenium.webdriver.remote.errorhandler import ErrorHandler
+    from selenium.webdriver.remote.file_detector import LocalFileDetector
+    from selenium.webdriver.remote.mobile import Mobile
+    from selenium.webdriver.remote.switch_to import SwitchTo
+    from selenium.webdriver.remote.webdriver import WebDriver as RemoteWebDriver
+
+    class ReplayWebDriver(RemoteWebDriver):
+        """Remote WebDriver without a session: the trace is the browser"""
+
+        def __init__(self, header, executor):
+            # RemoteWebDriver.__init__ would start a new session
+            self.command_executor = executor
+            self._is_remote = True
+            self.session_id = header.get("session_id") or "replay"
+            self.capabilities = header.get("capabilities") or {}
+            self.w3c = header.get("w3c", False)
+            self.error_handler = ErrorHandler()
+            self._switch_to = SwitchTo(self)
+            self._mobile = Mobile(self)
+            self.file_detector = LocalFileDetector()
+
+    header, entries = read_trace(path)
+    return ReplayWebDriver(header, ReplayExecutor(entries, speed, check_params,
+                                                  ReplayClock(header.get("started") or 0.0)))
+
+
+def summarize(entries, top=15):
+    """Returns a text summary of a trace: time per command and the slowest commands"""
+    totals = defaultdict(lambda: [0, 0.0])
+    commands = [entry for entry in entries if entry.get("type") != "mark"]
+    for entry in commands:
+        totals[entry["c"]][0] += 1
+        totals[entry["c"]][1] += entry.get("d", 0.0)
+    browser_seconds = sum(total[1] for total in totals.values())
+    span = commands[-1]["t"] + commands[-1].get("d", 0.0) if commands else 0.0
+    lines = ["{} commands, {:.2f} s in the browser of {:.2f} s recorded ({:.2f} s on the python side)".format(
+        len(commands), browser_seconds, span, span - browser_seconds)]
+    lines.append("{:<28} {:>7} {:>10} {:>9}".format("command", "count", "total s", "mean ms"))
+    for command, (number, seconds) in sorted(totals.items(), key=lambda item: -item[1][1]):
+        lines.append("{:<28} {:>7} {:>10.3f} {:>9.2f}".format(command, number, seconds, 1000 * seconds / number))
+    lines.append("Slowest commands:")
+    for entry in sorted(commands, key=lambda entry: -entry.get("d", 0.0))[:top]:
+        lines.append("  {:>8.3f} s at {:>9.3f} s {} {}".format(entry.get("d", 0.0), entry["t"], entry["c"],
+                                                               json.dumps(entry["p"], default=str)[:100]))
+    return "\n".join(lines)
+
+
+def main():
+    import cProfile
+    import pstats
+
+    parser = argparse.ArgumentParser(description="Summarizes or replays a WebDriver command trace")
+    parser.add_argument("action", choices=["summary", "replay"])
+    parser.add_argument("trace")
+    parser.add_argument("--labels", help="replay: labels rules workbook")
+    parser.add_argument("--clients", help="replay: clients rules workbook")
+    parser.add_argument("--mark", default="process_inbox", help="replay: mark where the replay starts")
+    parser.add_argument("--speed", type=float, default=0.0, help="replay: multiplier of the recorded latency")
+    parser.add_argument("--top", type=int, default=25)
+    arguments = parser.parse_args()
+
+    if arguments.action == "summary":
+        print(summarize(read_trace(arguments.trace)[1], arguments.top))
+        return
+
+    if not (arguments.labels and arguments.clients):
+        parser.error("--labels and --clients are required to replay")
+    from app.configFiles.rules import LabelRules
+    from app.pages.main_page import WebInterations
+
+    driver = replay_driver(arguments.trace, arguments.speed)
+    data = driver.command_executor.seek(arguments.mark)
+    interactions = WebInterations(driver, LabelRules(arguments.labels), LabelRules(arguments.clients))
+    interactions.last_mail_date = data.get("last_mail_date")
+    interactions.stop = False
+
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    with replay_clock(driver.command_executor.clock):
+        profiler.enable()
+        try:
+            details = interactions.get_emails_details()
+        finally:
+            profiler.disable()
+    print("Replayed {} commands, {} mails in {:.2f} s".format(driver.command_executor.replayed,
+                                                              len(details["subject"]), time.perf_counter() - start))
+    pstats.Stats(profiler).sort_stats("cumulative").print_stats(arguments.top)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Locators that know their type. A Locator is a str, so it can be passed everywhere a locator string is expected; its
+By type is resolved once, when the page class is created, instead of on every call.
+
+Example:
+    class MainPage(SeleniumDriver):
+        _subject_locator = Locator("#messages-list > tbody > tr > td.column-subject > a")
+        _label_field_locator = Locator("s2id_autogen4", "id")
+
+    MainPage.locators["_subject_locator"].by_tuple  # ("css selector", "#messages-list > ...")
+"""
+from selenium.webdriver.common.by import By
+
+# Locator type names used by SeleniumDriver and their By values
+LOCATOR_TYPES = {
+    "id": By.ID,
+    "name": By.NAME,
+    "xpath": By.XPATH,
+    "css": By.CSS_SELECTOR,
+    "class": By.CLASS_NAME,
+    "link": By.LINK_TEXT,
+}
+
+
+class Locator(str):
+    """
+    A locator string with its type
+
+    Parameters
+    ----------
+    value : str
+        The locator
+    locator_type : str
+        Type of locator can be: id, name, xpath, css, class, link
+
+    Attributes
+    ----------
+    locator_type : str
+        The locator type name (lower case)
+    by : str
+        The By value of the type
+    """
+
+    def __new__(cls, value, locator_type="css"):
+        locator = super().__new__(cls, value)
+        locator_type = locator_type.lower()
+        if locator_type not in LOCATOR_TYPES:
+            raise ValueError("Locator type " + locator_type + " not correct/supported")
+        locator.locator_type = locator_type
+        locator.by = LOCATOR_TYPES[locator_type]
+        return locator
+
+    @property
+    def by_tuple(self):
+        """(By type, locator), the form used by find_element and the expected conditions"""
+        return self.by, str(self)
+
+    def __repr__(self):
+        return "Locator({}, {!r})".format(str.__repr__(self), self.locator_type)
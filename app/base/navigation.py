@@ -0,0 +1,191 @@
+"""
+Readiness based navigation. Instead of fixed sleeps after get/refresh, the page is polled until:
+    1. document.readyState is "complete"
+    2. there are no pending XHR/fetch requests (and no active jQuery requests) for a short quiet period
+    3. the ready selector (e.g. the first row of #messages-list) is in the page
+The time until every signal is reported for each navigation.
+
+The XHR/fetch counter is installed with the Chrome DevTools protocol before the page scripts run, so the requests
+started during the load are counted. Drivers without CDP get the counter from the first readiness check.
+
+Example:
+    navigator = Navigator(driver, ready_selector="#messages-list > tbody > tr:nth-child(1)")
+    timing = navigator.navigate("https://leaseplangroup.icontroller.eu/messages")
+    print(timing.ready, timing.seconds)
+"""
+import logging
+import time
+from collections import namedtuple
+
+from selenium.common.exceptions import WebDriverException
+
+import app.utilities.custom_logger as cl
+
+NavigationTiming = namedtuple("NavigationTiming", ["url", "ready", "seconds", "load_seconds", "dom_seconds",
+                                                   "idle_seconds", "selector_seconds"])
+NavigationTiming.__doc__ = """
+Timings of a navigation, in seconds from its start. load_seconds is the time spent in get/refresh. A signal that
+was not reached before the timeout is None
+"""
+
+# Counts the pending XHR and fetch requests in window.__pendingRequests
+_REQUEST_COUNTER_SCRIPT = '''
+(function () {
+    if (window.__pendingRequests !== undefined) { return; }
+    window.__pendingRequests = 0;
+    function done() { window.__pendingRequests = Math.max(0, window.__pendingRequests - 1); }
+    var send = XMLHttpRequest.prototype.send;
+    XMLHttpRequest.prototype.send = function () {
+        window.__pendingRequests++;
+        this.addEventListener("loadend", done);
+        return send.apply(this, arguments);
+    };
+    if (window.fetch) {
+        var fetch = window.fetch;
+        window.fetch = function () {
+            window.__pendingRequests++;
+            return fetch.apply(this, arguments).then(function (response) { done(); return response; },
+                                                     function (error) { done(); throw error; });
+        };
+    }
+})();
+'''
+
+# arguments[0]: ready selector or null
+_READY_STATE_SCRIPT = '/* ready_state */' + _REQUEST_COUNTER_SCRIPT + '''
+return {
+    readyState: document.readyState,
+    pending: window.__pendingRequests + (window.jQuery && window.jQuery.active ? window.jQuery.active : 0),
+    selector: arguments[0] ? document.querySelector(arguments[0]) !== null : true
+};'''
+
+
+class Navigator(object):
+    """
+    Opens pages and waits until they are ready
+
+    Parameters
+    ----------
+    driver : webdriver
+        The browser
+    ready_selector : str
+        Css selector of an element that exists only when the page is usable. None waits only for the load and the
+        network
+    timeout : float
+        Seconds to wait for a page to be ready
+    poll_frequency : float
+        Seconds between two readiness checks
+    quiet_period : float
+        Seconds without pending requests after which the network is considered idle
+    selector_grace : float
+        Seconds the ready selector is still waited for once the page is loaded and the network idle (e.g. a login
+        page or an empty inbox never shows it). None waits until the timeout
+    """
+
+    log = cl.customLogger(logging.DEBUG)
+
+    def __init__(self, driver, ready_selector=None, timeout=30, poll_frequency=0.1, quiet_period=0.3,
+                 selector_grace=None):
+        self.driver = driver
+        self.ready_selector = ready_selector
+        self.timeout = timeout
+        self.poll_frequency = poll_frequency
+        self.quiet_period = quiet_period
+        self.selector_grace = selector_grace
+        self.history = []
+        self.cdp = self._install_request_counter()
+
+    def _install_request_counter(self):
+        """Installs the request counter for every new document (Chrome only). Returns True if it was installed"""
+        execute_cdp_cmd = getattr(self.driver, "execute_cdp_cmd", None)
+        if execute_cdp_cmd is None:
+            return False
+        try:
+            execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": _REQUEST_COUNTER_SCRIPT})
+            return True
+        except WebDriverException as e:
+            self.log.debug("Request counter not installed with CDP: " + repr(e))
+            return False
+
+    def _state(self, ready_selector):
+        try:
+            return self.driver.execute_script(_READY_STATE_SCRIPT, ready_selector) or {}
+        except WebDriverException as e:
+            # The document can be replaced while the script runs
+            self.log.debug("Readiness check failed: " + repr(e))
+            return {}
+
+    def wait_until_ready(self, ready_selector=None, timeout=None, start=None, load_seconds=0.0, url=None):
+        """
+        Polls the page until it is ready
+
+        Parameters
+        ----------
+        ready_selector : str
+            Overrides the navigator ready selector. "" waits only for the load and the network
+        timeout : float
+            Overrides the navigator timeout
+
+        Returns
+        -------
+            NavigationTiming
+        """
+        if ready_selector is None:
+            ready_selector = self.ready_selector
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic() if start is None else start
+        deadline = start + timeout
+        dom_seconds = idle_seconds = selector_seconds = None
+        idle_since = None
+
+        while True:
+            now = time.monotonic()
+            state = self._state(ready_selector or None)
+            if state.get("readyState") == "complete":
+                if dom_seconds is None:
+                    dom_seconds = now - start
+                if state.get("pending") == 0:
+                    idle_since = now if idle_since is None else idle_since
+                    if idle_seconds is None and now - idle_since >= self.quiet_period:
+                        idle_seconds = idle_since - start
+                else:
+                    idle_since = None
+                if selector_seconds is None and state.get("selector"):
+                    selector_seconds = now - start
+            ready = None not in (dom_seconds, idle_seconds, selector_seconds)
+            if ready or now >= deadline:
+                break
+            if (self.selector_grace is not None and idle_seconds is not None and
+                    now - start - idle_seconds >= self.selector_grace):
+                # Loaded and idle, but the selector didn't appear: waiting longer won't show it
+                break
+            time.sleep(self.poll_frequency)
+
+        timing = NavigationTiming(url, ready, time.monotonic() - start, load_seconds, dom_seconds, idle_seconds,
+                                  selector_seconds)
+        self.history.append(timing)
+        self.log.info("Navigation {}: ready={} in {:.2f} s (load {:.2f} s, dom {}, network idle {}, "
+                      "selector {})".format(url, ready, timing.seconds, load_seconds, _seconds(dom_seconds),
+                                            _seconds(idle_seconds), _seconds(selector_seconds)))
+        return timing
+
+    def navigate(self, url, ready_selector=None, timeout=None):
+        """Opens url and waits until the page is ready. Returns NavigationTiming"""
+        return self._load(lambda: self.driver.get(url), url, ready_selector, timeout)
+
+    def refresh(self, ready_selector=None, timeout=None):
+        """Refreshes the current page and waits until it is ready. Returns NavigationTiming"""
+        return self._load(self.driver.refresh, "(refresh)", ready_selector, timeout)
+
+    def _load(self, load, url, ready_selector, timeout):
+        start = time.monotonic()
+        try:
+            load()
+        except WebDriverException as e:
+            # A page load timeout: the page can still become usable
+            self.log.error("Page load failed for " + str(url) + ": " + repr(e))
+        return self.wait_until_ready(ready_selector, timeout, start, time.monotonic() - start, url)
+
+
+def _seconds(value):
+    return "-" if value is None else "{:.2f} s".format(value)
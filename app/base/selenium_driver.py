@@ -2,17 +2,90 @@
 A framework based on, used to control the browser.
 """
 
-from selenium.webdriver.common.by import By
+from collections import namedtuple
 from traceback import print_stack
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import *
 import app.utilities.custom_logger as cl
+from app.base.locators import LOCATOR_TYPES, Locator
+from app.base.navigation import Navigator
 from app.utilities.custom_logger import screen_shot
 import logging
 import time
 from retrying import retry
 
+ProbeResult = namedtuple("ProbeResult", ["present", "count", "visible", "text"])
+ProbeResult.__doc__ = """
+Result of SeleniumDriver.probe_many for one locator. visible and text are for the first matching element
+"""
+
+# Finds the elements of a locator in the page. Used by the scripts below
+_FIND_FUNCTION = '''
+function find(by, value) {
+    switch (by) {
+        case "css selector": return Array.prototype.slice.call(document.querySelectorAll(value));
+        case "id": var element = document.getElementById(value); return element ? [element] : [];
+        case "name": return Array.prototype.slice.call(document.getElementsByName(value));
+        case "class name": return Array.prototype.slice.call(document.getElementsByClassName(value));
+        case "link text":
+            return Array.prototype.filter.call(document.getElementsByTagName("a"), function (link) {
+                return link.textContent.trim() === value;
+            });
+        case "xpath":
+            var snapshot = document.evaluate(value, document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+            var nodes = [];
+            for (var i = 0; i < snapshot.snapshotLength; i++) { nodes.push(snapshot.snapshotItem(i)); }
+            return nodes;
+    }
+    return [];
+}
+'''
+
+# Checks several locators in the page in one call. arguments[0] is a list of [By type, locator]
+_PROBE_MANY_SCRIPT = '/* probe_many */' + _FIND_FUNCTION + '''
+return arguments[0].map(function (probe) {
+    try {
+        var elements = find(probe[0], probe[1]), first = elements[0];
+        return {
+            count: elements.length,
+            visible: !!first && !!(first.offsetWidth || first.offsetHeight || first.getClientRects().length),
+            text: first ? (first.innerText || first.textContent || "").trim() : null
+        };
+    } catch (e) {
+        return {count: 0, visible: false, text: null};
+    }
+});'''
+
+# Returns the elements of several locators in one call. arguments[0] is a list of [By type, locator]
+_FIND_MANY_SCRIPT = '/* find_many */' + _FIND_FUNCTION + '''
+return arguments[0].map(function (probe) {
+    try {
+        return find(probe[0], probe[1]);
+    } catch (e) {
+        return [];
+    }
+});'''
+
+# Reads the texts and one attribute of the elements of several locators in one call. The script runs without
+# interruption in the page, so all the columns come from the same DOM state. arguments[0] is a list of
+# [By type, locator, attribute name or null]
+_READ_COLUMNS_SCRIPT = '/* read_columns */' + _FIND_FUNCTION + '''
+return arguments[0].map(function (column) {
+    try {
+        var elements = find(column[0], column[1]), name = column[2];
+        return {
+            texts: elements.map(function (element) { return (element.innerText || "").trim(); }),
+            attributes: name ? elements.map(function (element) {
+                var value = element[name];
+                return value === undefined || value === null ? element.getAttribute(name) : String(value);
+            }) : null
+        };
+    } catch (e) {
+        return {texts: [], attributes: null};
+    }
+});'''
+
 
 class SeleniumDriver(object):
     """
@@ -22,9 +95,157 @@ class SeleniumDriver(object):
 
     log = cl.customLogger(logging.DEBUG)
 
+    # Locator attributes of the class and its bases, {attribute name: Locator}. Built when a subclass is created
+    locators = {}
+
+    # Seconds a "not present" lookup result is trusted. Positive results are kept until the page state changes
+    negative_cache_ttl = 1.0
+    # The implicit wait configured on the driver. Probes set it to 0 and restore it afterwards
+    implicit_wait = 0
+
     def __init__(self, driver):
         self.driver = driver
 
+        # Lookup cache scoped to the current page state. It is cleared on navigation, window switch or any action
+        self._lookup_cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._navigator = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        registry = {}
+        for base in reversed(cls.__mro__[1:]):
+            registry.update(getattr(base, "locators", {}))
+        registry.update({name: value for name, value in vars(cls).items() if isinstance(value, Locator)})
+        cls.locators = registry
+
+    def invalidate_lookup_cache(self):
+        """
+        Clears the element lookup cache. Must be called every time the DOM state might have changed (navigation,
+        window switch, click, typing)
+        """
+        self._lookup_cache.clear()
+
+    def _cached_lookup(self, locator, locatorType, lookup):
+        """
+        Returns the cached presence of an element or calls lookup() and caches its result
+
+        Parameters
+        ----------
+        locator : str
+            The locator of the element
+        locatorType : str
+            Type of locator can be: id, name, xpath, css, class, link
+        lookup : callable
+            Called without arguments on cache miss. Should return True if the element is present
+
+        Returns
+        -------
+            True if the element is present
+        """
+        key = (locatorType.lower(), locator)
+        cached = self._lookup_cache.get(key)
+        if cached is not None:
+            present, expires_at = cached
+            if expires_at is None or time.monotonic() < expires_at:
+                self.cache_hits += 1
+                return present
+        self.cache_misses += 1
+        present = bool(lookup())
+        expires_at = None if present else time.monotonic() + self.negative_cache_ttl
+        self._lookup_cache[key] = (present, expires_at)
+        return present
+
+    def set_implicit_wait(self, seconds):
+        """
+        Sets the driver implicit wait and remembers it, so probes can restore it
+        """
+        self.implicit_wait = seconds
+        self.driver.implicitly_wait(seconds)
+
+    def get_cache_stats(self):
+        """
+        Returns the hit/miss counters of the lookup cache
+        """
+        total = self.cache_hits + self.cache_misses
+        hit_rate = self.cache_hits / total if total else 0.0
+        return {"hits": self.cache_hits, "misses": self.cache_misses, "hit_rate": hit_rate}
+
+    def switch_to_window(self, handle):
+        """
+        Switches the focus to a window and invalidates the lookup cache
+        """
+        self.invalidate_lookup_cache()
+        self.driver.switch_to.window(handle)
+
+    def open_window(self, url):
+        """
+        Opens a url in a new window (tab). The focus remains on the current window
+        """
+        self.invalidate_lookup_cache()
+        self.driver.execute_script('''window.open("{}","_blank");'''.format(url))
+
+    def close_window(self):
+        """
+        Closes the current window and invalidates the lookup cache
+        """
+        self.invalidate_lookup_cache()
+        self.driver.close()
+
+    def close_orphan_windows(self, keep_handle):
+        """
+        Closes all the windows except keep_handle and switches the focus to it. Used to reclaim the tabs left open
+        when an exception skipped closing them
+
+        Parameters
+        ----------
+        keep_handle : str
+            The handle of the window that remains open (usually the main page)
+
+        Returns
+        -------
+            The number of closed windows
+        """
+        closed = 0
+        for handle in self.driver.window_handles:
+            if handle == keep_handle:
+                continue
+            try:
+                self.driver.switch_to.window(handle)
+                self.driver.close()
+                closed += 1
+            except WebDriverException as e:
+                self.log.debug("Couldn't close window " + str(handle) + " " + repr(e))
+        self.switch_to_window(keep_handle)
+        if closed:
+            self.log.info("Closed " + str(closed) + " orphan window(s)")
+        return closed
+
+    @property
+    def navigator(self):
+        """Navigator used to wait for the pages to be ready after a refresh"""
+        if self._navigator is None:
+            self._navigator = Navigator(self.driver)
+        return self._navigator
+
+    def refresh_page(self, ready_selector=None):
+        """
+        Refreshes the current page, waits until it is ready (load and network idle, see navigation.py) and
+        invalidates the lookup cache
+
+        Parameters
+        ----------
+        ready_selector : str
+            Css selector of an element that must be in the page. None waits only for the load and the network
+
+        Returns
+        -------
+            NavigationTiming
+        """
+        self.invalidate_lookup_cache()
+        return self.navigator.refresh(ready_selector or "")
+
     def get_title(self):
         """
         Returns the title of the page
@@ -43,23 +264,21 @@ class SeleniumDriver(object):
         -------
         The locator type as defined by the BY class
         """
-        locatorType = locatorType.lower()
-        if locatorType == "id":
-            return By.ID
-        elif locatorType == "name":
-            return By.NAME
-        elif locatorType == "xpath":
-            return By.XPATH
-        elif locatorType == "css":
-            return By.CSS_SELECTOR
-        elif locatorType == "class":
-            return By.CLASS_NAME
-        elif locatorType == "link":
-            return By.LINK_TEXT
-        else:
+        byType = LOCATOR_TYPES.get(locatorType.lower())
+        if byType is None:
             self.log.info("Locator type " + locatorType +
                           " not correct/supported")
-        return False
+            return False
+        return byType
+
+    def resolve_locator(self, locator, locatorType="id"):
+        """
+        Returns the (By type, locator) tuple of a locator. A Locator already has it, for a plain string locatorType
+        is used
+        """
+        if isinstance(locator, Locator):
+            return locator.by_tuple
+        return self.get_by_type(locatorType), locator
 
     @retry(stop_max_attempt_number=3, wait_fixed=3)
     def get_element(self, locator, locatorType="id", take_screen_shot=True):
@@ -135,6 +354,7 @@ class SeleniumDriver(object):
         locatorType : str
             Type of locator can be: id, name, xpath, css, class, link
         """
+        self.invalidate_lookup_cache()
         try:
             #element = self.get_element(locator, locatorType)
             element = self.wait_for_element(locator=locator, locator_type=locatorType,
@@ -164,6 +384,7 @@ class SeleniumDriver(object):
             Type of locator can be: id, name, xpath, css, class, link
 
         """
+        self.invalidate_lookup_cache()
         try:
             element = self.wait_for_element(locator=locator, locator_type=locatorType, refreshes=1)
             element.send_keys(data)
@@ -193,7 +414,15 @@ class SeleniumDriver(object):
 
     def is_element_present(self, locator, locatorType="id", take_screen_shot=True):
         """
-        Checks the presence of an element
+        Checks the presence of an element. The result is cached until the page state changes (see
+        invalidate_lookup_cache). A negative result is cached only for negative_cache_ttl seconds
+        """
+        return self._cached_lookup(locator, locatorType,
+                                   lambda: self._is_element_present(locator, locatorType, take_screen_shot))
+
+    def _is_element_present(self, locator, locatorType="id", take_screen_shot=True):
+        """
+        Checks the presence of an element without using the lookup cache
         """
         try:
             element = self.get_element(locator, locatorType, take_screen_shot)
@@ -212,6 +441,209 @@ class SeleniumDriver(object):
             return False
 
 
+    def probe_element(self, locator, locatorType="id", expect_absent=False):
+        """
+        Fast existence check. Uses find_elements with a zero implicit wait, so a missing element is reported
+        immediately. It never retries and never takes screenshots. Only an unexpected result is logged
+
+        Parameters
+        ----------
+        locator : str
+            The locator of the element
+        locatorType : str
+            Type of locator can be: id, name, xpath, css, class, link
+        expect_absent : bool
+            True if the caller expects the element to be missing (e.g. checking that a field is empty)
+
+        Returns
+        -------
+            True if the element is present
+        """
+        byType = self.get_by_type(locatorType)
+
+        def lookup():
+            if self.implicit_wait:
+                self.driver.implicitly_wait(0)
+            try:
+                return len(self.driver.find_elements(byType, locator)) > 0
+            except WebDriverException as e:
+                self.log.debug("Probe failed for locator: " + locator + " locatorType: " + locatorType +
+                               " exception: " + repr(e))
+                return False
+            finally:
+                if self.implicit_wait:
+                    self.driver.implicitly_wait(self.implicit_wait)
+
+        present = self._cached_lookup(locator, locatorType, lookup)
+        if present == expect_absent:
+            self.log.debug("Element " + ("present" if present else "not present") + " with locator: " + locator +
+                           " locatorType: " + locatorType)
+        return present
+
+    def probe_many(self, locators, locatorType="css"):
+        """
+        Checks the presence, visibility and text of several elements in one execute_script call. Like
+        probe_element, it never waits, retries or takes screenshots. The presence results are added to the lookup
+        cache, except when the script fails
+
+        Parameters
+        ----------
+        locators : list
+            Locator objects or locator strings
+        locatorType : str
+            Type of the locator strings. Locator objects use their own type
+
+        Returns
+        -------
+            {locator: ProbeResult}
+        """
+        probes = [list(self.resolve_locator(locator, locatorType)) for locator in locators]
+        try:
+            raw_results = self.driver.execute_script(_PROBE_MANY_SCRIPT, probes) or []
+        except WebDriverException as e:
+            self.log.debug("Probe failed for locators: " + str(list(locators)) + " exception: " + repr(e))
+            raw_results = []
+
+        results = {}
+        for position, locator in enumerate(locators):
+            raw = raw_results[position] if position < len(raw_results) and raw_results[position] else None
+            if raw is None:
+                # The script failed or didn't answer for this locator: absent, but nothing is cached
+                results[locator] = ProbeResult(False, 0, False, None)
+                continue
+            count = int(raw.get("count") or 0)
+            results[locator] = ProbeResult(count > 0, count, bool(raw.get("visible")), raw.get("text"))
+            cache_type = locator.locator_type if isinstance(locator, Locator) else locatorType
+            expires_at = None if count else time.monotonic() + self.negative_cache_ttl
+            self._lookup_cache[(cache_type.lower(), locator)] = (count > 0, expires_at)
+        return results
+
+    def find_many(self, locators, locatorType="css"):
+        """
+        Finds the elements of several locators in one execute_script call
+
+        Returns
+        -------
+            {locator: list of elements}
+        """
+        probes = [list(self.resolve_locator(locator, locatorType)) for locator in locators]
+        try:
+            found = self.driver.execute_script(_FIND_MANY_SCRIPT, probes) or []
+        except WebDriverException as e:
+            self.log.debug("Cannot find elements for locators: " + str(list(locators)) + " exception: " + repr(e))
+            found = []
+        return {locator: list(found[position]) if position < len(found) and found[position] else []
+                for position, locator in enumerate(locators)}
+
+    def read_columns(self, columns, locatorType="css"):
+        """
+        Reads the texts, and optionally an attribute, of the elements of several locators in one execute_script
+        call. Unlike reading element by element, the columns of a table are a consistent snapshot: the page can't
+        be redrawn between two of them
+
+        Parameters
+        ----------
+        columns : list
+            (locator, attribute name or None) tuples. Locator objects or locator strings
+        locatorType : str
+            Type of the locator strings. Locator objects use their own type
+
+        Returns
+        -------
+            {locator: (list of texts, list of attribute values or None)}. Empty lists if the script failed
+        """
+        probes = [list(self.resolve_locator(locator, locatorType)) + [attribute] for locator, attribute in columns]
+        try:
+            read = self.driver.execute_script(_READ_COLUMNS_SCRIPT, probes) or []
+        except WebDriverException as e:
+            self.log.debug("Cannot read the columns: " + str(columns) + " exception: " + repr(e))
+            read = []
+        results = {}
+        for position, (locator, attribute) in enumerate(columns):
+            column = read[position] if position < len(read) and read[position] else {}
+            results[locator] = (list(column.get("texts") or []),
+                                None if column.get("attributes") is None else list(column["attributes"]))
+        return results
+
+    def _poll(self, locators, locatorType, timeout, poll_frequency, condition):
+        """
+        Calls find_many every poll_frequency seconds until condition(results) is True or the timeout expires.
+        Returns (condition fulfilled, last results)
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            results = self.find_many(locators, locatorType)
+            if condition(results):
+                return True, results
+            if time.monotonic() >= deadline:
+                return False, results
+            time.sleep(poll_frequency)
+
+    def wait_for_all(self, locators, locatorType="css", timeout=7, poll_frequency=0.5, equal_counts=False,
+                     refreshes=0, take_screen_shot=True):
+        """
+        Waits until every locator has at least one element. All the locators are checked in one round-trip per
+        poll, instead of one wait_for_element (with its own timeout) per locator
+
+        Parameters
+        ----------
+        locators : list
+            Locator objects or locator strings
+        locatorType : str
+            Type of the locator strings. Locator objects use their own type
+        timeout : float
+            Seconds to wait
+        poll_frequency : float
+            Seconds between two checks
+        equal_counts : bool
+            Also wait until all the locators have the same number of elements (e.g. the columns of a table that is
+            still rendering)
+        refreshes : int
+            Refresh the page and wait again this many times if the condition was not fulfilled
+
+        Returns
+        -------
+            {locator: list of elements}. After a timeout, the elements found by the last check
+        """
+        def condition(results):
+            counts = [len(elements) for elements in results.values()]
+            return all(counts) and (not equal_counts or len(set(counts)) == 1)
+
+        fulfilled, results = self._poll(locators, locatorType, timeout, poll_frequency, condition)
+        for refresh_count in range(refreshes):
+            if fulfilled:
+                break
+            print("Elements timeout: " + str(list(locators)) + " Page refreshed")
+            self.refresh_page()
+            fulfilled, results = self._poll(locators, locatorType, timeout, poll_frequency, condition)
+        if not fulfilled:
+            self.log.debug("Cannot wait for all the elements with locators: " + str(list(locators)) + " counts: " +
+                           str([len(elements) for elements in results.values()]))
+            if take_screen_shot:
+                screen_shot(self.driver, self.log)
+        return results
+
+    def wait_for_any(self, locators, locatorType="css", timeout=7, poll_frequency=0.5, take_screen_shot=True):
+        """
+        Waits until one of the locators has elements. Used when the page can end in different states (e.g. a
+        result or an error message)
+
+        Returns
+        -------
+            (locator, list of elements) of the first locator (in the given order) that has elements, (None, [])
+            after a timeout
+        """
+        fulfilled, results = self._poll(locators, locatorType, timeout, poll_frequency,
+                                        lambda found: any(found.values()))
+        if fulfilled:
+            for locator in locators:
+                if results[locator]:
+                    return locator, results[locator]
+        self.log.debug("Cannot wait for any of the elements with locators: " + str(list(locators)))
+        if take_screen_shot:
+            screen_shot(self.driver, self.log)
+        return None, []
+
     def _check_load(self, element,  locator=None, locator_type="id"):
         """
         Just for testing
@@ -230,14 +662,17 @@ class SeleniumDriver(object):
         except StaleElementReferenceException:
             return False
 
-    def _retry_wait(self, element, locator=None, locator_type="id", find_time_out=3):
+    def _retry_wait(self, element, locator=None, locator_type="id", find_time_out=3, poll_frequency=0.2):
         "Just for testing"
-        start_time = time.time()
-        while time.time() < start_time + find_time_out:
+        if not element:
+            return None
+        deadline = time.monotonic() + find_time_out
+        while True:
             if self._check_load(element, locator, locator_type):
                 return element
-            # else:
-            #     new_el = self._check_load(element, locator, locator_type)
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(poll_frequency)
         screen_shot(self.driver, self.log)
         return None
 
@@ -309,8 +744,7 @@ class SeleniumDriver(object):
             if refreshes != 0:
                 for refresh_count in range(refreshes):
                     if not wait_result:
-                        time.sleep(10)
-                        self.driver.refresh()
+                        self.refresh_page()
                         print("Page refreshed")
                         wait_result = wait.until(condition)
                         if wait_result is not None:
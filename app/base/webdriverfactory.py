@@ -11,6 +11,8 @@ Example:
 from selenium import webdriver
 from app.utilities.custom_logger import screen_shot
 import app.utilities.custom_logger as cl
+from app.base.navigation import Navigator
+from app.base.command_trace import CommandRecorder
 import logging
 import sys
 import os
@@ -23,12 +25,44 @@ class WebDriverFactory():
 
     log = cl.customLogger(logging.DEBUG)
 
-    def __init__(self, browser, base_url):
+    # The page is ready when the first message of the list is shown
+    ready_selector = "#messages-list > tbody > tr:nth-child(1)"
+    # Seconds the ready selector is waited for once the page is loaded and idle (see Navigator)
+    selector_grace = 5
+
+    def __init__(self, browser, base_url, headless=False, driver_path=None, ready_selector=None, trace_folder=None,
+                 profile_dir=None):
         """
         Inits WebDriverFactory class
+
+        Parameters
+        ----------
+        browser : str
+            chrome, firefox or iexplorer
+        base_url : str
+            The url opened after the browser starts
+        headless : bool
+            Start chrome without a window and without the robot user profile. Used for benchmarks
+        driver_path : str
+            Path to chromedriver. By default chromedriver.exe from the script folder is used
+        ready_selector : str
+            Css selector of the element that shows the start page is ready. "" waits only for the load and the
+            network: use it when a login page comes first (the messages list is shown only after the login)
+        trace_folder : str
+            If set, the WebDriver commands of every new browser are recorded in a trace file in this folder (see
+            command_trace.py)
+        profile_dir : str
+            Chrome user data folder. Chrome can't open a profile used by another browser, so every browser running
+            at the same time needs its own. By default the robot user profile (or none in headless mode)
         """
         self.browser = browser
         self.base_url = base_url
+        self.headless = headless
+        self.driver_path = driver_path or os.path.join(os.path.split(sys.argv[0])[0], "chromedriver.exe")
+        if ready_selector is not None:
+            self.ready_selector = ready_selector
+        self.trace_folder = trace_folder
+        self.profile_dir = profile_dir
 
     def getWebDriverInstance(self):
         """
@@ -51,37 +85,45 @@ class WebDriverFactory():
         elif self.browser == "chrome":
             # Set chrome driver
             options = webdriver.ChromeOptions()
-            #options.add_argument("headless")
-            options.add_argument(r"user-data-dir=D:\Users\eddiehamilton\AppData\Local\Google\Chrome\User Data\Default")
-            driver = webdriver.Chrome(os.path.join(os.path.split(sys.argv[0])[0], "chromedriver.exe"),
-                                      chrome_options=options)
+            if self.headless:
+                options.add_argument("headless")
+                options.add_argument("window-size=1920,1080")
+            if self.profile_dir:
+                options.add_argument("user-data-dir=" + os.path.abspath(self.profile_dir))
+            elif not self.headless:
+                options.add_argument(r"user-data-dir=D:\Users\eddiehamilton\AppData\Local\Google\Chrome\User Data\Default")
+            driver = webdriver.Chrome(self.driver_path, chrome_options=options)
         # Setting Driver Implicit Time out for An Element
         #driver.implicitly_wait(15)
         # Setting load timeout
+        if self.trace_folder:
+            os.makedirs(self.trace_folder, exist_ok=True)
+            CommandRecorder.attach(driver, os.path.join(self.trace_folder,
+                                                        time.strftime("trace_%Y-%m-%d_%Hh%Mm%Ss.jsonl.gz")))
         driver.set_page_load_timeout(60)
         # Maximize the window
 
         #driver.minimize_window()
-        # Loading browser with App URL. Try 3 times
+        driver.maximize_window()
+        # Loading browser with App URL. Try 3 times. Every attempt waits for the page to be ready (see navigation.py)
+        navigator = Navigator(driver, self.ready_selector, selector_grace=self.selector_grace)
         for i in range(3):
-            try:
-                driver.get(self.base_url)
-                #driver.set_window_size(width=1980, height=1050)
-                driver.maximize_window()
-                # driver.set_window_position(0, 0)
-                print("Page opened " + self.base_url + "  " + str(driver.get_window_size()))
+            timing = navigator.navigate(self.base_url)
+            if timing.ready:
+                print("Page opened " + self.base_url + " in " + "{:.1f}".format(timing.seconds) + " s  " +
+                      str(driver.get_window_size()))
                 self.log.info("Page opened " + str(driver.get_window_size()) + ' ' + self.base_url)
-                #driver.minimize_window()
                 return driver
-            except:
-                self.log.error(self.base_url + " could not be loaded!")
-                print(self.base_url + " could not be loaded!")
-                time.sleep(10)
-                driver.refresh()
-                screen_shot(driver, self.log)
-
-
-print(os.path.join(os.path.split(sys.argv[0])[0], "chromedriver.exe"))
+            screen_shot(driver, self.log)
+            if timing.dom_seconds is not None:
+                # The page loaded but the ready selector is missing (e.g. login page, empty inbox). Loading it again
+                # won't show it, the automation decides what to do
+                self.log.warning(self.base_url + " loaded without " + str(self.ready_selector) + " after " +
+                                 "{:.1f}".format(timing.seconds) + " s")
+                return driver
+            self.log.error(self.base_url + " was not ready after " + "{:.1f}".format(timing.seconds) + " s")
+            print(self.base_url + " could not be loaded!")
+        return None
 
 if __name__ == "__main__":
     print(os.path.join(os.path.split(sys.argv[0])[0], "chromedriver.exe"))
\ No newline at end of file
@@ -0,0 +1,5 @@
+"""
+Benchmarks for the automation. Every module can be run as a script, e.g.:
+
+    python -m app.benchmarks.probe_benchmark
+"""
@@ -0,0 +1,435 @@
+"""
+A local stand-in for the iController messages pages. It serves the messages list, the mail pop-up (show) and the
+forward (compose) page with the same structure and locators as the live site, including select2 label, client and
+forward fields.
+
+Example:
+    inbox = FakeInbox(size=50)
+    server = FakeIControllerServer(inbox, latency=0.05)
+    server.start()
+    driver.get(server.base_url)
+    ...
+    server.stop()
+"""
+import html
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+LABELS = ["Invoice", "Damage", "Fines", "Contract", "Fuel card", "Tyres", "Maintenance", "Insurance"]
+SENDERS = ["noreply@fleet-services.com", "claims@insurer.eu", "driver{}@client.com", "accounts@supplier.nl",
+           "info@tyres.be"]
+WORDS = ["please", "find", "attached", "invoice", "vehicle", "contract", "damage", "report", "payment", "driver",
+         "order", "reference", "regards", "number", "plate", "request", "confirm", "maintenance", "service", "date"]
+
+
+class FakeInbox(object):
+    """
+    In-memory inbox with generated mails. Labels, clients, forwards and closed mails set from the pages are stored
+    here, so a second run sees the mails as already labeled. closed counts the Done clicks of a mail.
+
+    Parameters
+    ----------
+    size : int
+        Number of mails in the inbox
+    seed : int
+        Seed for the generated content. The same seed always generates the same inbox
+    clients_count : int
+        Number of client numbers available in the clients field
+    """
+
+    def __init__(self, size=50, seed=0, clients_count=200):
+        generator = random.Random(seed)
+        self.clients = [str(100000 + index) for index in range(clients_count)]
+        self.labels = list(LABELS)
+        self.messages = {}
+        self.order = []
+        newest = datetime(2020, 10, 27, 18, 0)
+        for index in range(size):
+            message_id = str(700000 + index)
+            sender = generator.choice(SENDERS).format(generator.randint(1, 99))
+            subject = "{} {} {}".format(generator.choice(LABELS), generator.choice(WORDS), generator.randint(1, 9999))
+            body = " ".join(generator.choice(WORDS) for _ in range(generator.randint(40, 400)))
+            body += "\nClient " + generator.choice(self.clients)
+            body += "\nFrom: previous@mail.com\n" + " ".join(generator.choice(WORDS) for _ in range(100))
+            self.messages[message_id] = {
+                "id": message_id,
+                "subject": subject,
+                "sender": sender,
+                "receiver": "robot@leaseplan.com",
+                "date": (newest - timedelta(minutes=7 * index)).strftime("%Y-%m-%d %H:%M"),
+                "body": body,
+                "labels": [],
+                "clients": [],
+                "forwarded_to": [],
+                "forward_sent": False,
+                "closed": 0,
+            }
+            self.order.append(message_id)
+        self.lock = threading.Lock()
+
+    def record(self, action, message_id, value=None):
+        """
+        Stores an action done from the pages: label, client, forward, send or done
+        """
+        with self.lock:
+            message = self.messages.get(message_id)
+            if message is None:
+                return False
+            if action == "label":
+                message["labels"].append(value)
+            elif action == "client":
+                message["clients"].append(value)
+            elif action == "forward":
+                message["forwarded_to"].append(value)
+            elif action == "send":
+                message["forward_sent"] = True
+            elif action == "done":
+                message["closed"] += 1
+            else:
+                return False
+            return True
+
+    def unprocessed(self):
+        """
+        Returns the ids of the mails that were not labeled and closed exactly once. After a run with rules that label
+        and close every mail, the list should be empty
+        """
+        with self.lock:
+            return [message_id for message_id in self.order
+                    if len(self.messages[message_id]["labels"]) != 1 or self.messages[message_id]["closed"] != 1]
+
+
+SELECT2_SCRIPT = """
+<script>
+(function () {
+  var drop = document.getElementById("select2-drop");
+  var active = null;
+  function post(action, value, done) {
+    var request = new XMLHttpRequest();
+    request.open("POST", "/messages/" + action + "?msg=" + document.body.dataset.msg +
+                 "&value=" + encodeURIComponent(value));
+    if (done) { request.onloadend = done; }
+    request.send();
+  }
+  function addChoice(input, text) {
+    var li = document.createElement("li");
+    li.className = "select2-search-choice";
+    var div = document.createElement("div");
+    div.textContent = text;
+    li.appendChild(div);
+    input.parentNode.parentNode.insertBefore(li, input.parentNode);
+    post(input.dataset.action, text);
+  }
+  function hideDrop() { drop.style.display = "none"; drop.firstElementChild.innerHTML = ""; }
+  function showDrop(input) {
+    var text = input.value.toLowerCase();
+    var options = JSON.parse(input.dataset.options || "[]").filter(function (option) {
+      return text && option.toLowerCase().indexOf(text) !== -1;
+    });
+    var list = drop.firstElementChild;
+    list.innerHTML = "";
+    if (input.dataset.grouped) {
+      var group = document.createElement("li");
+      var inner = document.createElement("ul");
+      options.slice(0, 10).forEach(function (option) {
+        var item = document.createElement("li"); item.textContent = option; inner.appendChild(item);
+      });
+      group.appendChild(inner);
+      list.appendChild(group);
+    } else {
+      options.slice(0, 10).forEach(function (option) {
+        var item = document.createElement("li"); item.textContent = option; list.appendChild(item);
+      });
+    }
+    drop.style.display = options.length ? "block" : "none";
+    active = input;
+  }
+  Array.prototype.forEach.call(document.querySelectorAll(".select2-search-field input"), function (input) {
+    input.addEventListener("input", function () { showDrop(input); });
+    input.addEventListener("keydown", function (event) {
+      if (event.key === "Enter") {
+        var first = drop.querySelector("ul ul li") || drop.querySelector("li");
+        if (active === input && first) { addChoice(input, first.textContent); }
+        input.value = "";
+        hideDrop();
+        event.preventDefault();
+      } else if (event.key === "Escape") {
+        if (input.dataset.tags && input.value.indexOf("@") !== -1) { addChoice(input, input.value); }
+        input.value = "";
+        hideDrop();
+      }
+    });
+  });
+  Array.prototype.forEach.call(document.querySelectorAll("button[data-action]"), function (button) {
+    button.addEventListener("click", function (event) {
+      event.preventDefault();
+      // Done and Send close the pop-up once the request is answered, like the live site
+      post(button.dataset.action, "", function () { window.close(); });
+    });
+  });
+})();
+</script>
+"""
+
+
+def _select2_field(container_id, input_id, action, options=None, grouped=False, tags=False):
+    """
+    Returns the html of a select2 multi value field
+    """
+    attributes = 'data-action="{}"'.format(action)
+    if options is not None:
+        attributes += " data-options='{}'".format(html.escape(json.dumps(options), quote=True))
+    if grouped:
+        attributes += ' data-grouped="1"'
+    if tags:
+        attributes += ' data-tags="1"'
+    return ('<div class="select2-container select2-container-multi" id="{container}">'
+            '<ul class="select2-choices"><li class="select2-search-field">'
+            '<input type="text" id="{input}" autocomplete="off" {attributes}></li></ul></div>'
+            ).format(container=container_id, input=input_id, attributes=attributes)
+
+
+def _choices(values):
+    return "".join('<li class="select2-search-choice"><div>{}</div></li>'.format(html.escape(value))
+                   for value in values)
+
+
+def messages_page(inbox, host):
+    """
+    Returns the html of the messages list
+    """
+    rows = []
+    for message_id in inbox.order:
+        message = inbox.messages[message_id]
+        rows.append(
+            '<tr><td class="column-checkbox"><input type="checkbox"></td>'
+            '<td class="column-subject"><a href="http://{host}/messages#mail={id}">{subject}</a></td>'
+            '<td class="column-from"><span>{sender}</span></td>'
+            '<td class="column-received-at sorting_1">{date}</td>'
+            '<td class="column-3">{label}</td></tr>'.format(host=host, id=message_id,
+                                                           subject=html.escape(message["subject"]),
+                                                           sender=html.escape(message["sender"]),
+                                                           date=message["date"],
+                                                           label=html.escape(", ".join(message["labels"]))))
+    return ('<html><head><title>Messages - iController</title></head><body>'
+            '<div class="main-content"><table id="messages-list"><thead><tr><th></th><th>Subject</th><th>From</th>'
+            '<th>Received</th><th>Labels</th></tr></thead><tbody>{}</tbody></table></div></body></html>'
+            ).format("".join(rows))
+
+
+def show_page(inbox, message_id):
+    """
+    Returns the html of the mail pop-up
+    """
+    message = inbox.messages[message_id]
+    clients = _select2_field("s2id_autogen1", "s2id_autogen2", "client", inbox.clients, grouped=True)
+    labels = _select2_field("s2id_autogen3", "s2id_autogen4", "label", inbox.labels)
+    clients = clients.replace('<ul class="select2-choices">', '<ul class="select2-choices">' +
+                              _choices(message["clients"]))
+    labels = labels.replace('<ul class="select2-choices">', '<ul class="select2-choices">' +
+                            _choices(message["labels"]))
+    return ('<html><head><title>{subject}</title></head><body data-msg="{id}">'
+            '<div class="main-content"><form>'
+            '<h2>{subject}</h2>'
+            '<div class="from">{sender} &lt;{sender}&gt;</div>'
+            '<div class="contact"><div><span>Robot &lt;{receiver}&gt;</span></div></div>'
+            '<div class="clients">{clients}</div>'
+            '<div class="labels">{labels}</div>'
+            '<div class="content" style="white-space: pre-wrap">{body}</div>'
+            '<div class="actions"><button class="done call-to-action" data-action="done">Done</button></div>'
+            '</form></div>'
+            '<div id="select2-drop" style="display:none"><ul></ul></div>{script}</body></html>'
+            ).format(id=message_id, subject=html.escape(message["subject"]),
+                     sender=html.escape(message["sender"]), receiver=html.escape(message["receiver"]),
+                     clients=clients, labels=labels, body=html.escape(message["body"]), script=SELECT2_SCRIPT)
+
+
+def forward_page(inbox, message_id):
+    """
+    Returns the html of the forward (compose) pop-up
+    """
+    message = inbox.messages[message_id]
+    receivers = _select2_field("s2id_autogen3", "s2id_autogen4", "forward", tags=True)
+    return ('<html><head><title>Forward</title></head><body data-msg="{id}">'
+            '<div class="main-content"><form>'
+            '<div class="to">{receivers}</div>'
+            '<h2>FW: {subject}</h2>'
+            '<div class="actions"><button class="send call-to-action" data-action="send">Send</button></div>'
+            '</form></div>'
+            '<div id="select2-drop" style="display:none"><ul></ul></div>{script}</body></html>'
+            ).format(id=message_id, subject=html.escape(message["subject"]), receivers=receivers,
+                     script=SELECT2_SCRIPT)
+
+
+def render(inbox, path, host):
+    """
+    Returns the html for a url path (with query) or None if the page doesn't exist
+    """
+    parsed = urlparse(path)
+    if parsed.path.rstrip("/") == "/messages":
+        return messages_page(inbox, host)
+    if parsed.path == "/messages/show":
+        message_id = parse_qs(parsed.query).get("msg", [""])[0]
+        if message_id in inbox.messages:
+            return show_page(inbox, message_id)
+    match = re.match(r"^/messages/compose/direction/forward/messageId/(\d+)$", parsed.path)
+    if match and match.group(1) in inbox.messages:
+        return forward_page(inbox, match.group(1))
+    return None
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        page = render(self.server.inbox, self.path, "{}:{}".format(*self.server.server_address))
+        if page is None:
+            self.send_error(404)
+            return
+        data = page.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        action = parsed.path.rsplit("/", 1)[-1]
+        recorded = self.server.inbox.record(action, query.get("msg", [""])[0], query.get("value", [""])[0])
+        self.send_response(204 if recorded else 404)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeIControllerServer(object):
+    """
+    HTTP server that serves a FakeInbox on localhost
+
+    Parameters
+    ----------
+    inbox : FakeInbox
+        The mails served by the server
+    latency : float
+        Seconds added to every response
+    port : int
+        0 chooses a free port
+    """
+
+    def __init__(self, inbox, latency=0.0, port=0):
+        self.inbox = inbox
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+        self.httpd.inbox = inbox
+        self.httpd.latency = latency
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return "http://{}:{}/messages".format(*self.httpd.server_address)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeIControllerSite(object):
+    """
+    Serves a FakeInbox to FakeWebDriver (see fake_webdriver.py) without a HTTP server. The select2 fields and the
+    buttons are simulated in python, with the same behaviour as SELECT2_SCRIPT
+
+    Parameters
+    ----------
+    inbox : FakeInbox
+        The mails served by the site
+    host : str
+        Host used in the urls
+    """
+
+    def __init__(self, inbox, host="icontroller.local"):
+        self.inbox = inbox
+        self.host = host
+
+    @property
+    def base_url(self):
+        return "http://{}/messages".format(self.host)
+
+    def page(self, url):
+        return render(self.inbox, url, self.host)
+
+    @staticmethod
+    def _message_id(driver):
+        from app.benchmarks.fake_webdriver import find_nodes
+        from selenium.webdriver.common.by import By
+        return find_nodes(driver.document(), By.TAG_NAME, "body")[0].attrs.get("data-msg")
+
+    def _drop_list(self, driver):
+        from app.benchmarks.fake_webdriver import select
+        return select(driver.document(), "#select2-drop > ul")[0]
+
+    def _add_choice(self, driver, node, text):
+        from app.benchmarks.fake_webdriver import parse_fragment
+        choice = parse_fragment('<li class="select2-search-choice"><div>{}</div></li>'.format(html.escape(text)))[0]
+        search_field = node.parent
+        search_field.parent.insert_before(choice, search_field)
+        self.inbox.record(node.attrs.get("data-action"), self._message_id(driver), text)
+
+    def on_send_keys(self, driver, element, text):
+        from app.benchmarks.fake_webdriver import parse_fragment
+        from selenium.webdriver.common.keys import Keys
+        node = element.node
+        if node.tag != "input" or node.parent is None or "select2-search-field" not in node.parent.classes:
+            return False
+        drop_list = self._drop_list(driver)
+        drop_list.parent.attrs["style"] = "display:none"
+        if text in (Keys.RETURN, Keys.ENTER):
+            options = [item for item in drop_list.iter_descendants()
+                       if item.tag == "li" and not item.element_children()]
+            if options:
+                self._add_choice(driver, node, options[0].text())
+            node.value = ""
+            drop_list.remove_children()
+        elif text == Keys.ESCAPE:
+            if "data-tags" in node.attrs and "@" in node.value:
+                self._add_choice(driver, node, node.value)
+            node.value = ""
+            drop_list.remove_children()
+        else:
+            node.value += text
+            typed = node.value.lower()
+            options = [option for option in json.loads(node.attrs.get("data-options", "[]"))
+                       if typed in option.lower()][:10]
+            items = "".join("<li>{}</li>".format(html.escape(option)) for option in options)
+            if "data-grouped" in node.attrs:
+                items = "<li><ul>{}</ul></li>".format(items)
+            drop_list.remove_children()
+            for item in parse_fragment(items):
+                drop_list.append(item)
+            if options:
+                drop_list.parent.attrs["style"] = "display:block"
+        return True
+
+    def on_click(self, driver, element):
+        node = element.node
+        action = node.attrs.get("data-action")
+        if node.tag != "button" or not action:
+            return False
+        self.inbox.record(action, self._message_id(driver))
+        if action in ("done", "send"):
+            # Done and Send close the pop-up, like window.close() in SELECT2_SCRIPT
+            driver._windows.pop(driver._current, None)
+        return True
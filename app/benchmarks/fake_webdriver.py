@@ -0,0 +1,610 @@
+"""
+An in-memory WebDriver used to measure the python side of the automation (SeleniumDriver, WebInterations,
+CreateReport) without a browser. Pages are parsed into a small DOM tree and searched with a CSS selector engine
+that supports the selectors used by the page classes.
+
+Example:
+    driver = FakeWebDriver(site)
+    driver.get(site.base_url)
+    SeleniumDriver(driver).get_text(locator="#messages-list > tbody > tr:nth-child(1)", locator_type="css")
+
+The site object should have a page(url) method returning html (or None for 404). It can also define
+on_send_keys(driver, element, text) and on_click(driver, element) to simulate the page scripts. Both return True if
+they handled the event.
+"""
+import re
+import time
+from collections import Counter
+from html.parser import HTMLParser
+from itertools import count
+
+from selenium.common.exceptions import (InvalidSelectorException, NoSuchElementException,
+                                        NoSuchWindowException, StaleElementReferenceException)
+from selenium.webdriver.common.by import By
+
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track",
+             "wbr"}
+BLOCK_TAGS = {"address", "article", "aside", "blockquote", "br", "dd", "div", "dl", "dt", "fieldset", "footer",
+              "form", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr", "li", "main", "nav", "ol", "p", "pre",
+              "section", "table", "tbody", "thead", "tfoot", "tr", "ul"}
+HIDDEN_TAGS = {"head", "script", "style", "template", "title"}
+
+# A 1x1 transparent png written by save_screenshot
+PNG_PIXEL = bytes.fromhex("89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c489"
+                          "0000000d4944415478da63f8ffff3f0005fe02fea7d6a4bd0000000049454e44ae426082")
+
+
+class Node(object):
+    """A DOM element. children contains Node objects and strings (text nodes)"""
+
+    def __init__(self, tag, attrs=None, parent=None):
+        self.tag = tag
+        self.attrs = dict(attrs or {})
+        self.parent = parent
+        self.children = []
+        self.value = self.attrs.get("value", "")
+
+    @property
+    def classes(self):
+        return self.attrs.get("class", "").split()
+
+    def element_children(self):
+        return [child for child in self.children if isinstance(child, Node)]
+
+    def iter_descendants(self):
+        for child in self.children:
+            if isinstance(child, Node):
+                yield child
+                yield from child.iter_descendants()
+
+    def append(self, child):
+        if isinstance(child, Node):
+            child.parent = self
+        self.children.append(child)
+
+    def insert_before(self, child, reference):
+        child.parent = self
+        self.children.insert(self.children.index(reference), child)
+
+    def remove_children(self):
+        for child in self.children:
+            if isinstance(child, Node):
+                child.parent = None
+        self.children = []
+
+    def root(self):
+        node = self
+        while node.parent is not None:
+            node = node.parent
+        return node
+
+    def is_hidden(self):
+        node = self
+        while node is not None:
+            style = node.attrs.get("style", "").replace(" ", "").lower()
+            if node.tag in HIDDEN_TAGS or "display:none" in style or "hidden" in node.attrs:
+                return True
+            node = node.parent
+        return False
+
+    def text(self):
+        """Returns the rendered text, similar to WebElement.text"""
+        parts = []
+        self._collect_text(parts, preformatted=False)
+        lines = [re.sub(r"[ \t\r\f\v]+", " ", line).strip() for line in "".join(parts).split("\n")]
+        return "\n".join(line for line in lines if line)
+
+    def _collect_text(self, parts, preformatted):
+        style = self.attrs.get("style", "").replace(" ", "").lower()
+        preformatted = preformatted or self.tag == "pre" or "white-space:pre" in style
+        for child in self.children:
+            if isinstance(child, Node):
+                if child.tag in HIDDEN_TAGS or "display:none" in child.attrs.get("style", "").replace(" ", ""):
+                    continue
+                if child.tag in BLOCK_TAGS:
+                    parts.append("\n")
+                child._collect_text(parts, preformatted)
+                if child.tag in BLOCK_TAGS:
+                    parts.append("\n")
+                elif child.tag in ("td", "th"):
+                    parts.append(" ")
+            elif preformatted:
+                parts.append(child)
+            else:
+                parts.append(re.sub(r"\s+", " ", child))
+
+
+class _TreeBuilder(HTMLParser):
+
+    def __init__(self, root):
+        super().__init__(convert_charrefs=True)
+        self.stack = [root]
+
+    def handle_starttag(self, tag, attrs):
+        node = Node(tag, [(name, "" if value is None else value) for name, value in attrs])
+        self.stack[-1].append(node)
+        if tag not in VOID_TAGS:
+            self.stack.append(node)
+
+    def handle_startendtag(self, tag, attrs):
+        self.stack[-1].append(Node(tag, [(name, "" if value is None else value) for name, value in attrs]))
+
+    def handle_endtag(self, tag):
+        for position in range(len(self.stack) - 1, 0, -1):
+            if self.stack[position].tag == tag:
+                del self.stack[position:]
+                break
+
+    def handle_data(self, data):
+        self.stack[-1].append(data)
+
+
+def parse_html(page):
+    """Parses a html page and returns the document node"""
+    document = Node("#document")
+    builder = _TreeBuilder(document)
+    builder.feed(page)
+    builder.close()
+    return document
+
+
+def parse_fragment(fragment):
+    """Parses a html fragment and returns its top level nodes"""
+    return parse_html(fragment).element_children()
+
+
+# CSS selectors
+
+_TOKEN = re.compile(r"""
+    (?P<space>\s*(?P<combinator>[>+~])\s*|\s+)
+  | (?P<tag>\*|[a-zA-Z][\w-]*)
+  | \#(?P<id>[\w-]+)
+  | \.(?P<class>[\w-]+)
+  | \[\s*(?P<attr>[\w-]+)\s*(?:(?P<op>[~^$*|]?=)\s*(?:"(?P<dq>[^"]*)"|'(?P<sq>[^']*)'|(?P<bare>[^\]\s]+))\s*)?\]
+  | :(?P<pseudo>[\w-]+)(?:\((?P<arg>[^)]*)\))?
+""", re.VERBOSE)
+
+
+class Compound(object):
+    """A compound selector: tag, ids, classes, attributes and pseudo classes of one element"""
+
+    def __init__(self):
+        self.tag = None
+        self.ids = []
+        self.classes = []
+        self.attributes = []
+        self.pseudos = []
+
+    def matches(self, node):
+        if self.tag and self.tag != "*" and node.tag != self.tag:
+            return False
+        if any(node.attrs.get("id") != node_id for node_id in self.ids):
+            return False
+        node_classes = node.classes
+        if any(name not in node_classes for name in self.classes):
+            return False
+        for name, op, expected in self.attributes:
+            if name not in node.attrs:
+                return False
+            actual = node.attrs[name]
+            if op == "=" and actual != expected or \
+                    op == "~=" and expected not in actual.split() or \
+                    op == "^=" and not actual.startswith(expected) or \
+                    op == "$=" and not actual.endswith(expected) or \
+                    op == "*=" and expected not in actual or \
+                    op == "|=" and not (actual == expected or actual.startswith(expected + "-")):
+                return False
+        for pseudo, argument in self.pseudos:
+            if not _match_pseudo(node, pseudo, argument):
+                return False
+        return True
+
+
+def _nth_matches(position, formula):
+    formula = formula.replace(" ", "").lower()
+    if formula == "odd":
+        formula = "2n+1"
+    elif formula == "even":
+        formula = "2n"
+    if "n" not in formula:
+        return position == int(formula)
+    step, offset = formula.split("n")
+    step = -1 if step == "-" else int(step or 1) if step != "+" else 1
+    offset = int(offset or 0)
+    if step == 0:
+        return position == offset
+    return (position - offset) % step == 0 and (position - offset) // step >= 0
+
+
+def _match_pseudo(node, pseudo, argument):
+    if node.parent is None:
+        return False
+    siblings = node.parent.element_children()
+    if pseudo == "nth-child":
+        return _nth_matches(siblings.index(node) + 1, argument)
+    if pseudo == "nth-last-child":
+        return _nth_matches(len(siblings) - siblings.index(node), argument)
+    if pseudo == "first-child":
+        return siblings[0] is node
+    if pseudo == "last-child":
+        return siblings[-1] is node
+    if pseudo == "not":
+        return not any(_matches_complex(node, complex_selector) for complex_selector in parse_selector(argument))
+    raise InvalidSelectorException("Pseudo class not supported by the fake driver: " + pseudo)
+
+
+_SELECTOR_CACHE = {}
+
+
+def parse_selector(selector):
+    """
+    Parses a selector group. Returns a list of complex selectors. A complex selector is a list of
+    (combinator, Compound) pairs, the combinator of the first compound is None
+    """
+    if selector in _SELECTOR_CACHE:
+        return _SELECTOR_CACHE[selector]
+    group = []
+    for part in selector.split(","):
+        part = part.strip()
+        complex_selector = []
+        compound = Compound()
+        combinator = None
+        position = 0
+        while position < len(part):
+            match = _TOKEN.match(part, position)
+            if match is None or match.end() == position:
+                raise InvalidSelectorException("Invalid selector: " + selector)
+            position = match.end()
+            if match.group("space") is not None:
+                complex_selector.append((combinator, compound))
+                compound = Compound()
+                combinator = match.group("combinator") or " "
+            elif match.group("tag"):
+                compound.tag = match.group("tag").lower()
+            elif match.group("id"):
+                compound.ids.append(match.group("id"))
+            elif match.group("class"):
+                compound.classes.append(match.group("class"))
+            elif match.group("attr"):
+                expected = next((value for value in (match.group("dq"), match.group("sq"), match.group("bare"))
+                                 if value is not None), None)
+                compound.attributes.append((match.group("attr"), match.group("op"), expected))
+            else:
+                compound.pseudos.append((match.group("pseudo"), match.group("arg")))
+        complex_selector.append((combinator, compound))
+        group.append(complex_selector)
+    _SELECTOR_CACHE[selector] = group
+    return group
+
+
+def _matches_complex(node, complex_selector, index=None):
+    if index is None:
+        index = len(complex_selector) - 1
+    combinator, compound = complex_selector[index]
+    if not compound.matches(node):
+        return False
+    if index == 0:
+        return True
+    if combinator == ">":
+        return node.parent is not None and node.parent.tag != "#document" and \
+            _matches_complex(node.parent, complex_selector, index - 1)
+    if combinator in ("+", "~"):
+        if node.parent is None:
+            return False
+        siblings = node.parent.element_children()
+        previous = siblings[:siblings.index(node)]
+        if combinator == "+":
+            previous = previous[-1:]
+        return any(_matches_complex(sibling, complex_selector, index - 1) for sibling in previous)
+    ancestor = node.parent
+    while ancestor is not None and ancestor.tag != "#document":
+        if _matches_complex(ancestor, complex_selector, index - 1):
+            return True
+        ancestor = ancestor.parent
+    return False
+
+
+def select(scope, selector):
+    """Returns the descendants of scope that match a css selector, in document order"""
+    group = parse_selector(selector)
+    return [node for node in scope.iter_descendants()
+            if any(_matches_complex(node, complex_selector) for complex_selector in group)]
+
+
+def find_nodes(scope, by, value):
+    """Returns the descendants of scope found with a selenium By strategy"""
+    if by == By.CSS_SELECTOR:
+        return select(scope, value)
+    if by == By.ID:
+        return [node for node in scope.iter_descendants() if node.attrs.get("id") == value]
+    if by == By.NAME:
+        return [node for node in scope.iter_descendants() if node.attrs.get("name") == value]
+    if by == By.CLASS_NAME:
+        return [node for node in scope.iter_descendants() if value in node.classes]
+    if by == By.TAG_NAME:
+        return [node for node in scope.iter_descendants() if node.tag == value.lower()]
+    if by in (By.LINK_TEXT, By.PARTIAL_LINK_TEXT):
+        links = [node for node in scope.iter_descendants() if node.tag == "a"]
+        if by == By.LINK_TEXT:
+            return [node for node in links if node.text() == value]
+        return [node for node in links if value in node.text()]
+    raise InvalidSelectorException("Locator strategy not supported by the fake driver: " + str(by))
+
+
+# WebDriver
+
+class FakeWebElement(object):
+    """The WebElement returned by FakeWebDriver"""
+
+    def __init__(self, driver, node):
+        self._driver = driver
+        self._node = node
+        self.id = str(id(node))
+
+    @property
+    def node(self):
+        if self._node.root() is not self._driver._window().document:
+            raise StaleElementReferenceException("Element is not attached to the page document")
+        return self._node
+
+    @property
+    def tag_name(self):
+        return self.node.tag
+
+    @property
+    def text(self):
+        self._driver._count("getElementText")
+        node = self.node
+        return "" if node.is_hidden() else node.text()
+
+    def get_attribute(self, name):
+        self._driver._count("getElementAttribute")
+        node = self.node
+        if name == "value":
+            return node.value
+        if name in ("textContent", "innerText"):
+            return node.text()
+        return node.attrs.get(name)
+
+    def is_displayed(self):
+        self._driver._count("isElementDisplayed")
+        return not self.node.is_hidden()
+
+    def is_enabled(self):
+        self._driver._count("isElementEnabled")
+        return "disabled" not in self.node.attrs
+
+    def is_selected(self):
+        return "checked" in self.node.attrs or "selected" in self.node.attrs
+
+    def click(self):
+        self._driver._count("clickElement")
+        node = self.node
+        handler = getattr(self._driver.site, "on_click", None)
+        if handler is not None and handler(self._driver, self):
+            return
+        if node.tag == "a" and node.attrs.get("href"):
+            self._driver.get(node.attrs["href"])
+
+    def send_keys(self, *values):
+        self._driver._count("sendKeysToElement")
+        text = "".join(values)
+        node = self.node
+        handler = getattr(self._driver.site, "on_send_keys", None)
+        if handler is not None and handler(self._driver, self, text):
+            return
+        node.value += "".join(character for character in text if not "\ue000" <= character <= "\uf8ff")
+
+    def clear(self):
+        self.node.value = ""
+
+    def find_element(self, by=By.ID, value=None):
+        return self._driver._find(self.node, by, value, single=True)
+
+    def find_elements(self, by=By.ID, value=None):
+        return self._driver._find(self.node, by, value, single=False)
+
+    def __eq__(self, other):
+        return isinstance(other, FakeWebElement) and other._node is self._node
+
+    def __hash__(self):
+        return hash(self._node)
+
+
+class _Window(object):
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.url = "about:blank"
+        self.document = parse_html("<html><head></head><body></body></html>")
+
+
+class _SwitchTo(object):
+
+    def __init__(self, driver):
+        self._driver = driver
+
+    def window(self, handle):
+        self._driver._count("switchToWindow")
+        if handle not in self._driver._windows:
+            raise NoSuchWindowException("No window with handle " + str(handle))
+        self._driver._current = handle
+
+    def default_content(self):
+        pass
+
+
+class FakeWebDriver(object):
+    """
+    WebDriver implementation that serves the pages of a site object from memory
+
+    Parameters
+    ----------
+    site : object
+        Has a page(url) method that returns the html of an url. It can define on_click and on_send_keys
+    command_latency : float
+        Seconds added to every command, to simulate the browser round-trip
+    """
+
+    _handle_ids = count(1)
+
+    def __init__(self, site, command_latency=0.0):
+        self.site = site
+        self.command_latency = command_latency
+        self.commands = Counter()
+        self._windows = {}
+        self._current = None
+        self._new_window()
+        self.switch_to = _SwitchTo(self)
+        self.implicit_wait = 0
+        self.script_handlers = [
+            (re.compile(r"""window\.open\(\s*["'](.*?)["']\s*,\s*["']_blank["']\s*\)"""), self._script_open),
+            (re.compile(r"/\* ready_state \*/"), self._script_ready_state),
+            (re.compile(r"return\s+document\.readyState"), lambda match, args: "complete"),
+            (re.compile(r"/\* probe_many \*/"), self._script_probe_many),
+            (re.compile(r"/\* find_many \*/"), self._script_find_many),
+            (re.compile(r"/\* read_columns \*/"), self._script_read_columns),
+        ]
+
+    def _count(self, command):
+        self.commands[command] += 1
+        if self.command_latency:
+            time.sleep(self.command_latency)
+
+    def _new_window(self):
+        handle = "CDwindow-{}".format(next(self._handle_ids))
+        self._windows[handle] = _Window(handle)
+        if self._current is None:
+            self._current = handle
+        return handle
+
+    def _window(self):
+        if self._current not in self._windows:
+            raise NoSuchWindowException("The current window was closed")
+        return self._windows[self._current]
+
+    def _load(self, window, url):
+        page = self.site.page(url)
+        if page is None:
+            page = "<html><head><title>404</title></head><body><h1>Not Found</h1></body></html>"
+        window.url = url
+        window.document = parse_html(page)
+
+    def _find(self, scope, by, value, single):
+        self._count("findElement" if single else "findElements")
+        nodes = find_nodes(scope, by, value)
+        if single:
+            if not nodes:
+                raise NoSuchElementException("Unable to locate element: {} {}".format(by, value))
+            return FakeWebElement(self, nodes[0])
+        return [FakeWebElement(self, node) for node in nodes]
+
+    def _script_open(self, match, args):
+        handle = self._new_window()
+        self._load(self._windows[handle], match.group(1))
+
+    def _script_ready_state(self, match, args):
+        selector = args[0] if args else None
+        present = not selector or bool(find_nodes(self._window().document, By.CSS_SELECTOR, selector))
+        return {"readyState": "complete", "pending": 0, "selector": present}
+
+    def _script_find_many(self, match, args):
+        document = self._window().document
+        return [[FakeWebElement(self, node) for node in find_nodes(document, by, value)] for by, value in args[0]]
+
+    def _script_read_columns(self, match, args):
+        columns = []
+        for by, value, attribute in args[0]:
+            nodes = find_nodes(self._window().document, by, value)
+            columns.append({"texts": ["" if node.is_hidden() else node.text() for node in nodes],
+                            "attributes": [node.attrs.get(attribute) for node in nodes] if attribute else None})
+        return columns
+
+    def _script_probe_many(self, match, args):
+        results = []
+        for by, value in args[0]:
+            nodes = find_nodes(self._window().document, by, value)
+            first = nodes[0] if nodes else None
+            results.append({"count": len(nodes), "visible": first is not None and not first.is_hidden(),
+                            "text": first.text().strip() if first is not None else None})
+        return results
+
+    def get(self, url):
+        self._count("get")
+        self._load(self._window(), url)
+
+    def refresh(self):
+        self._count("refresh")
+        window = self._window()
+        self._load(window, window.url)
+
+    def document(self):
+        """Returns the document node of the current window"""
+        return self._window().document
+
+    @property
+    def title(self):
+        self._count("getTitle")
+        titles = find_nodes(self._window().document, By.TAG_NAME, "title")
+        return titles[0].text() if titles else ""
+
+    @property
+    def current_url(self):
+        self._count("getCurrentUrl")
+        return self._window().url
+
+    @property
+    def page_source(self):
+        raise NotImplementedError("page_source is not available in the fake driver")
+
+    @property
+    def current_window_handle(self):
+        self._count("getCurrentWindowHandle")
+        return self._window().handle
+
+    @property
+    def window_handles(self):
+        self._count("getWindowHandles")
+        return list(self._windows)
+
+    def find_element(self, by=By.ID, value=None):
+        return self._find(self._window().document, by, value, single=True)
+
+    def find_elements(self, by=By.ID, value=None):
+        return self._find(self._window().document, by, value, single=False)
+
+    def execute_script(self, script, *args):
+        self._count("executeScript")
+        for pattern, handler in self.script_handlers:
+            match = pattern.search(script)
+            if match:
+                return handler(match, args)
+        raise NotImplementedError("Script not supported by the fake driver: " + script[:80])
+
+    def save_screenshot(self, filename):
+        self._count("screenshot")
+        with open(filename, "wb") as screenshot_file:
+            screenshot_file.write(PNG_PIXEL)
+        return True
+
+    get_screenshot_as_file = save_screenshot
+
+    def close(self):
+        self._count("closeWindow")
+        self._windows.pop(self._current, None)
+
+    def quit(self):
+        self._count("quit")
+        self._windows.clear()
+
+    def implicitly_wait(self, seconds):
+        self.implicit_wait = seconds
+
+    def set_page_load_timeout(self, seconds):
+        pass
+
+    def maximize_window(self):
+        pass
+
+    def get_window_size(self, windowHandle="current"):
+        return {"width": 1920, "height": 1080}
@@ -0,0 +1,74 @@
+"""
+Compares the old eval based CreateReport.filter_report with the compiled filters from report_filter.py on a
+generated report.
+
+Usage:
+    python -m app.benchmarks.filter_benchmark [rows]
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from app.utilities.report_filter import ReportFilter, compile_filter
+
+STATUSES = ["Label was added", "Couldn't set the label", "Labels were set before"]
+LABELS = ["Invoice", "Damage", "Fines", "Contract", "Fuel card", "Tyres", "Maintenance", "Insurance", ""]
+
+CONDITIONS = [
+    '["status"] == "Label was added"',
+    '["status"] == "Couldn\'t set the label"',
+    '["status"] == "Labels were set before"',
+    '["label"] == "Invoice"',
+    '["label"] == "Damage"',
+    '["forward"] == "Not forwarded"',
+    '["status"].isin(["Label was added", "Labels were set before"])',
+]
+
+
+def generate_report(rows, seed=0):
+    generator = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "subject": ["Subject {}".format(number) for number in range(rows)],
+        "status": generator.choice(STATUSES, rows),
+        "label": generator.choice(LABELS, rows),
+        "forward": generator.choice(["Not forwarded", "fleet@leaseplan.com", "Failed to forward"], rows),
+        "email_closed": generator.choice(["Yes", "No", ""], rows),
+    })
+
+
+def legacy_filter(df_today, filter_condition):
+    """The filter_report implementation before report_filter.py"""
+    return eval("df_today.loc[df_today" + filter_condition + "]")
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, (time.perf_counter() - start) * 1000
+
+
+def run(rows=100000):
+    df = generate_report(rows)
+    legacy, legacy_ms = timed(lambda: [legacy_filter(df, condition) for condition in CONDITIONS])
+
+    compile_filter.cache_clear()
+    compiled, compiled_ms = timed(lambda: [ReportFilter(df).filter(condition) for condition in CONDITIONS])
+    many, many_ms = timed(lambda: ReportFilter(df).filter_many(CONDITIONS))
+    report_filter = ReportFilter(df)
+    report_filter.filter_many(CONDITIONS)
+    _, cached_ms = timed(lambda: report_filter.filter_many(CONDITIONS))
+
+    for old, new, batched in zip(legacy, compiled, many):
+        assert old.index.equals(new.index) and old.index.equals(batched.index)
+
+    print("{} rows, {} filters".format(rows, len(CONDITIONS)))
+    print("eval (old filter_report)      {:8.1f} ms".format(legacy_ms))
+    print("compiled, one filter at once  {:8.1f} ms".format(compiled_ms))
+    print("compiled, filter_many         {:8.1f} ms".format(many_ms))
+    print("filter_many, cached masks     {:8.1f} ms".format(cached_ms))
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
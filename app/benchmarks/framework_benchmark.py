@@ -0,0 +1,113 @@
+"""
+Measures the python overhead of SeleniumDriver and WebInterations with the in-memory FakeWebDriver, so the numbers
+don't include browser time. The fixed sleeps from main_page are disabled.
+
+Usage:
+    python -m app.benchmarks.framework_benchmark [--inbox-size 50] [--repeat 200] [--profile]
+"""
+import argparse
+import cProfile
+import pstats
+import time
+import timeit
+from types import SimpleNamespace
+
+import app.pages.main_page as main_page
+from app.base.selenium_driver import SeleniumDriver
+from app.benchmarks.fake_icontroller import FakeIControllerSite, FakeInbox
+from app.benchmarks.fake_webdriver import FakeWebDriver
+from app.benchmarks.inbox_benchmark import StaticRules
+from app.utilities.custom_logger import screen_shot
+
+SUBJECT_LOCATOR = "#messages-list > tbody > tr > td.column-subject > a"
+MISSING_LOCATOR = "#s2id_autogen1 > ul > li.select2-search-choice > div"
+PROBE_LOCATORS = [SUBJECT_LOCATOR, MISSING_LOCATOR, "#messages-list > tbody > tr > td.column-from > span"]
+
+
+def micro_benchmarks(repeat):
+    """
+    Times the SeleniumDriver methods on the messages list. Returns {name: microseconds per call}
+    """
+    site = FakeIControllerSite(FakeInbox(size=50))
+    driver = FakeWebDriver(site)
+    driver.get(site.base_url)
+    selenium_driver = SeleniumDriver(driver)
+
+    def uncached(check):
+        def call():
+            selenium_driver.invalidate_lookup_cache()
+            check()
+        return call
+
+    calls = {
+        "get_by_type": lambda: selenium_driver.get_by_type("css"),
+        "get_element": lambda: selenium_driver.get_element(SUBJECT_LOCATOR, "css"),
+        "is_element_present (cached)": lambda: selenium_driver.is_element_present(SUBJECT_LOCATOR, "css"),
+        "is_element_present": uncached(lambda: selenium_driver.is_element_present(SUBJECT_LOCATOR, "css")),
+        "probe_element": uncached(lambda: selenium_driver.probe_element(SUBJECT_LOCATOR, "css")),
+        "probe_element (missing)": uncached(
+            lambda: selenium_driver.probe_element(MISSING_LOCATOR, "css", expect_absent=True)),
+        "probe_element x3": uncached(lambda: [selenium_driver.probe_element(locator, "css")
+                                              for locator in PROBE_LOCATORS]),
+        "probe_many (3 locators)": uncached(lambda: selenium_driver.probe_many(PROBE_LOCATORS)),
+        "wait_for_element": lambda: selenium_driver.wait_for_element(locator=SUBJECT_LOCATOR, locator_type="css"),
+        "wait_for_element (all)": lambda: selenium_driver.wait_for_element(
+            locator=SUBJECT_LOCATOR, locator_type="css", condition_text="presence_of_all_elements_located"),
+        "get_text": lambda: selenium_driver.get_text(locator=SUBJECT_LOCATOR, locator_type="css"),
+        "screen_shot": lambda: screen_shot(driver, selenium_driver.log),
+    }
+    results = {}
+    for name, call in calls.items():
+        number = repeat if name != "screen_shot" else max(1, repeat // 10)
+        results[name] = min(timeit.repeat(call, number=number, repeat=3)) / number * 10 ** 6
+    return results
+
+
+def inbox_benchmark(inbox_size, profile=False):
+    """
+    Runs get_emails_details over a fake inbox. Returns the duration in seconds and the driver command counts
+    """
+    site = FakeIControllerSite(FakeInbox(size=inbox_size))
+    driver = FakeWebDriver(site)
+    driver.get(site.base_url)
+    interactions = main_page.WebInterations(driver,
+                                            label_rules_obj=StaticRules("label"),
+                                            clients_rules_obj=StaticRules("client"))
+    original_time = main_page.time
+    main_page.time = SimpleNamespace(sleep=lambda seconds: None, time=time.time)
+    profiler = cProfile.Profile() if profile else None
+    try:
+        start = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        interactions.get_emails_details()
+        if profiler:
+            profiler.disable()
+        elapsed = time.perf_counter() - start
+    finally:
+        main_page.time = original_time
+    if profiler:
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+    # StaticRules labels and closes every mail, anything else means the timed flow was broken
+    unprocessed = site.inbox.unprocessed()
+    if unprocessed:
+        raise RuntimeError("{} of {} mails were not labeled and closed exactly once: {}".format(
+            len(unprocessed), inbox_size, ", ".join(unprocessed)))
+    return elapsed, driver.commands
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--inbox-size", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--profile", action="store_true", help="print a cProfile of get_emails_details")
+    arguments = parser.parse_args()
+
+    for benchmark_name, microseconds in micro_benchmarks(arguments.repeat).items():
+        print("{:<30} {:10.1f} us".format(benchmark_name, microseconds))
+
+    seconds, commands = inbox_benchmark(arguments.inbox_size, arguments.profile)
+    print("get_emails_details: {} mails in {:.3f}s ({:.1f} ms/mail)".format(
+        arguments.inbox_size, seconds, seconds / arguments.inbox_size * 1000))
+    print("WebDriver commands: " + ", ".join("{}={}".format(name, number)
+                                             for name, number in commands.most_common()))
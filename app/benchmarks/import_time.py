@@ -0,0 +1,75 @@
+"""
+Measures the cold start import time of the automation entry point with "python -X importtime" and fails if it is
+slower than the limit or if a heavy module (pandas, matplotlib, psycopg2, win32com) is imported at start.
+
+Usage:
+    python -m app.benchmarks.import_time [--module app.pages.main_page] [--max-ms 1500] [--top 15]
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+HEAVY_MODULES = ["pandas", "matplotlib", "psycopg2", "win32com", "openpyxl", "numpy"]
+
+_IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$")
+
+
+def measure(module):
+    """
+    Imports module in a new interpreter
+
+    Returns
+    -------
+        (total cumulative microseconds, list of (self us, cumulative us, module name))
+    """
+    project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    environment = dict(os.environ, PYTHONPATH=project_root + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                               stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True,
+                               env=environment, cwd=project_root)
+    if completed.returncode != 0:
+        raise RuntimeError("Couldn't import {}:\n{}".format(module, completed.stderr[-2000:]))
+    imports = []
+    total = 0
+    for line in completed.stderr.splitlines():
+        match = _IMPORT_TIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = int(match.group(1)), int(match.group(2)), match.group(3), \
+            match.group(4)
+        imports.append((self_us, cumulative_us, name))
+        # Top level imports have a single space of indentation
+        if len(indent) == 1:
+            total += cumulative_us
+    return total, imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="app.pages.main_page")
+    parser.add_argument("--max-ms", type=float, default=1500)
+    parser.add_argument("--top", type=int, default=15)
+    arguments = parser.parse_args()
+
+    total, imports = measure(arguments.module)
+    print("Import of {}: {:.0f} ms".format(arguments.module, total / 1000))
+    print("Slowest modules (cumulative):")
+    for self_us, cumulative_us, name in sorted(imports, key=lambda item: -item[1])[:arguments.top]:
+        print("  {:<50} {:8.1f} ms (self {:.1f} ms)".format(name, cumulative_us / 1000, self_us / 1000))
+
+    imported = {name for _, _, name in imports}
+    heavy = [name for name in HEAVY_MODULES if name in imported]
+    failed = False
+    if heavy:
+        print("FAIL: heavy modules imported at start: " + ", ".join(heavy))
+        failed = True
+    if total / 1000 > arguments.max_ms:
+        print("FAIL: import time is over the limit of {:.0f} ms".format(arguments.max_ms))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,180 @@
+"""
+Offline end-to-end benchmark. Starts the fake iController server, opens it with WebDriverFactory in headless chrome
+and runs WebInterations.get_emails_details over the whole inbox. Reports mails/minute, the latency of every phase and
+the browser memory. Results can be saved as json to compare runs.
+
+Usage:
+    python -m app.benchmarks.inbox_benchmark --inbox-size 50 --latency 0.05 --output bench.json
+"""
+import argparse
+import json
+import re
+import statistics
+import time
+from collections import defaultdict
+
+from app.base.webdriverfactory import WebDriverFactory
+from app.benchmarks.fake_icontroller import FakeIControllerServer, FakeInbox
+from app.pages.main_page import WebInterations
+
+
+class StaticRules(object):
+    """
+    Rules object with the same interface as the label and client rules. The result is derived from the mail, so it
+    is deterministic for a given inbox
+
+    Parameters
+    ----------
+    kind : str
+        "label" or "client"
+    forward_every : int
+        Every n-th label result has a forward address. 0 disables forwarding
+    """
+
+    def __init__(self, kind, forward_every=5):
+        self.kind = kind
+        self.forward_every = forward_every
+        self.calls = 0
+
+    def get_labels_dict(self, email_details):
+        self.calls += 1
+        if self.kind == "client":
+            match = re.search(r"Client (\d+)", email_details["body"])
+            client = match.group(1) if match else None
+            return {"check_text": "Client " + str(client), "labels": client, "forward": None, "close": None}
+        label = email_details["subject"].split(" ")[0]
+        forward = None
+        if self.forward_every and self.calls % self.forward_every == 0:
+            forward = "fleet@leaseplan.com"
+        return {"check_text": label + " in subject", "labels": label, "forward": forward, "close": "yes"}
+
+
+class TimedWebInterations(WebInterations):
+    """
+    WebInterations that records the duration of every phase
+    """
+
+    timed_phases = ["read_mail_details", "open_body", "get_current_email", "set_label"]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timings = defaultdict(list)
+        for phase in self.timed_phases:
+            setattr(self, phase, self._timed(phase, getattr(self, phase)))
+
+    def _timed(self, phase, method):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.timings[phase].append(time.perf_counter() - start)
+        return timed
+
+
+def browser_memory_mb(driver):
+    """
+    Returns the resident memory of chromedriver and all the chrome processes in MB. If psutil is not installed,
+    the JS heap of the current page is returned instead
+    """
+    try:
+        import psutil
+    except ImportError:
+        heap = driver.execute_script("return window.performance.memory ? "
+                                     "window.performance.memory.usedJSHeapSize : 0;")
+        return {"js_heap_mb": heap / 1024 ** 2}
+    process = psutil.Process(driver.service.process.pid)
+    processes = [process] + process.children(recursive=True)
+    rss = 0
+    for child in processes:
+        try:
+            rss += child.memory_info().rss
+        except psutil.Error:
+            pass
+    return {"browser_rss_mb": rss / 1024 ** 2}
+
+
+def summarize(durations):
+    ordered = sorted(durations)
+    return {"count": len(ordered),
+            "mean_ms": statistics.mean(ordered) * 1000,
+            "p50_ms": ordered[len(ordered) // 2] * 1000,
+            "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+            "max_ms": ordered[-1] * 1000}
+
+
+def run(inbox_size=50, latency=0.0, seed=0, driver_path="chromedriver", forward_every=5):
+    """
+    Runs the benchmark and returns the results dictionary
+    """
+    inbox = FakeInbox(size=inbox_size, seed=seed)
+    server = FakeIControllerServer(inbox, latency=latency).start()
+    driver = None
+    try:
+        start_browser = time.perf_counter()
+        driver = WebDriverFactory("chrome", server.base_url, headless=True,
+                                  driver_path=driver_path).getWebDriverInstance()
+        browser_start_s = time.perf_counter() - start_browser
+
+        interactions = TimedWebInterations(driver,
+                                           label_rules_obj=StaticRules("label", forward_every),
+                                           clients_rules_obj=StaticRules("client"))
+        start = time.perf_counter()
+        details = interactions.get_emails_details()
+        elapsed = time.perf_counter() - start
+
+        # Every mail is labeled and closed by StaticRules. A mail missed or done twice means the run didn't measure
+        # the real flow (e.g. a mail read from a window left open by the previous one)
+        unprocessed = inbox.unprocessed()
+        if unprocessed:
+            raise RuntimeError("{} of {} mails were not labeled and closed exactly once: {}".format(
+                len(unprocessed), inbox_size, ", ".join(unprocessed)))
+
+        processed = len([status for status in details["status"] if status != "Labels were set before"])
+        results = {
+            "inbox_size": inbox_size,
+            "latency_s": latency,
+            "browser_start_s": browser_start_s,
+            "run_s": elapsed,
+            "mails_processed": processed,
+            "mails_labeled": len([label for label in details["label"] if label]),
+            "mails_per_minute": processed / elapsed * 60 if elapsed else 0.0,
+            "phases": {phase: summarize(durations) for phase, durations in interactions.timings.items()},
+            "lookup_cache": interactions.get_cache_stats(),
+        }
+        results.update(browser_memory_mb(driver))
+        return results
+    finally:
+        if driver is not None:
+            driver.quit()
+        server.stop()
+
+
+def print_results(results):
+    print("Mails processed: {mails_processed} ({mails_labeled} labeled) in {run_s:.1f}s -> "
+          "{mails_per_minute:.1f} mails/minute".format(**results))
+    print("Browser start: {:.1f}s".format(results["browser_start_s"]))
+    for phase, stats in results["phases"].items():
+        print("{:<20} n={count:<5} mean={mean_ms:8.1f}ms p50={p50_ms:8.1f}ms p95={p95_ms:8.1f}ms "
+              "max={max_ms:8.1f}ms".format(phase, **stats))
+    for key in ("browser_rss_mb", "js_heap_mb"):
+        if key in results:
+            print("{}: {:.1f}".format(key, results[key]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--inbox-size", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--driver-path", default="chromedriver")
+    parser.add_argument("--forward-every", type=int, default=5, help="forward every n-th mail, 0 disables")
+    parser.add_argument("--output", help="save the results as json")
+    arguments = parser.parse_args()
+
+    benchmark_results = run(arguments.inbox_size, arguments.latency, arguments.seed, arguments.driver_path,
+                            arguments.forward_every)
+    print_results(benchmark_results)
+    if arguments.output:
+        with open(arguments.output, "w") as output_file:
+            json.dump(benchmark_results, output_file, indent=2)
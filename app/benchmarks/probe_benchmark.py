@@ -0,0 +1,71 @@
+"""
+Compares is_element_present with probe_element for present and missing elements on a local page.
+
+Usage:
+    python -m app.benchmarks.probe_benchmark [iterations]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from selenium import webdriver
+
+from app.base.selenium_driver import SeleniumDriver
+
+PAGE = """<html><body>
+<div class="labels" id="s2id_autogen3"><ul><li class="select2-search-choice"><div>Label</div></li></ul></div>
+</body></html>"""
+
+PRESENT_LOCATOR = "div.labels li.select2-search-choice"
+MISSING_LOCATOR = "#s2id_autogen1 > ul > li.select2-search-choice > div"
+
+
+def time_calls(function, iterations):
+    """
+    Runs function iterations times and returns the average duration in milliseconds
+    """
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+def run(iterations=20):
+    options = webdriver.ChromeOptions()
+    options.add_argument("headless")
+    driver = webdriver.Chrome(options=options)
+
+    page_file = tempfile.NamedTemporaryFile("w", suffix=".html", delete=False)
+    page_file.write(PAGE)
+    page_file.close()
+    try:
+        driver.get("file://" + page_file.name)
+        selenium_driver = SeleniumDriver(driver)
+
+        # The cache is cleared before each call so the raw cost of the lookup is measured
+        def uncached(check):
+            def call():
+                selenium_driver.invalidate_lookup_cache()
+                check()
+            return call
+
+        results = {
+            "is_element_present (present)": uncached(
+                lambda: selenium_driver.is_element_present(PRESENT_LOCATOR, "css", False)),
+            "is_element_present (missing)": uncached(
+                lambda: selenium_driver.is_element_present(MISSING_LOCATOR, "css", False)),
+            "probe_element (present)": uncached(
+                lambda: selenium_driver.probe_element(PRESENT_LOCATOR, "css")),
+            "probe_element (missing)": uncached(
+                lambda: selenium_driver.probe_element(MISSING_LOCATOR, "css", expect_absent=True)),
+        }
+        for name, call in results.items():
+            print("{:<32} {:8.2f} ms".format(name, time_calls(call, iterations)))
+    finally:
+        driver.quit()
+        os.remove(page_file.name)
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,127 @@
+"""
+Several queue workers (work_queue.py) labeling one fake inbox. The coordinator step reads the messages list and
+queues the mails, then every worker process claims mails from the same queue file and labels them with open_body
+on its own FakeWebDriver. Each worker has its own copy of the inbox (same seed), so the actions it records (label,
+client, close) show which mails it changed: the benchmark checks that every queued mail was changed by exactly one
+worker.
+
+The fixed sleeps from main_page are disabled and --latency is added to every WebDriver command, so the run shows
+how the throughput scales with the number of workers when the browser round-trips dominate.
+
+Usage:
+    python -m app.benchmarks.queue_benchmark --workers 6 --inbox-size 120 --latency 0.01
+"""
+import argparse
+import os
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+import app.pages.main_page as main_page
+from app.benchmarks.fake_icontroller import FakeIControllerSite, FakeInbox
+from app.benchmarks.fake_webdriver import FakeWebDriver
+from app.benchmarks.inbox_benchmark import StaticRules
+from app.main_app.work_queue import QueueWorker, WorkQueue
+
+
+def fake_driver(inbox_size, seed, latency):
+    """Returns a FakeWebDriver on the messages list of a new fake inbox"""
+    site = FakeIControllerSite(FakeInbox(size=inbox_size, seed=seed))
+    driver = FakeWebDriver(site, command_latency=latency)
+    driver.get(site.base_url)
+    return site, driver
+
+
+def enqueue(queue_path, inbox_size, seed):
+    """The coordinator step: queues the unlabeled mails of the inbox. Returns the number of queued mails"""
+    _, driver = fake_driver(inbox_size, seed, 0.0)
+    queue = WorkQueue(queue_path)
+    try:
+        return queue.enqueue(main_page.WebInterations(driver, None, None).read_mail_details())
+    finally:
+        queue.close()
+
+
+def run_worker(queue_path, worker_id, inbox_size, seed, latency):
+    """
+    Runs one worker until the queue is empty. Module level function, it runs in the process pool
+
+    Returns
+    -------
+        (worker id, processed mails, ids of the mails changed in its inbox, seconds)
+    """
+    main_page.time = SimpleNamespace(sleep=lambda seconds: None, time=time.time)
+    site, driver = fake_driver(inbox_size, seed, latency)
+    interactions = main_page.WebInterations(driver, label_rules_obj=StaticRules("label", forward_every=0),
+                                            clients_rules_obj=StaticRules("client"))
+    queue = WorkQueue(queue_path)
+    worker = QueueWorker(queue, interactions, worker_id, idle_seconds=0)
+    start = time.perf_counter()
+    try:
+        while worker.run_once():
+            pass
+    finally:
+        queue.close()
+    changed = [message_id for message_id, message in site.inbox.messages.items()
+               if message["labels"] or message["clients"] or message["closed"]]
+    return worker_id, worker.processed, changed, time.perf_counter() - start
+
+
+def run(workers=6, inbox_size=120, latency=0.01, seed=0):
+    """Runs the benchmark and returns the results dictionary"""
+    with tempfile.TemporaryDirectory(prefix="queue_benchmark_") as folder:
+        queue_path = os.path.join(folder, "queue.sqlite")
+        queued = enqueue(queue_path, inbox_size, seed)
+
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_worker, queue_path, "worker-{}".format(number), inbox_size, seed,
+                                       latency) for number in range(1, workers + 1)]
+            worker_results = [future.result() for future in futures]
+        elapsed = time.perf_counter() - start
+
+        queue = WorkQueue(queue_path)
+        try:
+            counts = queue.counts()
+        finally:
+            queue.close()
+    changed_by = Counter(message_id for _, _, changed, _ in worker_results for message_id in changed)
+    processed = sum(worker_processed for _, worker_processed, _, _ in worker_results)
+    changed_once = sum(1 for number in changed_by.values() if number == 1)
+    changed_by_several = sorted(message_id for message_id, number in changed_by.items() if number > 1)
+    # A mail left unchanged passes the duplicates check, so the run only counts if every queued mail was changed once
+    if changed_once != queued or changed_by_several:
+        raise RuntimeError("{} of {} queued mails were changed by one worker, by several: {}".format(
+            changed_once, queued, changed_by_several or "none"))
+    return {
+        "workers": workers,
+        "queued": queued,
+        "processed": processed,
+        "seconds": elapsed,
+        "mails_per_minute": processed / elapsed * 60 if elapsed else 0.0,
+        "changed_once": changed_once,
+        "changed_by_several": changed_by_several,
+        "queue_states": counts,
+        "per_worker": {worker_id: {"processed": worker_processed, "seconds": seconds}
+                       for worker_id, worker_processed, _, seconds in worker_results},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=6)
+    parser.add_argument("--inbox-size", type=int, default=120)
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds added to every WebDriver command")
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args()
+
+    results = run(arguments.workers, arguments.inbox_size, arguments.latency, arguments.seed)
+    print("{workers} workers: {processed} of {queued} queued mails in {seconds:.1f}s -> "
+          "{mails_per_minute:.0f} mails/minute".format(**results))
+    print("Mails changed by one worker: {}, by several: {}".format(results["changed_once"],
+                                                                   results["changed_by_several"] or "none"))
+    print("Queue states: {}".format(results["queue_states"]))
+    for worker_id, stats in sorted(results["per_worker"].items()):
+        print("  {:<10} {processed:>5} mails in {seconds:.1f}s".format(worker_id, **stats))
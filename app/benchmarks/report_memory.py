@@ -0,0 +1,84 @@
+"""
+Memory and speed of a loaded report with the old representation (every column object) and with the compact schema
+from report_schema.py.
+
+Usage:
+    python -m app.benchmarks.report_memory [rows] [report.xlsx]
+
+Without a report file, a report is generated. With a report file, it is read once and converted in memory.
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from app.utilities.report_schema import apply_schema, memory_mb, sort_report
+
+STATUSES = ["Label was added", "Couldn't set the label", "Labels were set before"]
+LABELS = ["Invoice", "Damage", "Fines", "Contract", "Fuel card", "Tyres", "Maintenance", "Insurance", ""]
+CLIENTS = ["Client {}".format(number) for number in range(40)] + [""]
+
+
+def generate_report(rows, body_chars=1500, seed=0):
+    generator = np.random.default_rng(seed)
+    start = pd.Timestamp("2020-10-01 08:00")
+    minutes = np.sort(generator.integers(0, 60 * 24 * 30, rows))
+    dates = (start + pd.to_timedelta(minutes, unit="m")).strftime("%Y-%m-%d %H:%M")
+    body = "Dear colleagues, please find attached the invoice for the vehicle. " * (body_chars // 68 + 1)
+    return pd.DataFrame({
+        "subject": ["Subject {}".format(number) for number in range(rows)],
+        "sender": ["sender{}@example.com".format(number) for number in generator.integers(0, 500, rows)],
+        "date": list(dates),
+        "label": generator.choice(LABELS, rows),
+        "status": generator.choice(STATUSES, rows),
+        "email_body": [body[:body_chars] + str(number) for number in range(rows)],
+        "check": generator.choice(["invoice", "damage", "fine", ""], rows),
+        "url": ["https://icontroller.example/mail/messages#mail={}".format(number) for number in range(rows)],
+        "client": generator.choice(CLIENTS, rows),
+        "clients_check_text": generator.choice(["contract number", "plate", ""], rows),
+        "forward": generator.choice(["Not forwarded", "fleet@leaseplan.com", "Failed to forward"], rows),
+        "email_closed": generator.choice(["Yes", "No", ""], rows),
+    }).sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def timed(function, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def old_sort(df):
+    """CreateReport.__init__ before report_schema.py"""
+    return df.sort_values("date", ascending=False).reset_index(drop=True)
+
+
+def value_counts(df):
+    return [df[column].value_counts() for column in ("status", "label", "client", "forward")]
+
+
+def run(rows=50000, report_path=None):
+    if report_path:
+        old = pd.read_excel(report_path)
+    else:
+        old = generate_report(rows)
+    variants = [
+        ("object columns (old)", old, old_sort),
+        ("categoricals", apply_schema(old), sort_report),
+        ("categoricals, body 300", apply_schema(old, body_max_chars=300), sort_report),
+        ("categoricals, no body", apply_schema(old, drop_body=True), sort_report),
+    ]
+
+    print("{} rows".format(len(old)))
+    print("{:32} {:>10} {:>10} {:>14}".format("", "memory MB", "sort ms", "value_counts ms"))
+    for name, df, sort in variants:
+        print("{:32} {:10.1f} {:10.1f} {:14.1f}".format(name, memory_mb(df), timed(lambda: sort(df)),
+                                                        timed(lambda: value_counts(df))))
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 50000, sys.argv[2] if len(sys.argv) > 2 else None)
@@ -0,0 +1,328 @@
+"""
+Loads the daily reports (report_<country>_<date>.xlsx) into PostgreSQL. The reports are parsed in a process pool
+and written with multi row inserts (execute_values), one transaction per report. Every row has a key (the message
+id or a hash of sender, date and subject, see report_diff.py) with a unique index on it, so loading a report again
+only updates the status fields of its rows.
+
+The connection arguments are required (there is no default database) and the table and its unique index are
+created or altered only with --create-schema. The password can come from PGPASSWORD or ~/.pgpass.
+
+Usage:
+    python -m app.main_app.backfill --folder reports_PT --table lpsc_pt_iController --dry-run
+    python -m app.main_app.backfill --folder reports_PT --table lpsc_pt_iController --host localhost \
+        --database test --user postgres --password postgres --create-schema --since 2020-09-01
+"""
+import argparse
+import logging
+import os
+import re
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import app.utilities.custom_logger as cl
+from app.utilities.database import CursorFromConnectionFromPool, Database
+from app.utilities.lazy_import import lazy_import
+from app.utilities.report_diff import STATUS_FIELDS, row_key
+
+pd = lazy_import("pandas")
+extras = lazy_import("psycopg2.extras")
+sql = lazy_import("psycopg2.sql")
+
+log = cl.customLogger(logging.INFO)
+
+REPORT_FILE = re.compile(r"^report_(?:(?P<country>[A-Za-z]{2,3})_)?(?P<date>\d{4}-\d{2}-\d{2})\.xlsx$")
+
+# (report column, table column). The table columns are the ones used by CreateReport.excel_to_db
+COLUMNS = [("subject", "subject"), ("sender", "sender"), ("date", "date"), ("label", "label"),
+           ("status", "status"), ("email_body", "email_body"), ("check", "label_check"), ("url", "url"),
+           ("client", "client"), ("clients_check_text", "client_check"), ("forward", "forward"),
+           ("email_closed", "email_closed")]
+KEY_COLUMNS = ["row_key", "country", "report_date"]
+TABLE_COLUMNS = KEY_COLUMNS + [table_column for _, table_column in COLUMNS]
+UPDATED_COLUMNS = [table_column for report_column, table_column in COLUMNS if report_column in STATUS_FIELDS]
+
+ReportFile = namedtuple("ReportFile", ["path", "country", "date", "size"])
+ParsedReport = namedtuple("ParsedReport", ["report_file", "rows", "seconds", "error"])
+BackfillStats = namedtuple("BackfillStats", ["files", "failed_files", "rows", "inserted", "updated", "seconds"])
+
+
+def report_file_info(path, country=None, size=None):
+    """
+    Returns the ReportFile of a report path (report_<country>_<date>.xlsx) or None if the name is not a report name.
+    country is used when the name doesn't contain it
+    """
+    name = os.path.basename(path)
+    match = REPORT_FILE.match(name)
+    if not match or "backup" in name:
+        return None
+    report_country = (match.group("country") or country or "").upper() or None
+    return ReportFile(path, report_country, match.group("date"), size)
+
+
+def find_report_files(folder, country=None, since=None, until=None):
+    """
+    Finds the daily reports in a folder and its subfolders (os.scandir, the file sizes come with the directory
+    listing)
+
+    Parameters
+    ----------
+    folder : str
+        Reports folder
+    country : str
+        Country of the reports whose name doesn't contain it. Reports of other countries are skipped
+    since, until : str
+        Only the reports between these dates (YYYY-MM-DD, inclusive)
+
+    Returns
+    -------
+        ReportFile tuples sorted by date
+    """
+    found = []
+    folders = [folder]
+    while folders:
+        with os.scandir(folders.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                    continue
+                report_file = report_file_info(entry.path, country)
+                if report_file is None:
+                    continue
+                if country and report_file.country != country.upper():
+                    continue
+                if (since and report_file.date < since) or (until and report_file.date > until):
+                    continue
+                found.append(report_file._replace(size=entry.stat().st_size))
+    return sorted(found, key=lambda report_file: (report_file.date, report_file.path))
+
+
+def _text(value):
+    if value is None or value != value:  # None or NaN
+        return None
+    return str(value)
+
+
+def report_rows(df, country, report_date):
+    """
+    Returns the table rows (TABLE_COLUMNS tuples) of a report dataframe. The same mail twice in a report is one row,
+    the last one: it has the latest status
+    """
+    columns = {report_column: df[report_column].tolist() if report_column in df.columns else [None] * len(df)
+               for report_column, _ in COLUMNS}
+    rows = {}
+    for position in range(len(df)):
+        values = [_text(columns[report_column][position]) for report_column, _ in COLUMNS]
+        key = row_key(columns["subject"][position], columns["sender"][position], columns["date"][position],
+                      columns["url"][position])
+        rows[key] = tuple([key, country, report_date] + values)
+    return list(rows.values())
+
+
+def parse_report_file(report_file):
+    """
+    Reads a report and returns its table rows. Module level function, it runs in the process pool
+
+    Returns
+    -------
+        ParsedReport. Errors are returned, not raised, so one bad file doesn't stop the backfill
+    """
+    start = time.perf_counter()
+    try:
+        rows = report_rows(pd.read_excel(report_file.path), report_file.country, report_file.date)
+        return ParsedReport(report_file, rows, time.perf_counter() - start, None)
+    except Exception as e:
+        return ParsedReport(report_file, [], time.perf_counter() - start, repr(e))
+
+
+def ensure_table(cursor, table):
+    """
+    Creates the table if it doesn't exist. An existing table (created for excel_to_db) gets the key columns and the
+    unique index on row_key. The rows loaded before have no key and are not changed
+    """
+    identifier = sql.Identifier(table)
+    cursor.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} ({})").format(
+        identifier, sql.SQL(", ").join(sql.SQL("{} text").format(sql.Identifier(column))
+                                       for column in TABLE_COLUMNS)))
+    for column in KEY_COLUMNS:
+        cursor.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} text").format(
+            identifier, sql.Identifier(column)))
+    cursor.execute(sql.SQL("CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} (row_key)").format(
+        sql.Identifier(table + "_row_key"), identifier))
+
+
+def plain_rows(df, table_columns=None):
+    """
+    Returns the columns and the rows of a report for a table without the key columns (the tables written by
+    excel_to_db before the backfill)
+
+    Parameters
+    ----------
+    df : pandas dataframe
+        Report rows
+    table_columns : list
+        The table columns of the dataframe columns, in order. None maps the report columns with COLUMNS
+
+    Returns
+    -------
+        (table columns, rows)
+    """
+    if table_columns is None:
+        table_columns = [table_column for _, table_column in COLUMNS]
+        df = df.reindex(columns=[report_column for report_column, _ in COLUMNS])
+    elif len(table_columns) != df.shape[1]:
+        raise ValueError("Number of input columns is not equal to db table columns")
+    rows = [tuple(_text(value) for value in row) for row in df.itertuples(index=False, name=None)]
+    return table_columns, rows
+
+
+def has_row_key_index(cursor, table):
+    """Returns True if the table has a unique index on row_key (ensure_table), needed by write_rows"""
+    cursor.execute("SELECT 1 FROM pg_index i JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0] "
+                   "WHERE i.indrelid = to_regclass(%s) AND i.indisunique AND i.indnatts = 1 AND a.attname = 'row_key'",
+                   (sql.Identifier(table).as_string(cursor),))
+    return cursor.fetchone() is not None
+
+
+def insert_rows(cursor, table, columns, rows, page_size=1000):
+    """Inserts the rows without a conflict check (see plain_rows). Returns the number of inserted rows"""
+    if not rows:
+        return 0
+    statement = sql.SQL("INSERT INTO {} ({}) VALUES %s").format(
+        sql.Identifier(table), sql.SQL(", ").join(sql.Identifier(column) for column in columns))
+    extras.execute_values(cursor, statement.as_string(cursor), rows, page_size=page_size)
+    return len(rows)
+
+
+def write_rows(cursor, table, rows, page_size=1000):
+    """
+    Inserts the rows; the rows whose key is already in the table get the new status fields
+
+    Returns
+    -------
+        (inserted, updated)
+    """
+    if not rows:
+        return 0, 0
+    statement = sql.SQL("INSERT INTO {table} ({columns}) VALUES %s ON CONFLICT (row_key) DO UPDATE SET {updates} "
+                        "RETURNING (xmax = 0)").format(
+        table=sql.Identifier(table),
+        columns=sql.SQL(", ").join(sql.Identifier(column) for column in TABLE_COLUMNS),
+        updates=sql.SQL(", ").join(sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(column))
+                                   for column in UPDATED_COLUMNS))
+    results = extras.execute_values(cursor, statement.as_string(cursor), rows, page_size=page_size, fetch=True)
+    inserted = sum(1 for (is_insert,) in results if is_insert)
+    return inserted, len(results) - inserted
+
+
+class Backfill(object):
+    """
+    Parses reports in a process pool and loads them into a table. The database must be initialised
+    (Database.initialise) before run. The table must have the unique index on row_key (ensure_table)
+
+    Parameters
+    ----------
+    table : str
+        Table name
+    processes : int
+        Number of parsing processes. None uses the number of CPUs
+    page_size : int
+        Rows per INSERT statement
+    """
+
+    def __init__(self, table, processes=None, page_size=1000):
+        self.table = table
+        self.processes = processes
+        self.page_size = page_size
+
+    def run(self, report_files, dry_run=False, create_schema=False):
+        """
+        Loads the reports. The progress is printed after every report
+
+        Parameters
+        ----------
+        report_files : list
+            ReportFile tuples (see find_report_files)
+        dry_run : bool
+            Only parse the reports, nothing is written to the database
+        create_schema : bool
+            Create the table or add the key columns and the unique index (ensure_table) before loading
+
+        Returns
+        -------
+            BackfillStats
+        """
+        start = time.perf_counter()
+        files = failed = rows = inserted = updated = 0
+        if create_schema and not dry_run:
+            with CursorFromConnectionFromPool() as cursor:
+                ensure_table(cursor, self.table)
+
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            futures = [executor.submit(parse_report_file, report_file) for report_file in report_files]
+            for future in as_completed(futures):
+                parsed = future.result()
+                files += 1
+                name = os.path.basename(parsed.report_file.path)
+                if parsed.error is None and not dry_run:
+                    try:
+                        with CursorFromConnectionFromPool() as cursor:
+                            file_inserted, file_updated = write_rows(cursor, self.table, parsed.rows,
+                                                                     self.page_size)
+                        inserted += file_inserted
+                        updated += file_updated
+                    except Exception as e:
+                        parsed = parsed._replace(error=repr(e))
+                if parsed.error is not None:
+                    failed += 1
+                    log.error("Backfill of {} failed: {}".format(parsed.report_file.path, parsed.error))
+                    print("[{}/{}] {} failed: {}".format(files, len(report_files), name, parsed.error))
+                    continue
+                rows += len(parsed.rows)
+                elapsed = time.perf_counter() - start
+                print("[{}/{}] {}: {} rows (parsed in {:.1f} s) - {:.0f} rows/s".format(
+                    files, len(report_files), name, len(parsed.rows), parsed.seconds, rows / max(elapsed, 1e-9)))
+
+        stats = BackfillStats(files, failed, rows, inserted, updated, time.perf_counter() - start)
+        log.info("Backfill of {}: {}".format(self.table, stats))
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loads the daily reports into PostgreSQL")
+    parser.add_argument("--folder", required=True, help="reports folder (searched recursively)")
+    parser.add_argument("--table", required=True)
+    parser.add_argument("--country", help="country of the reports whose name doesn't contain it")
+    parser.add_argument("--since", help="first report date, YYYY-MM-DD")
+    parser.add_argument("--until", help="last report date, YYYY-MM-DD")
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--dry-run", action="store_true", help="only parse the reports")
+    parser.add_argument("--create-schema", action="store_true",
+                        help="create the table, its key columns and the unique index on row_key if missing")
+    parser.add_argument("--host")
+    parser.add_argument("--database")
+    parser.add_argument("--user")
+    parser.add_argument("--password", help="default: PGPASSWORD or ~/.pgpass")
+    arguments = parser.parse_args()
+    if not arguments.dry_run and not (arguments.host and arguments.database and arguments.user):
+        parser.error("--host, --database and --user are required unless --dry-run")
+
+    report_files = find_report_files(arguments.folder, arguments.country, arguments.since, arguments.until)
+    print("{} reports found in {}".format(len(report_files), arguments.folder))
+    if not arguments.dry_run:
+        # Every connection argument is passed: the defaults of Database.initialise are the production database
+        Database.initialise(host=arguments.host, database=arguments.database, user=arguments.user,
+                            password=arguments.password)
+
+    stats = Backfill(arguments.table, arguments.processes, arguments.page_size).run(
+        report_files, arguments.dry_run, arguments.create_schema)
+    print("{} reports ({} failed), {} rows: {} inserted, {} updated in {:.1f} s ({:.0f} rows/s)".format(
+        stats.files, stats.failed_files, stats.rows, stats.inserted, stats.updated, stats.seconds,
+        stats.rows / max(stats.seconds, 1e-9)))
+    if not arguments.dry_run:
+        Database.close_all_connections()
+
+
+if __name__ == "__main__":
+    main()
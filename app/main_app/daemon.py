@@ -0,0 +1,350 @@
+"""
+Long running mode for the labeling automation. The inbox is polled on an interval and the browser is recycled when
+it uses too much memory or has too many tabs open.
+
+Example:
+    python -m app.main_app.daemon --country PT --base-url https://leaseplangroup.icontroller.eu/messages \
+        --labels Rotulos.xlsx --clients Clientes.xlsx --interval 300
+"""
+import argparse
+import logging
+import os
+import signal
+import threading
+import time
+from datetime import date
+
+import app.utilities.custom_logger as cl
+from app.base.command_trace import mark
+from app.base.webdriverfactory import WebDriverFactory
+from app.main_app.startup import StartupError, labeling_startup
+from app.pages.main_page import WebInterations
+from app.utilities.classification_cache import ClassificationCache
+from app.utilities.create_report import CreateReport, TablesUtil
+from app.utilities.nice_tools import GetPaths, newest_file, send_error_email
+from app.utilities.rule_profiler import RuleProfiler
+
+
+def process_rss_mb(pid=None, include_children=False):
+    """
+    Returns the resident memory of a process (and optionally of its children) in MB or None if psutil is not
+    installed
+
+    Parameters
+    ----------
+    pid : int
+        Process id. The current process if None
+    include_children : bool
+        Add the memory of all the child processes (chrome starts one process per tab)
+    """
+    try:
+        import psutil
+    except ImportError:
+        return None
+    try:
+        process = psutil.Process(pid)
+        processes = [process] + (process.children(recursive=True) if include_children else [])
+    except psutil.Error:
+        return None
+    rss = 0
+    for item in processes:
+        try:
+            rss += item.memory_info().rss
+        except psutil.Error:
+            pass
+    return rss / 1024 ** 2
+
+
+def browser_rss_mb(driver):
+    """
+    Returns the memory used by chromedriver and the browser processes in MB or None if it can't be measured
+    """
+    service = getattr(driver, "service", None)
+    process = getattr(service, "process", None)
+    if process is None:
+        return None
+    return process_rss_mb(process.pid, include_children=True)
+
+
+def process_inbox(interactions, report, last_mail=None):
+    """
+    Labels the new mails from the inbox and appends them to the report
+
+    Parameters
+    ----------
+    interactions : WebInterations
+        The main page automation. The driver should be on the messages page
+    report : CreateReport
+        Today report
+    last_mail : list
+        [subject, date] of the last mail in the reports, if it was already read (e.g. the last_mail step of
+        labeling_startup). By default it is read from the report
+
+    Returns
+    -------
+        The number of mails written in the report
+    """
+    if last_mail is None:
+        last_mail = report.get_last_email_date_and_subj()
+    interactions.last_mail_date = last_mail[1]
+    interactions.stop = False
+    # Replay starting point when the commands are recorded (see command_trace.py)
+    mark(interactions.driver, "process_inbox", last_mail_date=interactions.last_mail_date)
+    emails_details = interactions.get_emails_details()
+    mails_count = len(emails_details["subject"])
+    if mails_count:
+        report.write_data_to_excel(TablesUtil().data_from_dict(emails_details))
+    return mails_count
+
+
+class LabelingDaemon(object):
+    """
+    Runs the labeling automation on an interval until stop() is called
+
+    Attributes
+    ----------
+        driver_factory : WebDriverFactory
+            Used to create (and recreate) the browser
+        label_rules_obj, clients_rules_obj
+            The rules objects passed to WebInterations. They can be None if start loads them
+        reports_folder : str
+            Folder with the daily reports
+        country : str
+            Used in the report name
+        interval : float
+            Seconds between two inbox checks
+        max_browser_rss_mb : float
+            The browser is recycled when chromedriver + chrome use more memory
+        max_python_rss_mb : float
+            The browser is recycled when this process uses more memory. The rules objects are kept
+        max_tabs : int
+            The browser is recycled when more tabs are open after a run
+        login : callable
+            Called with the new driver after the browser was started, if the site requires a login
+        classification_cache : ClassificationCache
+            Cache of the rules results, kept when the browser is recycled
+    """
+
+    log = cl.customLogger(logging.DEBUG)
+    error_receiver = "victor.stanescu@leaseplan.com"
+
+    def __init__(self, driver_factory, label_rules_obj, clients_rules_obj, reports_folder, country,
+                 interval=300, max_browser_rss_mb=1500, max_python_rss_mb=1000, max_tabs=2, login=None,
+                 classification_cache=None):
+        self.driver_factory = driver_factory
+        self.label_rules_obj = label_rules_obj
+        self.clients_rules_obj = clients_rules_obj
+        self.reports_folder = reports_folder
+        self.country = country
+        self.interval = interval
+        self.max_browser_rss_mb = max_browser_rss_mb
+        self.max_python_rss_mb = max_python_rss_mb
+        self.max_tabs = max_tabs
+        self.login = login
+        self.classification_cache = classification_cache
+
+        self.driver = None
+        self.main_handle = None
+        self.interactions = None
+        self.runs = 0
+        self.recycles = 0
+        # (report, last mail) loaded by start, used by the first run
+        self._started_report = None
+        self._stop_event = threading.Event()
+
+    def report_paths(self):
+        """Returns the paths of today report and of the previous report"""
+        os.makedirs(self.reports_folder, exist_ok=True)
+        return (GetPaths.get_report_file_path(self.reports_folder, date, self.country),
+                newest_file(self.reports_folder))
+
+    def start(self, labels_file, clients_file, rules_loader=None):
+        """
+        Starts the browser (and login), loads the rules and opens today report concurrently (labeling_startup).
+        The first run uses the report and its last mail. If only the browser failed, it is started again by the
+        first run
+
+        Parameters
+        ----------
+        labels_file, clients_file : str
+            Rules workbooks
+        rules_loader : callable
+            Creates a rules object from a workbook path (see labeling_startup)
+
+        Returns
+        -------
+            StartupResult or None if the browser couldn't be started
+        """
+        report_path, last_report_path = self.report_paths()
+        try:
+            startup = labeling_startup(self.driver_factory, labels_file, clients_file, report_path,
+                                       last_report_path, rules_loader=rules_loader, login=self.login,
+                                       classification_cache=self.classification_cache)
+        except StartupError as e:
+            if e.step != "driver" or "label_rules" not in e.results or "client_rules" not in e.results:
+                raise
+            self.log.error("The browser couldn't be started: " + str(e))
+            self.label_rules_obj, self.clients_rules_obj = e.results["label_rules"], e.results["client_rules"]
+            return None
+        results = startup.results
+        self.label_rules_obj, self.clients_rules_obj = results["label_rules"], results["client_rules"]
+        self.driver, self.interactions = results["driver"], results["interactions"]
+        self.main_handle = self.driver.current_window_handle
+        self._started_report = (results["report"], results["last_mail"])
+        self.log.info("Started\n" + startup.summary())
+        return startup
+
+    def start_browser(self):
+        self.driver = self.driver_factory.getWebDriverInstance()
+        self.main_handle = self.driver.current_window_handle
+        if self.login:
+            self.login(self.driver)
+        self.interactions = WebInterations(self.driver, self.label_rules_obj, self.clients_rules_obj,
+                                           self.classification_cache)
+        self.log.info("Browser started")
+
+    def quit_browser(self):
+        if self.driver is not None:
+            try:
+                self.driver.quit()
+            except Exception as e:
+                self.log.debug("Couldn't quit the browser " + repr(e))
+        self.driver = None
+        self.interactions = None
+
+    def recycle_browser(self, reason):
+        self.log.info("Recycling the browser: " + reason)
+        print("Recycling the browser: " + reason)
+        self.quit_browser()
+        self.recycles += 1
+        self.start_browser()
+
+    def recycle_reason(self):
+        """
+        Returns the reason why the browser should be recycled or None if the thresholds are not crossed
+        """
+        tabs = len(self.driver.window_handles)
+        if tabs > self.max_tabs:
+            return "{} tabs are open".format(tabs)
+        browser_rss = browser_rss_mb(self.driver)
+        if browser_rss is not None and browser_rss > self.max_browser_rss_mb:
+            return "browser uses {:.0f} MB".format(browser_rss)
+        python_rss = process_rss_mb()
+        if python_rss is not None and python_rss > self.max_python_rss_mb:
+            return "python uses {:.0f} MB".format(python_rss)
+        return None
+
+    def run_once(self):
+        """
+        Checks the inbox once and writes the new mails in today report
+
+        Returns
+        -------
+            The number of mails written in the report
+        """
+        if self._started_report is not None:
+            # The browser was just started by start, with the report
+            (report, last_mail), self._started_report = self._started_report, None
+        else:
+            if self.driver is None:
+                self.start_browser()
+            else:
+                # Reload the messages list and close the tabs left open by the previous run
+                self.interactions.close_orphan_windows(self.main_handle)
+                self.driver.get(self.driver_factory.base_url)
+                self.interactions.invalidate_lookup_cache()
+            report, last_mail = CreateReport(*self.report_paths()), None
+        mails_count = process_inbox(self.interactions, report, last_mail)
+        self.runs += 1
+
+        self.log.info("Run {} processed {} mails. Lookup cache {}".format(self.runs, mails_count,
+                                                                           self.interactions.get_cache_stats()))
+        reason = self.recycle_reason()
+        if reason:
+            self.recycle_browser(reason)
+        return mails_count
+
+    def run_forever(self):
+        """
+        Runs the automation every interval seconds until stop() is called. A failed run is reported by mail and
+        the browser is restarted
+        """
+        while not self._stop_event.is_set():
+            start = time.time()
+            try:
+                self.run_once()
+            except Exception as e:
+                self.log.error("Run failed: " + repr(e))
+                send_error_email(self.error_receiver, repr(e))
+                self._started_report = None
+                self.quit_browser()
+            self._stop_event.wait(max(0.0, self.interval - (time.time() - start)))
+        self.quit_browser()
+
+    def stop(self, *args):
+        self._stop_event.set()
+
+
+def main():
+    from app.configFiles.rules import LabelRules
+
+    parser = argparse.ArgumentParser(description="Runs the labeling automation as a daemon")
+    parser.add_argument("--country", required=True)
+    parser.add_argument("--base-url", required=True)
+    parser.add_argument("--labels", required=True, help="labels rules workbook")
+    parser.add_argument("--clients", required=True, help="clients rules workbook")
+    parser.add_argument("--interval", type=float, default=300)
+    parser.add_argument("--max-browser-mb", type=float, default=1500)
+    parser.add_argument("--max-python-mb", type=float, default=1000)
+    parser.add_argument("--max-tabs", type=int, default=2)
+    parser.add_argument("--headless", action="store_true")
+    parser.add_argument("--classification-cache", help="sqlite file of the rules results cache. By default "
+                                                       "classification_cache.sqlite in the reports folder")
+    parser.add_argument("--classification-cache-size", type=int, default=20000)
+    parser.add_argument("--trace-folder", help="record the WebDriver commands of every browser in this folder")
+    parser.add_argument("--profile-rules", action="store_true",
+                        help="profile the rules and write rules_profile_<date>.txt in the reports folder on exit. "
+                             "The classification cache is disabled, so every mail reaches the rules")
+    arguments = parser.parse_args()
+
+    reports_folder = GetPaths.get_report_folder(arguments.country)
+    classification_cache = None
+    if arguments.profile_rules:
+        # A cache hit would skip the profiled rules and the profile would miss the repeated mails
+        print("The classification cache is disabled while the rules are profiled")
+    else:
+        classification_cache = ClassificationCache(
+            arguments.classification_cache or os.path.join(reports_folder, "classification_cache.sqlite"),
+            rules_files={"labels": arguments.labels, "clients": arguments.clients},
+            max_entries=arguments.classification_cache_size)
+
+    rule_profiler = RuleProfiler() if arguments.profile_rules else None
+    rule_set_names = {arguments.labels: "labels", arguments.clients: "clients"}
+
+    def profiled_loader(path):
+        return rule_profiler.wrap(rule_set_names[path], LabelRules(path))
+
+    rules_loader = profiled_loader if rule_profiler is not None else LabelRules
+
+    daemon = LabelingDaemon(WebDriverFactory("chrome", arguments.base_url, headless=arguments.headless,
+                                             trace_folder=arguments.trace_folder),
+                            None, None,
+                            reports_folder, arguments.country,
+                            interval=arguments.interval, max_browser_rss_mb=arguments.max_browser_mb,
+                            max_python_rss_mb=arguments.max_python_mb, max_tabs=arguments.max_tabs,
+                            classification_cache=classification_cache)
+    signal.signal(signal.SIGINT, daemon.stop)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    # The browser, the rules and the report are loaded at the same time
+    daemon.start(arguments.labels, arguments.clients, rules_loader)
+    daemon.run_forever()
+
+    if rule_profiler is not None:
+        profile_path = os.path.join(reports_folder, "rules_profile_{}.txt".format(date.today()))
+        with open(profile_path, "w", encoding="utf-8") as wf:
+            wf.write(rule_profiler.report())
+        print("Rules profile written to " + profile_path)
+
+
+if __name__ == "__main__":
+    main()
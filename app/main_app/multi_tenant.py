@@ -0,0 +1,277 @@
+"""
+Runs the labeling automation for several iController instances (countries) at the same time. Every run of a tenant
+(WebDriverFactory + WebInterations + CreateReport) is done in its own process.
+
+Example:
+    tenants = [Tenant("PT", "https://leaseplangroup.icontroller.eu/messages", "Rotulos.xlsx", "Clientes.xlsx"),
+               Tenant("BE", "https://leaseplnlu.icontroller.eu/messages", "Labels_BE.xlsx", "Clients_BE.xlsx")]
+    runner = MultiTenantRunner(tenants, rules_cache_dir="rules_cache")
+    print(runner.run(rounds=1).summary())
+"""
+import hashlib
+import logging
+import os
+import pickle
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import date
+
+import sys
+
+import app.utilities.custom_logger as cl
+from app.utilities.nice_tools import GetPaths, newest_file
+
+Tenant = namedtuple("Tenant", ["country", "base_url", "labels_file", "clients_file", "max_concurrent_runs",
+                               "headless", "profile_dir", "login"])
+Tenant.__new__.__defaults__ = (1, False, None, None)
+Tenant.__doc__ = """
+An iController instance processed by MultiTenantRunner. max_concurrent_runs limits how many runs of the tenant can
+be in progress at the same time. Keep it 1 unless the inbox is split between the runs, otherwise a mail can be
+labeled twice.
+
+Chrome can't open a profile that another browser uses, so the tenants never share the robot user profile: every
+tenant runs in its own profile_dir (default Profiles/<country> next to the script, one folder per process if
+max_concurrent_runs > 1), where its iController session is kept. login is called with the driver after the browser
+started, if the site requires a login (a module level function, it is sent to the worker process). A headless tenant
+needs a profile_dir with a session or a login, MultiTenantRunner rejects it otherwise
+"""
+
+TenantResult = namedtuple("TenantResult", ["country", "mails", "seconds", "error"])
+
+
+def load_rules(path):
+    """
+    Default rules loader. Creates the rules object from a rules workbook
+    """
+    from app.configFiles.rules import LabelRules
+    return LabelRules(path)
+
+
+class RuleCache(object):
+    """
+    Cache of the parsed rules objects shared by all the tenant processes. A rules workbook is parsed once and
+    pickled in cache_dir; the key is the hash of the workbook content, so a changed workbook is parsed again.
+
+    Unpickling runs code, so cache_dir must be writable only by the robot user: it is created with mode 0o700 and
+    only files named by the hash of an existing workbook are ever loaded from it
+
+    Parameters
+    ----------
+    cache_dir : str
+        Folder where the parsed rules are saved
+    loader : callable
+        Creates a rules object from a workbook path. Should be a module level function (it is sent to other
+        processes)
+    """
+
+    def __init__(self, cache_dir, loader=load_rules):
+        self.cache_dir = cache_dir
+        self.loader = loader
+        self._memory = {}
+
+    def _key(self, path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as workbook:
+            for block in iter(lambda: workbook.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def get(self, path):
+        key = self._key(path)
+        if key in self._memory:
+            return self._memory[key]
+        cache_file = os.path.join(self.cache_dir, key + ".pickle")
+        rules = None
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, "rb") as rules_file:
+                    rules = pickle.load(rules_file)
+            except Exception:
+                rules = None
+        if rules is None:
+            rules = self.loader(path)
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            temporary_file = "{}.{}.tmp".format(cache_file, os.getpid())
+            try:
+                with open(temporary_file, "wb") as rules_file:
+                    pickle.dump(rules, rules_file, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(temporary_file, cache_file)
+            except Exception:
+                # Rules objects that can't be pickled are only cached in this process
+                if os.path.exists(temporary_file):
+                    os.remove(temporary_file)
+        self._memory[key] = rules
+        return rules
+
+
+_process_rule_cache = None
+
+
+def check_tenant(tenant):
+    """
+    Raises ValueError if the tenant would start without an iController session: headless, without profile_dir and
+    login. Such a browser only loads the login page
+    """
+    if tenant.headless and tenant.profile_dir is None and tenant.login is None:
+        raise ValueError("Tenant {} is headless without profile_dir or login, it has no iController session".format(
+            tenant.country))
+
+
+def tenant_profile_dir(tenant):
+    """Returns the Chrome profile folder of a tenant run or None for headless tenants without one"""
+    if tenant.profile_dir is None and tenant.headless:
+        return None
+    profile_dir = tenant.profile_dir or os.path.join(os.path.split(sys.argv[0])[0], "Profiles", tenant.country)
+    if tenant.max_concurrent_runs > 1:
+        profile_dir = "{}_{}".format(profile_dir, os.getpid())
+    return profile_dir
+
+
+def run_tenant(tenant, rules_cache_dir, loader=load_rules):
+    """
+    Runs the automation once for a tenant. Executed in a worker process
+
+    Returns
+    -------
+        TenantResult
+    """
+    from app.base.webdriverfactory import WebDriverFactory
+    from app.main_app.daemon import process_inbox
+    from app.main_app.startup import labeling_startup
+
+    global _process_rule_cache
+    if _process_rule_cache is None or _process_rule_cache.cache_dir != rules_cache_dir:
+        _process_rule_cache = RuleCache(rules_cache_dir, loader)
+
+    start = time.time()
+    driver = None
+    try:
+        reports_folder = GetPaths.get_report_folder(tenant.country)
+        os.makedirs(reports_folder, exist_ok=True)
+        # The browser, the rules and the report are loaded at the same time
+        driver_factory = WebDriverFactory("chrome", tenant.base_url, headless=tenant.headless,
+                                          profile_dir=tenant_profile_dir(tenant),
+                                          ready_selector="" if tenant.login else None)
+        startup = labeling_startup(driver_factory, tenant.labels_file, tenant.clients_file,
+                                   GetPaths.get_report_file_path(reports_folder, date, tenant.country),
+                                   newest_file(reports_folder), rules_loader=_process_rule_cache.get,
+                                   login=tenant.login)
+        driver = startup.results["driver"]
+        mails = process_inbox(startup.results["interactions"], startup.results["report"],
+                              startup.results["last_mail"])
+        return TenantResult(tenant.country, mails, time.time() - start, None)
+    except Exception as e:
+        return TenantResult(tenant.country, 0, time.time() - start, repr(e))
+    finally:
+        if driver is not None:
+            driver.quit()
+
+
+class ThroughputReport(object):
+    """Combined throughput of all the tenants"""
+
+    def __init__(self):
+        self.results = []
+        self.started = time.time()
+        self.finished = None
+
+    def add(self, result):
+        self.results.append(result)
+
+    def per_tenant(self):
+        tenants = {}
+        for result in self.results:
+            stats = tenants.setdefault(result.country, {"runs": 0, "mails": 0, "seconds": 0.0, "errors": 0})
+            stats["runs"] += 1
+            stats["mails"] += result.mails
+            stats["seconds"] += result.seconds
+            stats["errors"] += result.error is not None
+        for stats in tenants.values():
+            stats["mails_per_minute"] = stats["mails"] / stats["seconds"] * 60 if stats["seconds"] else 0.0
+        return tenants
+
+    def summary(self):
+        wall_time = (self.finished or time.time()) - self.started
+        mails = sum(result.mails for result in self.results)
+        lines = []
+        for country, stats in sorted(self.per_tenant().items()):
+            lines.append("{:<6} runs={runs} mails={mails} time={seconds:.0f}s errors={errors} "
+                         "-> {mails_per_minute:.1f} mails/minute".format(country, **stats))
+        lines.append("Total: {} mails in {:.0f}s wall time -> {:.1f} mails/minute".format(
+            mails, wall_time, mails / wall_time * 60 if wall_time else 0.0))
+        return "\n".join(lines)
+
+
+class MultiTenantRunner(object):
+    """
+    Schedules the tenant runs in a process pool
+
+    Parameters
+    ----------
+    tenants : list
+        Tenant tuples
+    rules_cache_dir : str
+        Folder used by the shared RuleCache
+    max_processes : int
+        Size of the process pool. By default one process per tenant
+    loader : callable
+        Creates a rules object from a workbook path (see RuleCache)
+    """
+
+    log = cl.customLogger(logging.DEBUG)
+
+    def __init__(self, tenants, rules_cache_dir, max_processes=None, loader=load_rules):
+        self.tenants = list(tenants)
+        for tenant in self.tenants:
+            check_tenant(tenant)
+        self.rules_cache_dir = rules_cache_dir
+        self.max_processes = max_processes or sum(tenant.max_concurrent_runs for tenant in self.tenants)
+        self.loader = loader
+
+    def run(self, rounds=1, interval=0):
+        """
+        Runs every tenant rounds times. A tenant run starts interval seconds after its previous run started, as soon
+        as the tenant has less than max_concurrent_runs runs in progress
+
+        Returns
+        -------
+            ThroughputReport
+        """
+        report = ThroughputReport()
+        remaining = {tenant.country: rounds for tenant in self.tenants}
+        in_progress = {tenant.country: 0 for tenant in self.tenants}
+        next_start = {tenant.country: 0.0 for tenant in self.tenants}
+        futures = {}
+        with ProcessPoolExecutor(max_workers=self.max_processes) as executor:
+            while futures or any(remaining.values()):
+                now = time.time()
+                for tenant in self.tenants:
+                    country = tenant.country
+                    if remaining[country] and in_progress[country] < tenant.max_concurrent_runs and \
+                            next_start[country] <= now:
+                        future = executor.submit(run_tenant, tenant, self.rules_cache_dir, self.loader)
+                        futures[future] = tenant
+                        remaining[country] -= 1
+                        in_progress[country] += 1
+                        next_start[country] = now + interval
+                pending_starts = [next_start[tenant.country] - now for tenant in self.tenants
+                                  if remaining[tenant.country]]
+                timeout = max(0.1, min(pending_starts)) if pending_starts else None
+                if not futures:
+                    time.sleep(timeout)
+                    continue
+                done, _ = wait(list(futures), timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    tenant = futures.pop(future)
+                    in_progress[tenant.country] -= 1
+                    result = future.result()
+                    report.add(result)
+                    if result.error:
+                        self.log.error("Run for {} failed: {}".format(tenant.country, result.error))
+                    else:
+                        self.log.info("Run for {} processed {} mails in {:.0f}s".format(
+                            tenant.country, result.mails, result.seconds))
+        report.finished = time.time()
+        self.log.info("Multi-tenant run finished\n" + report.summary())
+        return report
@@ -0,0 +1,274 @@
+"""
+Concurrent startup of a labeling run. Starting the browser, loading the rules workbooks and opening the report are
+independent and each takes seconds; they run at the same time and a step starts as soon as the steps it depends on
+are done. The startup then takes as long as its critical path (usually the browser), not the sum of the steps.
+
+Example:
+    startup = labeling_startup(WebDriverFactory("chrome", base_url), "Rotulos.xlsx", "Clientes.xlsx",
+                               report_path, last_report_path)
+    print(startup.summary())
+    interactions, report = startup.results["interactions"], startup.results["report"]
+"""
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import app.utilities.custom_logger as cl
+
+log = cl.customLogger(logging.INFO)
+
+
+class StartupError(Exception):
+    """
+    A startup step failed. step is the name of the step and results the results of the steps that finished (e.g.
+    to quit a browser that was started). The original exception is the __cause__
+    """
+
+    def __init__(self, step, error, results=None):
+        super().__init__("Startup step {} failed: {!r}".format(step, error))
+        self.step = step
+        self.results = results or {}
+
+
+class Step(object):
+    """
+    A startup step
+
+    Parameters
+    ----------
+    name : str
+        Step name. The step result is passed with this name to the steps that depend on it
+    function : callable
+        Called with the results of the dependencies as keyword arguments
+    depends : tuple
+        Names of the steps that must be done before this one
+    in_process : bool
+        Run the step in a separate process (CPU bound steps). The function, its arguments and its result must be
+        picklable
+    """
+
+    def __init__(self, name, function, depends=(), in_process=False):
+        self.name = name
+        self.function = function
+        self.depends = tuple(depends)
+        self.in_process = in_process
+
+
+class StartupResult(object):
+    """
+    Results and timings of a startup
+
+    Attributes
+    ----------
+    results : dict
+        {step name: result}
+    timings : dict
+        {step name: (start, end)} in seconds from the startup start
+    """
+
+    def __init__(self, steps, results, timings, wall_seconds):
+        self.steps = steps
+        self.results = results
+        self.timings = timings
+        self.wall_seconds = wall_seconds
+
+    @property
+    def sequential_seconds(self):
+        """How long the startup would take with the steps run one after another"""
+        return sum(end - start for start, end in self.timings.values())
+
+    def critical_path(self):
+        """
+        Returns the chain of steps that determined the startup duration: the step that finished last, the
+        dependency it waited for last, and so on
+        """
+        if not self.timings:
+            return []
+        name = max(self.timings, key=lambda step_name: self.timings[step_name][1])
+        path = [name]
+        while self.steps[name].depends:
+            name = max(self.steps[name].depends, key=lambda step_name: self.timings[step_name][1])
+            path.append(name)
+        return path[::-1]
+
+    def summary(self):
+        lines = []
+        for name, (start, end) in sorted(self.timings.items(), key=lambda item: item[1][0]):
+            lines.append("{:<16} {:6.2f} s -> {:6.2f} s ({:.2f} s)".format(name, start, end, end - start))
+        lines.append("Startup: {:.2f} s (sequential {:.2f} s). Critical path: {}".format(
+            self.wall_seconds, self.sequential_seconds, " -> ".join(self.critical_path())))
+        return "\n".join(lines)
+
+
+class StartupOrchestrator(object):
+    """
+    Runs startup steps concurrently following their dependencies
+
+    Parameters
+    ----------
+    max_threads : int
+        Threads for the steps. By default one per step
+    max_processes : int
+        Processes for the in_process steps. By default one per in_process step
+    """
+
+    def __init__(self, max_threads=None, max_processes=None):
+        self.steps = {}
+        self.max_threads = max_threads
+        self.max_processes = max_processes
+
+    def add(self, name, function, depends=(), in_process=False):
+        """Adds a step. Returns the orchestrator, so the calls can be chained"""
+        if name in self.steps:
+            raise ValueError("Duplicated startup step: " + name)
+        self.steps[name] = Step(name, function, depends, in_process)
+        return self
+
+    def _check_graph(self):
+        """Raises ValueError for unknown dependencies and cycles"""
+        for step in self.steps.values():
+            for dependency in step.depends:
+                if dependency not in self.steps:
+                    raise ValueError("Step {} depends on unknown step {}".format(step.name, dependency))
+        visiting, done = set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError("Startup steps have a dependency cycle through " + name)
+            visiting.add(name)
+            for dependency in self.steps[name].depends:
+                visit(dependency)
+            visiting.discard(name)
+            done.add(name)
+
+        for name in self.steps:
+            visit(name)
+
+    def run(self):
+        """
+        Runs all the steps
+
+        Returns
+        -------
+            StartupResult
+
+        Raises
+        ------
+        StartupError
+            If a step failed. The steps already running are finished first, the steps depending on the failed one
+            are not started
+        """
+        self._check_graph()
+        process_steps = sum(step.in_process for step in self.steps.values())
+        threads = ThreadPoolExecutor(max_workers=self.max_threads or max(1, len(self.steps)))
+        processes = ProcessPoolExecutor(max_workers=self.max_processes or process_steps) if process_steps else None
+
+        start = time.monotonic()
+        results, timings, running = {}, {}, {}
+        pending = dict(self.steps)
+        failure = None
+        try:
+            while pending or running:
+                if failure is None:
+                    for name, step in list(pending.items()):
+                        if all(dependency in results for dependency in step.depends):
+                            arguments = {dependency: results[dependency] for dependency in step.depends}
+                            executor = processes if step.in_process else threads
+                            running[executor.submit(step.function, **arguments)] = (name, time.monotonic() - start)
+                            del pending[name]
+                elif not running:
+                    break
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, step_start = running.pop(future)
+                    timings[name] = (step_start, time.monotonic() - start)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        log.error("Startup step {} failed: {!r}".format(name, e))
+                        if failure is None:
+                            failure = (name, e)
+        finally:
+            threads.shutdown(wait=True)
+            if processes is not None:
+                processes.shutdown(wait=True)
+
+        if failure is not None:
+            raise StartupError(failure[0], failure[1], results) from failure[1]
+        result = StartupResult(self.steps, results, timings, time.monotonic() - start)
+        log.info(result.summary())
+        return result
+
+
+def labeling_startup(driver_factory, labels_file, clients_file, report_path, last_report_path=None,
+                     rules_loader=None, login=None, rules_in_process=False, classification_cache=None):
+    """
+    Starts a labeling run: browser (and login), label and client rules and the report, concurrently
+
+    Parameters
+    ----------
+    driver_factory : WebDriverFactory
+        Creates the browser
+    labels_file, clients_file : str
+        Rules workbooks
+    report_path, last_report_path : str
+        Today and previous report (see CreateReport)
+    rules_loader : callable
+        Creates a rules object from a workbook path. Default LabelRules (see multi_tenant.load_rules)
+    login : callable
+        Called with the driver after the browser started
+    rules_in_process : bool
+        Parse the rules workbooks in separate processes. The loader and the rules objects must be picklable
+    classification_cache : ClassificationCache
+        Passed to WebInterations
+
+    Returns
+    -------
+        StartupResult. results has "driver", "label_rules", "client_rules", "report", "last_mail" ([subject,
+        date] of the last mail in the reports) and "interactions"
+    """
+    from app.main_app.multi_tenant import load_rules
+    from app.pages.main_page import WebInterations
+    from app.utilities.create_report import CreateReport
+
+    rules_loader = rules_loader or load_rules
+
+    def start_browser():
+        driver = driver_factory.getWebDriverInstance()
+        if driver is None:
+            raise RuntimeError(driver_factory.base_url + " could not be loaded")
+        if login:
+            login(driver)
+        return driver
+
+    def interactions(driver, label_rules, client_rules):
+        return WebInterations(driver, label_rules, client_rules, classification_cache)
+
+    orchestrator = StartupOrchestrator()
+    orchestrator.add("driver", start_browser)
+    orchestrator.add("label_rules", _Call(rules_loader, labels_file), in_process=rules_in_process)
+    orchestrator.add("client_rules", _Call(rules_loader, clients_file), in_process=rules_in_process)
+    orchestrator.add("report", lambda: CreateReport(report_path, last_report_path))
+    orchestrator.add("last_mail", lambda report: report.get_last_email_date_and_subj(), depends=("report",))
+    orchestrator.add("interactions", interactions, depends=("driver", "label_rules", "client_rules"))
+    try:
+        return orchestrator.run()
+    except StartupError as e:
+        # Don't leave the browser open when another step failed
+        driver = e.results.get("driver")
+        if driver is not None:
+            driver.quit()
+        raise
+
+
+class _Call(object):
+    """function(*args) as a picklable callable (lambdas can't be sent to a process)"""
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def __call__(self):
+        return self.function(*self.args)
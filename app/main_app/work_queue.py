@@ -0,0 +1,507 @@
+"""
+Work queue to label one inbox with several workers (processes or hosts). A coordinator reads the messages list
+(read_mail_details) and queues the unlabeled mails; the workers claim them, run open_body and store the result; the
+coordinator writes the results in today report.
+
+The queue is a SQLite file (WAL mode, the claims are IMMEDIATE transactions). A claimed mail is leased to a worker
+for lease_seconds; when the worker dies before starting the mail, the lease expires and another worker claims it.
+Before labeling, the worker moves the mail to "processing", which succeeds only while it still holds the lease.
+A mail whose worker died while processing is not claimed again but marked "abandoned": it may have been labeled
+or forwarded already, so it is left for a person to check. A mail is therefore never labeled or forwarded twice.
+
+States: pending -> leased -> processing -> done -> reported
+                   leased (lease expired) -> leased by another worker
+                   leased -> pending (fail, retried) or failed (max_attempts reached)
+                   processing (lease expired) -> abandoned
+
+Several hosts can share the queue file only on storage with working file locks (not NFS/SMB shares).
+
+Example:
+    python -m app.main_app.work_queue coordinator --queue queue.sqlite --country PT --base-url https://...
+    python -m app.main_app.work_queue worker --queue queue.sqlite --base-url https://... \
+        --labels Rotulos.xlsx --clients Clientes.xlsx --headless --worker-id worker-1 --login robot.login:sign_in
+
+Every browser needs its own Chrome profile: without --headless, a worker uses --profile-dir or Profiles/<role>_<id>
+next to the script. --login (module:function) is called with the driver after the browser started.
+app/benchmarks/queue_benchmark.py runs several workers over one queue on the fake site.
+"""
+import argparse
+import importlib
+import json
+import logging
+import os
+import signal
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from collections import namedtuple
+from datetime import date
+
+import app.utilities.custom_logger as cl
+
+Task = namedtuple("Task", ["message_id", "subject", "sender", "date", "url", "attempts"])
+
+# Columns of the report rows built from the results (see get_emails_details)
+_RESULT_COLUMNS = ["subject", "sender", "date", "label", "status", "email_body", "check", "url", "client",
+                   "clients_check_text", "forward", "email_closed"]
+
+
+def import_callable(path):
+    """Returns the function of a "module:function" path"""
+    module_name, _, name = path.partition(":")
+    if not module_name or not name:
+        raise ValueError("Expected module:function, got " + path)
+    return getattr(importlib.import_module(module_name), name)
+
+
+def message_id_of(url):
+    """Returns the message id of a messages list url (https://.../messages#mail=155171 -> "155171")"""
+    return url.rsplit("=", 1)[-1] if "=" in url else url
+
+
+def body_url_of(url):
+    """The url of the mail body (see get_emails_details)"""
+    return url.replace("#mail", r"/show?msg")
+
+
+def forward_url_of(url):
+    """The url of the forward page of a mail (see get_emails_details)"""
+    return url.replace("#mail=", r"/compose/direction/forward/messageId/")
+
+
+class WorkQueue(object):
+    """
+    Durable queue of the mails to label
+
+    Parameters
+    ----------
+    path : str
+        SQLite file shared by the coordinator and the workers
+    lease_seconds : float
+        Visibility timeout of a claimed mail. The worker extends it while it works on the mail
+    max_attempts : int
+        A mail that failed this many times is not retried
+    """
+
+    log = cl.customLogger(logging.INFO)
+
+    def __init__(self, path, lease_seconds=300, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS messages (message_id TEXT PRIMARY KEY, "
+                                 "subject TEXT, sender TEXT, date TEXT, url TEXT, state TEXT NOT NULL, "
+                                 "owner TEXT, lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0, "
+                                 "result TEXT, error TEXT, enqueued REAL, updated REAL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS messages_state ON messages (state, date)")
+
+    def _transaction(self, function):
+        """Runs function(connection) in an IMMEDIATE transaction (the write lock is taken at the start)"""
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = function(self._connection)
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+            return result
+
+    def enqueue(self, mail_details, last_mail_date=None):
+        """
+        Queues the unlabeled mails of the messages list. Mails already in the queue are ignored
+
+        Parameters
+        ----------
+        mail_details : dict
+            The result of read_mail_details
+        last_mail_date : str
+            Mails with a date lower or equal are not queued (already in the reports)
+
+        Returns
+        -------
+            The number of new mails
+        """
+        subjects, urls = mail_details["subject"]
+        now = time.time()
+        rows = []
+        for subject, url, sender, mail_date, label in zip(subjects, urls, mail_details["sender"],
+                                                          mail_details["date"], mail_details["label"]):
+            if label != "" or (last_mail_date and mail_date <= last_mail_date):
+                continue
+            rows.append((message_id_of(url), subject, sender, mail_date, url, now, now))
+
+        def insert(connection):
+            before = connection.total_changes
+            connection.executemany("INSERT OR IGNORE INTO messages (message_id, subject, sender, date, url, state, "
+                                   "enqueued, updated) VALUES (?, ?, ?, ?, ?, 'pending', ?, ?)", rows)
+            return connection.total_changes - before
+
+        added = self._transaction(insert)
+        self.log.info("{} mails queued ({} unlabeled on the page)".format(added, len(rows)))
+        return added
+
+    def claim(self, worker, limit=1):
+        """
+        Leases up to limit mails (pending or with an expired lease, oldest first) to a worker
+
+        Returns
+        -------
+            list of Task
+        """
+        def lease(connection):
+            now = time.time()
+            # Workers that died while processing: their mails are not retried
+            abandoned = connection.execute("UPDATE messages SET state = 'abandoned', updated = ? "
+                                           "WHERE state = 'processing' AND lease_expires < ?", (now, now)).rowcount
+            if abandoned:
+                self.log.error("{} mails abandoned while processing, check them in iController".format(abandoned))
+            connection.execute("UPDATE messages SET state = 'failed', error = 'lease expired', updated = ? "
+                               "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                               (now, now, self.max_attempts))
+            rows = connection.execute("SELECT message_id, subject, sender, date, url, attempts FROM messages "
+                                      "WHERE (state = 'pending' OR (state = 'leased' AND lease_expires < ?)) "
+                                      "AND attempts < ? ORDER BY date LIMIT ?",
+                                      (now, self.max_attempts, limit)).fetchall()
+            connection.executemany("UPDATE messages SET state = 'leased', owner = ?, lease_expires = ?, "
+                                   "attempts = attempts + 1, updated = ? WHERE message_id = ?",
+                                   [(worker, now + self.lease_seconds, now, row[0]) for row in rows])
+            return [Task(*row[:5], attempts=row[5] + 1) for row in rows]
+
+        return self._transaction(lease)
+
+    def _update_owned(self, message_id, worker, states, assignments, values, require_lease=True):
+        """
+        Updates a mail only if the worker owns it in one of states (and, with require_lease, its lease didn't
+        expire). Returns True if it was updated
+        """
+        def update(connection):
+            now = time.time()
+            placeholders = ", ".join("?" * len(states))
+            query = "UPDATE messages SET {}, updated = ? WHERE message_id = ? AND owner = ? AND state IN ({})".format(
+                assignments, placeholders)
+            parameters = tuple(values) + (now, message_id, worker) + tuple(states)
+            if require_lease:
+                query += " AND lease_expires >= ?"
+                parameters += (now,)
+            return connection.execute(query, parameters).rowcount == 1
+
+        return self._transaction(update)
+
+    def extend(self, message_id, worker, seconds=None):
+        """Extends the lease of a mail. Returns False if the worker lost the lease"""
+        expires = time.time() + (seconds or self.lease_seconds)
+        return self._update_owned(message_id, worker, ("leased", "processing"), "lease_expires = ?", (expires,))
+
+    def start(self, message_id, worker):
+        """
+        Marks the mail as being labeled. Returns False if the worker lost the lease: the mail must not be opened
+        """
+        expires = time.time() + self.lease_seconds
+        return self._update_owned(message_id, worker, ("leased",), "state = 'processing', lease_expires = ?",
+                                  (expires,))
+
+    def complete(self, message_id, worker, result):
+        """
+        Stores the result (open_body dict) of a mail. Returns False if the mail was abandoned meanwhile. A mail in
+        processing is never claimed again, so a late result is still stored
+        """
+        return self._update_owned(message_id, worker, ("processing",), "state = 'done', result = ?",
+                                  (json.dumps(result, default=str),), require_lease=False)
+
+    def fail(self, message_id, worker, error, retry=True):
+        """
+        Releases a mail after an error. It is retried (until max_attempts) only if it was not started: a mail that
+        failed while processing may have been labeled
+        """
+        def release(connection):
+            now = time.time()
+            row = connection.execute("SELECT state, attempts FROM messages WHERE message_id = ? AND owner = ?",
+                                     (message_id, worker)).fetchone()
+            if row is None or row[0] not in ("leased", "processing"):
+                return None
+            if row[0] == "leased" and retry and row[1] < self.max_attempts:
+                state = "pending"
+            else:
+                state = "failed"
+            connection.execute("UPDATE messages SET state = ?, owner = NULL, lease_expires = NULL, error = ?, "
+                               "updated = ? WHERE message_id = ?", (state, str(error), now, message_id))
+            return state
+
+        return self._transaction(release)
+
+    def collect(self):
+        """
+        Returns the finished mails as a get_emails_details dictionary (report columns) and marks them as reported.
+        The failed and abandoned mails are reported with their status
+        """
+        def take(connection):
+            now = time.time()
+            rows = connection.execute("SELECT message_id, subject, sender, date, url, state, result, error "
+                                      "FROM messages WHERE state IN ('done', 'failed', 'abandoned') "
+                                      "ORDER BY date DESC").fetchall()
+            connection.executemany("UPDATE messages SET state = 'reported:' || state, updated = ? "
+                                   "WHERE message_id = ?", [(now, row[0]) for row in rows])
+            return rows
+
+        details = {column: [] for column in _RESULT_COLUMNS}
+        for message_id, subject, sender, mail_date, url, state, result, error in self._transaction(take):
+            result = json.loads(result) if result else {}
+            label = result.get("label") or ""
+            if state == "done":
+                status = "Label was added" if label else "Couldn't set the label"
+            else:
+                status = "Mail {} ({})".format(state, error or "worker stopped")
+            row = {"subject": result.get("subject_text") or subject, "sender": sender, "date": mail_date,
+                   "label": label, "status": status, "email_body": result.get("current_email", ""),
+                   "check": result.get("labels_check_text", "") if label else "", "url": body_url_of(url),
+                   "client": result.get("client", ""), "clients_check_text": result.get("clients_check_text", ""),
+                   "forward": result.get("forward", ""), "email_closed": result.get("email_closed", "")}
+            for column in _RESULT_COLUMNS:
+                details[column].append(row[column] if row[column] is not None else "")
+        return details
+
+    def counts(self):
+        """Returns {state: number of mails}"""
+        with self._lock:
+            return dict(self._connection.execute("SELECT state, COUNT(*) FROM messages GROUP BY state").fetchall())
+
+    def close(self):
+        self._connection.close()
+
+
+class _Heartbeat(object):
+    """Extends the lease of a mail every lease_seconds / 3 while the worker labels it"""
+
+    def __init__(self, queue, message_id, worker):
+        self.queue = queue
+        self.message_id = message_id
+        self.worker = worker
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop_event.wait(self.queue.lease_seconds / 3):
+            if not self.queue.extend(self.message_id, self.worker):
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop_event.set()
+        self._thread.join()
+
+
+class QueueWorker(object):
+    """
+    Claims mails from the queue and labels them with open_body
+
+    Parameters
+    ----------
+    queue : WorkQueue
+        The shared queue
+    interactions : WebInterations
+        The automation of this worker, with its own browser
+    worker_id : str
+        Unique name of the worker. By default host:pid
+    idle_seconds : float
+        Wait when the queue is empty
+    """
+
+    log = cl.customLogger(logging.INFO)
+
+    def __init__(self, queue, interactions, worker_id=None, idle_seconds=5):
+        self.queue = queue
+        self.interactions = interactions
+        self.worker_id = worker_id or "{}:{}".format(socket.gethostname(), os.getpid())
+        self.idle_seconds = idle_seconds
+        self.processed = 0
+        # The window the worker returns to. The tabs left open by a mail are closed after it
+        self.main_handle = interactions.driver.current_window_handle
+        self._stop_event = threading.Event()
+
+    def reclaim_windows(self):
+        """Closes the tabs left open by the last mail. Returns the number of closed tabs"""
+        if len(self.interactions.driver.window_handles) <= 1:
+            return 0
+        closed = self.interactions.close_orphan_windows(self.main_handle)
+        self.log.info("{} orphan tabs closed".format(closed))
+        return closed
+
+    def process(self, task):
+        """Labels one claimed mail. Returns the open_body result or None if the lease was lost"""
+        if not self.queue.start(task.message_id, self.worker_id):
+            self.log.info("Lease lost before mail {} was started".format(task.message_id))
+            return None
+        try:
+            with _Heartbeat(self.queue, task.message_id, self.worker_id):
+                result = self.interactions.open_body(email_link_element=body_url_of(task.url),
+                                                     forward_url=forward_url_of(task.url))
+        except Exception as e:
+            self.log.error("Mail {} failed: {!r}".format(task.message_id, e))
+            self.queue.fail(task.message_id, self.worker_id, repr(e))
+            raise
+        if not self.queue.complete(task.message_id, self.worker_id, result):
+            self.log.error("Mail {} was labeled after it was abandoned".format(task.message_id))
+        self.processed += 1
+        print("Mail {} labeled by {}: {}".format(task.message_id, self.worker_id, result.get("label")))
+        return result
+
+    def run_once(self):
+        """Claims and labels one mail. Returns False if the queue was empty"""
+        tasks = self.queue.claim(self.worker_id)
+        if not tasks:
+            return False
+        try:
+            self.process(tasks[0])
+        except Exception:
+            # The mail is marked failed, the worker goes on with the next one
+            pass
+        finally:
+            # The next mail must not be read from a window left open by this one
+            self.reclaim_windows()
+        return True
+
+    def run_forever(self):
+        while not self._stop_event.is_set():
+            if not self.run_once():
+                self._stop_event.wait(self.idle_seconds)
+
+    def stop(self, *args):
+        self._stop_event.set()
+
+
+class QueueCoordinator(object):
+    """
+    Queues the unlabeled mails of the inbox and writes the labeled ones in today report
+
+    Parameters
+    ----------
+    queue : WorkQueue
+        The shared queue
+    interactions : WebInterations
+        Automation on the messages page (its rules are not used)
+    reports_folder, country : str
+        Where today report is written (see LabelingDaemon)
+    interval : float
+        Seconds between two reads of the inbox
+    """
+
+    log = cl.customLogger(logging.INFO)
+
+    def __init__(self, queue, interactions, reports_folder, country, interval=60):
+        self.queue = queue
+        self.interactions = interactions
+        self.reports_folder = reports_folder
+        self.country = country
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def report(self):
+        from app.utilities.create_report import CreateReport
+        from app.utilities.nice_tools import GetPaths, newest_file
+
+        os.makedirs(self.reports_folder, exist_ok=True)
+        report_path = GetPaths.get_report_file_path(self.reports_folder, date, self.country)
+        return CreateReport(report_path, newest_file(self.reports_folder))
+
+    def run_once(self):
+        """Queues the new mails and reports the finished ones. Returns (queued, reported)"""
+        from app.utilities.create_report import TablesUtil
+
+        report = self.report()
+        self.interactions.driver.refresh()
+        self.interactions.invalidate_lookup_cache()
+        queued = self.queue.enqueue(self.interactions.read_mail_details(),
+                                    report.get_last_email_date_and_subj()[1])
+        details = self.queue.collect()
+        reported = len(details["subject"])
+        if reported:
+            report.write_data_to_excel(TablesUtil().data_from_dict(details))
+        self.log.info("Queue: {} queued, {} reported, {}".format(queued, reported, self.queue.counts()))
+        return queued, reported
+
+    def run_forever(self):
+        while not self._stop_event.is_set():
+            start = time.time()
+            try:
+                self.run_once()
+            except Exception as e:
+                self.log.error("Coordinator run failed: " + repr(e))
+            self._stop_event.wait(max(0.0, self.interval - (time.time() - start)))
+
+    def stop(self, *args):
+        self._stop_event.set()
+
+
+def main():
+    from app.base.webdriverfactory import WebDriverFactory
+    from app.pages.main_page import WebInterations
+    from app.utilities.nice_tools import GetPaths
+
+    parser = argparse.ArgumentParser(description="Labels one inbox with several workers")
+    parser.add_argument("role", choices=["coordinator", "worker"])
+    parser.add_argument("--queue", required=True, help="sqlite file of the queue")
+    parser.add_argument("--base-url", required=True)
+    parser.add_argument("--country", help="coordinator: country of the report")
+    parser.add_argument("--labels", help="worker: labels rules workbook")
+    parser.add_argument("--clients", help="worker: clients rules workbook")
+    parser.add_argument("--worker-id")
+    parser.add_argument("--interval", type=float, default=60)
+    parser.add_argument("--lease-seconds", type=float, default=300)
+    parser.add_argument("--headless", action="store_true")
+    parser.add_argument("--profile-dir", help="Chrome user data folder of this browser. By default "
+                                              "Profiles/<role>_<worker id or pid> next to the script (not headless)")
+    parser.add_argument("--login", help="module:function called with the driver after the browser started")
+    arguments = parser.parse_args()
+
+    login = import_callable(arguments.login) if arguments.login else None
+    profile_dir = arguments.profile_dir
+    if profile_dir is None and not arguments.headless:
+        # Chrome can't open a profile used by another browser: one folder per worker
+        name = "{}_{}".format(arguments.role, arguments.worker_id or os.getpid()).replace(":", "_")
+        profile_dir = os.path.join(os.path.split(sys.argv[0])[0], "Profiles", name)
+
+    queue = WorkQueue(arguments.queue, lease_seconds=arguments.lease_seconds)
+    # With a login the messages list is shown only after it: wait only for the login page to load
+    driver = WebDriverFactory("chrome", arguments.base_url, headless=arguments.headless, profile_dir=profile_dir,
+                              ready_selector="" if login else None).getWebDriverInstance()
+    if driver is None:
+        raise SystemExit(arguments.base_url + " could not be loaded")
+    if login:
+        login(driver)
+
+    if arguments.role == "coordinator":
+        if not arguments.country:
+            parser.error("--country is required for the coordinator")
+        runner = QueueCoordinator(queue, WebInterations(driver, None, None),
+                                  GetPaths.get_report_folder(arguments.country), arguments.country,
+                                  interval=arguments.interval)
+    else:
+        if not (arguments.labels and arguments.clients):
+            parser.error("--labels and --clients are required for a worker")
+        from app.configFiles.rules import LabelRules
+        interactions = WebInterations(driver, LabelRules(arguments.labels), LabelRules(arguments.clients))
+        runner = QueueWorker(queue, interactions, arguments.worker_id)
+
+    signal.signal(signal.SIGINT, runner.stop)
+    signal.signal(signal.SIGTERM, runner.stop)
+    try:
+        runner.run_forever()
+    finally:
+        driver.quit()
+        queue.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ The automation for the main page.
 from itertools import islice
 
 from app.base.selenium_driver import SeleniumDriver
+from app.base.locators import Locator
 from app.utilities.create_report import CreateReport
 import os
 from app.configFiles.rules import LabelRules
@@ -16,6 +17,7 @@ from sys import exit as exit_app
 import sys
 import time
 from app.utilities.custom_logger import screen_shot
+from app.utilities.mail_document import MailDocument
 
 
 class WebInterations(SeleniumDriver):
@@ -65,41 +67,51 @@ class WebInterations(SeleniumDriver):
 
     # LOCATORS
     # Check if page is opened (new message locator)
-    _first_checkbox_locator = "#messages-list > tbody > tr:nth-child(1)"
+    _first_checkbox_locator = Locator("#messages-list > tbody > tr:nth-child(1)")
 
     # Mail details
-    _subject_locator = "#messages-list > tbody > tr > td.column-subject > a"
-    _subject_from_popup_locator = "body > div > form > h2"
-    _sender_locator = "#messages-list > tbody > tr > td.column-from > span"
-    _sender_from_popup_locator = "body > div.main-content > form > div.from"
-    _receiver_from_popup_locator = "body > div > form > div.contact > div > span"
-    _date_locator = "#messages-list > tbody > tr> td.column-received-at.sorting_1"
-    _label_locator = "#messages-list > tbody > tr > td.column-3"
+    _subject_locator = Locator("#messages-list > tbody > tr > td.column-subject > a")
+    _subject_from_popup_locator = Locator("body > div > form > h2")
+    _sender_locator = Locator("#messages-list > tbody > tr > td.column-from > span")
+    _sender_from_popup_locator = Locator("body > div.main-content > form > div.from")
+    _receiver_from_popup_locator = Locator("body > div > form > div.contact > div > span")
+    _date_locator = Locator("#messages-list > tbody > tr> td.column-received-at.sorting_1")
+    _label_locator = Locator("#messages-list > tbody > tr > td.column-3")
 
     # Mail body
-    _email_body_locator = "body > div > form > div.content"
-    _label_field_locator = "s2id_autogen4"
-    _clients_field_locator = "#s2id_autogen2"
-    _label_body_locator = "#s2id_autogen3 > ul > li > div"
-    _label_dropdown_element = "#select2-drop > ul > li:nth-child(1)"
-    _done_button_locator = "body > div > form > div.actions > button.done.call-to-action"
+    _email_body_locator = Locator("body > div > form > div.content")
+    _label_field_locator = Locator("s2id_autogen4", "id")
+    _clients_field_locator = Locator("#s2id_autogen2")
+    _label_body_locator = Locator("#s2id_autogen3 > ul > li > div")
+    _label_dropdown_element = Locator("#select2-drop > ul > li:nth-child(1)")
+    _done_button_locator = Locator("body > div > form > div.actions > button.done.call-to-action")
 
-    _client_dropdown_label_locator = "#select2-drop > ul > li > ul > li:nth-child(1)"
+    _client_dropdown_label_locator = Locator("#select2-drop > ul > li > ul > li:nth-child(1)")
 
     # Forward window
-    _forward_field_locator = "#s2id_autogen4"
-    _forward_button_locator = "body > div.main-content > form > div.actions > button.send.call-to-action"
-    _forward_accepted_locator = "#s2id_autogen3 > ul > li.select2-search-choice"
+    _forward_field_locator = Locator("#s2id_autogen4")
+    _forward_button_locator = Locator("body > div.main-content > form > div.actions > button.send.call-to-action")
+    _forward_accepted_locator = Locator("#s2id_autogen3 > ul > li.select2-search-choice")
+
+    # Accepted labels and clients (select2 choices)
+    _label_choice_locator = Locator("div.labels li.select2-search-choice")
+    _client_choice_locator = Locator("#s2id_autogen1 > ul > li.select2-search-choice")
+    _client_choice_body_locator = Locator("#s2id_autogen1 > ul > li.select2-search-choice > div")
 
     log = cl.customLogger(logging.DEBUG)
     error_receiver = "victor.stanescu@leaseplan.com"
+    # Times the mails table is read (with a page refresh in between) before it fails because its columns have
+    # different lengths
+    read_attempts = 3
 
-    def __init__(self, driver, label_rules_obj, clients_rules_obj):
+    def __init__(self, driver, label_rules_obj, clients_rules_obj, classification_cache=None):
         super().__init__(driver)
         self.driver = driver
 
         self.label_rules_obj = label_rules_obj
         self.clients_rules_obj = clients_rules_obj
+        # Optional ClassificationCache (classification_cache.py). The rules results are reused for repeated mails
+        self.classification_cache = classification_cache
 
         #self.main_page_url = main_page_url
 
@@ -306,102 +318,135 @@ class WebInterations(SeleniumDriver):
 
         # Find parent handle -> Main Window
         parent_handle = self.driver.current_window_handle
+        # Reclaim the windows left open by the previous mail (Done and Send requests that didn't close their pop-up)
+        self.close_orphan_windows(parent_handle)
+        handles_before = set(self.driver.window_handles)
 
         # Find open window button and click it
-        self.driver.execute_script('''window.open("{}","_blank");'''.format(email_link_element))
+        self.open_window(email_link_element)
         # time.sleep(2)
 
-        # Find all handles, there should two handles after clicking open window button
-        handles = self.driver.window_handles
+        # The mail window is the handle that wasn't there before open_window
+        handles = set(self.driver.window_handles) - handles_before
 
         label, current_email, labels_check_text, subject_text, receiver_text, client, clients_check_text, \
         forward_address, email_closed = 9 * " "
-        # Switch to email body window
-        for handle in handles:
-            if handle not in parent_handle:
-                self.driver.switch_to.window(handle)
-                email_body_handle = self.driver.current_window_handle
-                try:
-                    current_email = self.get_current_email()
-                except Exception as e:
-                    current_email = ''
-                    self.log.debug("Couldn't get the email body -- " + str(e))
-                    screen_shot(self.driver, self.log)
-                    send_error_email(self.error_receiver)
-                    print(str(e))
-
-                subject_text = self.get_text(locator=self._subject_from_popup_locator,
-                                                     locator_type="css",
-                                                     refreshes=1)
-
-                sender_text = self.get_text(locator=self._sender_from_popup_locator,
-                                                    locator_type="css")
-                sender_text = sender_text[sender_text.find("<") + 1:].rstrip(">")
-
-                receiver_text = self.get_text(locator=self._receiver_from_popup_locator,
-                                                      locator_type="css")
-                receiver_text = receiver_text[receiver_text.find("<") + 1:].rstrip(">")
-
-                email_items = {'subject': subject_text, 'body': current_email,
-                               'sender': sender_text, "receiver": receiver_text}
-
-                label_email_info_dict = self.label_rules_obj.get_labels_dict(email_details=email_items)
-                labels_check_text = label_email_info_dict["check_text"]
-                # for test -> label_email_info_dict =
-                # {'check_text': "Label in text", 'labels': "test label", 'forward': "yes", 'close': "yes"}
-                start_get_client = time.time()
-                client_email_info_dict = self.clients_rules_obj.get_labels_dict(email_details=email_items)
-                clients_check_text = client_email_info_dict["check_text"]
-                stop_get_client = time.time()
-                print(f"It took {stop_get_client - start_get_client} seconds to get client")
-                # for test -> client_email_info_dict =
-                # {'check_text': "Client is ok", 'labels': "1111", 'forward': "yes", 'close': "yes"}
-                #client_email_info_dict["labels"] = "1243"  # todo delete after testing
-
-                label = self.set_label(to_fill=label_email_info_dict["labels"], is_client=False)
-
-                if label:
-                    #label_email_info_dict["labels"] = "test"  # todo delete after testing
-                    client = self.set_label(to_fill=client_email_info_dict["labels"], is_client=True)
-
-                # forward email todo create separate method for forward and close and test it
-                #label_email_info_dict["forward"] = "victor.stanescu@leaseplan.com"  # todo delete after testing
-                forward_address = label_email_info_dict["forward"]
-                if client and label and "@" in str(forward_address):
-                    self.driver.execute_script('''window.open("{}","_blank");'''.format(forward_url))
-                    handles = self.driver.window_handles
-                    for new_handle in handles:
-                        if new_handle not in [parent_handle, email_body_handle]:
-                            self.driver.switch_to.window(new_handle)
-                            self.send_Keys(forward_address, self._forward_field_locator, "css")
-                            self.send_Keys(Keys.ESCAPE, self._forward_field_locator, "css")
-                            if not self.is_element_present(self._forward_accepted_locator, "css"):
-                                forward_address = "Failed to forward"
-                                self.driver.close()
-                            else:
-                                self.element_click(self._forward_button_locator, "css")
-                                self.log.info("The email was forwarded")
-                                print("Email was forwarded")
-                else:
-                    forward_address = "Not forwarded"
-                self.driver.switch_to.window(email_body_handle)
-                #label_email_info_dict["close"] = "yes"  # todo delete after testing
-                if str(label_email_info_dict["close"]).strip().lower() == "yes" and client and \
-                        label:
-                    self.element_click(self._done_button_locator, "css") #todo uncomment for prod
-                    email_closed = "Yes"
-                    print("Email closed")
-                else:
-                    email_closed = "No"
-                    self.driver.close()
-                break
+        try:
+            # Switch to email body window
+            for handle in handles:
+                if handle != parent_handle:
+                    self.switch_to_window(handle)
+                    email_body_handle = self.driver.current_window_handle
+                    try:
+                        current_email = self.get_current_email()
+                    except Exception as e:
+                        current_email = ''
+                        self.log.debug("Couldn't get the email body -- " + str(e))
+                        screen_shot(self.driver, self.log)
+                        send_error_email(self.error_receiver)
+                        print(str(e))
+
+                    subject_text = self.get_text(locator=self._subject_from_popup_locator,
+                                                         locator_type="css",
+                                                         refreshes=1)
+
+                    sender_text = self.get_text(locator=self._sender_from_popup_locator,
+                                                        locator_type="css")
+                    sender_text = sender_text[sender_text.find("<") + 1:].rstrip(">")
+
+                    receiver_text = self.get_text(locator=self._receiver_from_popup_locator,
+                                                          locator_type="css")
+                    receiver_text = receiver_text[receiver_text.find("<") + 1:].rstrip(">")
+
+                    # Prepared once for the label and the client rules (see mail_document.py)
+                    email_items = MailDocument(subject=subject_text, body=current_email, sender=sender_text,
+                                               receiver=receiver_text)
+
+                    label_email_info_dict = self.classify("labels", self.label_rules_obj, email_items)
+                    labels_check_text = label_email_info_dict["check_text"]
+                    # for test -> label_email_info_dict =
+                    # {'check_text': "Label in text", 'labels': "test label", 'forward': "yes", 'close': "yes"}
+                    start_get_client = time.time()
+                    client_email_info_dict = self.classify("clients", self.clients_rules_obj, email_items)
+                    clients_check_text = client_email_info_dict["check_text"]
+                    stop_get_client = time.time()
+                    print(f"It took {stop_get_client - start_get_client} seconds to get client")
+                    # for test -> client_email_info_dict =
+                    # {'check_text': "Client is ok", 'labels': "1111", 'forward': "yes", 'close': "yes"}
+                    #client_email_info_dict["labels"] = "1243"  # todo delete after testing
+
+                    label = self.set_label(to_fill=label_email_info_dict["labels"], is_client=False)
+
+                    if label:
+                        #label_email_info_dict["labels"] = "test"  # todo delete after testing
+                        client = self.set_label(to_fill=client_email_info_dict["labels"], is_client=True)
+
+                    # forward email todo create separate method for forward and close and test it
+                    #label_email_info_dict["forward"] = "victor.stanescu@leaseplan.com"  # todo delete after testing
+                    forward_address = label_email_info_dict["forward"]
+                    if client and label and "@" in str(forward_address):
+                        handles_before = set(self.driver.window_handles)
+                        self.open_window(forward_url)
+                        handles = set(self.driver.window_handles) - handles_before
+                        for new_handle in handles:
+                            if new_handle not in [parent_handle, email_body_handle]:
+                                self.switch_to_window(new_handle)
+                                self.send_Keys(forward_address, self._forward_field_locator, "css")
+                                self.send_Keys(Keys.ESCAPE, self._forward_field_locator, "css")
+                                if not self.is_element_present(self._forward_accepted_locator, "css"):
+                                    forward_address = "Failed to forward"
+                                    self.close_window()
+                                else:
+                                    self.element_click(self._forward_button_locator, "css")
+                                    self.log.info("The email was forwarded")
+                                    print("Email was forwarded")
+                    else:
+                        forward_address = "Not forwarded"
+                    self.switch_to_window(email_body_handle)
+                    #label_email_info_dict["close"] = "yes"  # todo delete after testing
+                    if str(label_email_info_dict["close"]).strip().lower() == "yes" and client and \
+                            label:
+                        self.element_click(self._done_button_locator, "css") #todo uncomment for prod
+                        email_closed = "Yes"
+                        print("Email closed")
+                    else:
+                        email_closed = "No"
+                        self.close_window()
+                    break
+        except Exception:
+            # Reclaim the mail and forward windows left open by the exception. The windows of a finished mail are
+            # not closed here: the Done and Send requests may still be in flight (they are reclaimed when the next
+            # mail is opened)
+            self.close_orphan_windows(parent_handle)
+            raise
 
         # Switch back to the parent handle
-        self.driver.switch_to.window(parent_handle)
+        self.switch_to_window(parent_handle)
+
+        self.log.info("Lookup cache stats: " + str(self.get_cache_stats()))
+        if self.classification_cache is not None:
+            self.log.info("Classification cache stats: " + str(self.classification_cache.stats()))
         return {"label": label, "current_email": current_email, "labels_check_text": labels_check_text,
                 "subject_text": subject_text, "receiver_text": receiver_text, "client": client,
                 "clients_check_text": clients_check_text, "forward": forward_address, "email_closed": email_closed}
 
+    def classify(self, rule_set, rules_obj, email_items):
+        """
+        Returns the rules result (get_labels_dict) for a mail, from the classification cache if there is one
+
+        Parameters
+        ----------
+        rule_set : str
+            "labels" or "clients". Name of the rules in the cache
+        rules_obj
+            label_rules_obj or clients_rules_obj
+        email_items : dict
+            subject, body, sender and receiver of the mail
+        """
+        if self.classification_cache is None:
+            return rules_obj.get_labels_dict(email_details=email_items)
+        return self.classification_cache.classify(rule_set, rules_obj, email_items)
+
     def set_label(self, to_fill, is_client):
         """
         Fills the text in label or client field.
@@ -418,10 +463,11 @@ class WebInterations(SeleniumDriver):
             field_locator = self._label_field_locator
             locator_type = "id"
 
-        # check if labels field is empty
-        label_present = self.is_element_present(self._label_body_locator, "css", False)
+        # check if labels field is empty. Both fields are checked in one call
+        probes = self.probe_many([self._label_body_locator, self._client_choice_body_locator])
+        label_present = probes[self._label_body_locator].present
         if is_client:
-            label_present = self.is_element_present("#s2id_autogen1 > ul > li.select2-search-choice > div", "css", False)
+            label_present = probes[self._client_choice_body_locator].present
 
         if to_fill and not label_present:
             to_fill = to_fill.strip()
@@ -448,13 +494,10 @@ class WebInterations(SeleniumDriver):
 
             self.send_Keys(Keys.ESCAPE, field_locator, locator_type)  # todo comment for testing
             # Check if label was acceped (is in labels list)
-            label_accepted = self.is_element_present(locator="div.labels li.select2-search-choice",
-                                                    locatorType="css",
-                                                    take_screen_shot=False) # todo comment for testing
+            probes = self.probe_many([self._label_choice_locator, self._client_choice_locator])
+            label_accepted = probes[self._label_choice_locator].present # todo comment for testing
             if is_client:
-                label_accepted = self.is_element_present(locator="#s2id_autogen1 > ul > li.select2-search-choice",
-                                                         locatorType="css",
-                                                         take_screen_shot=False)
+                label_accepted = probes[self._client_choice_locator].present
             #self.send_Keys(Keys.BACK_SPACE, field_locator, locator_type) # todo uncomment for testing
             #self.send_Keys(Keys.BACK_SPACE, field_locator, locator_type) # todo uncomment for testing
             #self.send_Keys(Keys.ESCAPE, field_locator, locator_type)  # todo uncomment for testing
@@ -467,7 +510,8 @@ class WebInterations(SeleniumDriver):
 
     def read_mail_details(self):
         """
-        If page has loaded, it returns a dictionary that contains the e-mails details from main page
+        If page has loaded, it returns a dictionary that contains the e-mails details from main page. If the columns
+        still have different lengths after read_attempts reads, RuntimeError is raised
 
         Returns
         -------
@@ -480,38 +524,33 @@ class WebInterations(SeleniumDriver):
         """
 
         mail_details = {}
-
-        mails_subject_elements = self.wait_for_element(locator=self._subject_locator,
-                                                       locator_type="css",
-                                                       condition_text="presence_of_all_elements_located",
-                                                       check_page_load=True,
-                                                       refreshes=3)
-        mails_sender_elements = self.wait_for_element(locator=self._sender_locator,
-                                                      locator_type="css",
-                                                      condition_text="presence_of_all_elements_located",
-                                                      check_page_load=True)
-        mails_date_elements = self.wait_for_element(locator=self._date_locator,
-                                                      locator_type="css",
-                                                      condition_text="presence_of_all_elements_located",
-                                                      check_page_load=True)
-        mails_labels_elements = self.wait_for_element(locator=self._label_locator,
-                                                      locator_type="css",
-                                                      condition_text="presence_of_all_elements_located",
-                                                      check_page_load=True)
-
-        # Convert mails objects to text
-        # todo refactor get lists Use table.py try to get it in pandas
-        mails_subject_text_list = [mail_subject.text for mail_subject in mails_subject_elements]
-        mails_subject_urls = [mail_subject.get_attribute("href") for mail_subject in mails_subject_elements]
-        mails_sender_text_list = [mail_sender.text for mail_sender in mails_sender_elements]
-        mails_date_text_list = [mail_date.text for mail_date in mails_date_elements]
-        mails_label_text_list = [mail_label.text for mail_label in mails_labels_elements]
+        columns = [(self._subject_locator, "href"), (self._sender_locator, None), (self._date_locator, None),
+                   (self._label_locator, None)]
+
+        for attempt in range(self.read_attempts):
+            if attempt:
+                self.log.warning("The mails table columns have different lengths, the page is refreshed and read again")
+                self.refresh_page()
+            # The four columns are waited together, one round-trip per poll. equal_counts waits for the table to be
+            # fully rendered
+            self.wait_for_all([locator for locator, _ in columns], equal_counts=True, refreshes=3)
+            # All the columns are read in one script: they are a snapshot of the same table state, a redraw can't
+            # mix the rows of two states
+            snapshot = self.read_columns(columns)
+            counts = {len(snapshot[locator][0]) for locator, _ in columns}
+            if len(counts) == 1:
+                break
+        else:
+            # Zipping columns of different lengths would pair the subjects, dates and labels of different mails
+            screen_shot(self.driver, self.log)
+            raise RuntimeError("The mails table columns have different lengths after {} reads: {}".format(
+                self.read_attempts, [len(snapshot[locator][0]) for locator, _ in columns]))
 
         # Add detailes to the dictionary
-        mail_details["subject"] = (mails_subject_text_list, mails_subject_urls)
-        mail_details["sender"] = mails_sender_text_list
-        mail_details["date"] = mails_date_text_list
-        mail_details["label"] = mails_label_text_list
+        mail_details["subject"] = snapshot[self._subject_locator]
+        mail_details["sender"] = snapshot[self._sender_locator][0]
+        mail_details["date"] = snapshot[self._date_locator][0]
+        mail_details["label"] = snapshot[self._label_locator][0]
 
         return mail_details
         # mails_details = {"subjects":(mails_subject_text_list, mails_subject_elements),
@@ -552,7 +591,7 @@ class WebInterations(SeleniumDriver):
 
 
     def close_browser(self):
-        self.driver.close()
+        self.close_window()
 
 
 
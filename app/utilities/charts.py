@@ -0,0 +1,162 @@
+"""
+Renders the report charts with the object oriented matplotlib API (Figure + Agg canvas). pyplot is not used, so
+there is no global state and several charts can be rendered in parallel. A chart is redrawn only when its counts or
+title changed.
+
+Example:
+    renderer = ChartRenderer(pies_folder)
+    jobs = [ChartJob(df["status"].value_counts(), "Labels status", "pie_PT.png"),
+            ChartJob(df["label"].value_counts(), "Labels", "pie_PT_label.png")]
+    paths = renderer.render_many(jobs, processes=2)
+"""
+import hashlib
+import json
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+ChartJob = namedtuple("ChartJob", ["counts", "title", "file_name"])
+ChartJob.__doc__ = """
+A pie chart to render. counts is a mapping (or a pandas Series from value_counts) from label to count. file_name
+is relative to the renderer output folder
+"""
+
+# Colors of the matplotlib "ggplot" style, used before by CreateReport.create_pie
+GGPLOT_COLORS = ["#E24A33", "#348ABD", "#988ED5", "#777777", "#FBC15E", "#8EBA42", "#FFB5B8"]
+
+
+def _normalize_counts(counts):
+    """
+    Returns the counts as a list of (str label, int count) pairs, keeping the order. Zero counts (the unused
+    categories of a categorical column) are dropped, they would be empty pie slices
+    """
+    return [(str(label), int(count)) for label, count in counts.items() if count]
+
+
+def chart_key(counts_items, title):
+    """Returns the hash of the data shown in a chart"""
+    data = json.dumps([title, counts_items], ensure_ascii=False)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def render_pie(counts_items, title, path):
+    """
+    Draws a pie chart and saves it as png. Module level function so it can run in a process pool
+
+    Parameters
+    ----------
+    counts_items : list
+        (label, count) pairs
+    title : str
+        Pie title
+    path : str
+        Where the png is saved
+
+    Returns
+    -------
+        Pie path
+    """
+    # Figure + Agg canvas need no backend, the process-wide matplotlib backend is left as it is
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot(1, 1, 1)
+    labels = [label for label, _ in counts_items]
+    values = [count for _, count in counts_items]
+    colors = [GGPLOT_COLORS[index % len(GGPLOT_COLORS)] for index in range(len(values))]
+    axes.pie(values, labels=labels, startangle=0, autopct="%1.1f%%", colors=colors)
+    axes.set_title(title)
+    axes.axis("off")
+    figure.savefig(path)
+    return path
+
+
+class ChartRenderer(object):
+    """
+    Renders charts in a folder and remembers the hash of the data of every chart, so unchanged charts are not
+    redrawn
+
+    Parameters
+    ----------
+    output_folder : str
+        Folder where the charts are saved. It is created if it doesn't exist
+    index_file_name : str
+        Name of the json file that stores the data hash of every chart
+    """
+
+    def __init__(self, output_folder, index_file_name="charts_index.json"):
+        self.output_folder = output_folder
+        self.index_path = os.path.join(output_folder, index_file_name)
+        self.rendered = 0
+        self.reused = 0
+        self._index = None
+
+    def _load_index(self):
+        if self._index is None:
+            self._index = {}
+            if os.path.exists(self.index_path):
+                try:
+                    with open(self.index_path) as index_file:
+                        self._index = json.load(index_file)
+                except (ValueError, OSError):
+                    self._index = {}
+        return self._index
+
+    def _save_index(self):
+        temporary_path = self.index_path + ".tmp"
+        with open(temporary_path, "w") as index_file:
+            json.dump(self._index, index_file, indent=1)
+        os.replace(temporary_path, self.index_path)
+
+    def _pending(self, jobs):
+        """Returns the jobs that must be drawn as (counts_items, title, path, key, file_name) tuples"""
+        index = self._load_index()
+        pending = []
+        for job in jobs:
+            counts_items = _normalize_counts(job.counts)
+            key = chart_key(counts_items, job.title)
+            path = os.path.join(self.output_folder, job.file_name)
+            if index.get(job.file_name) == key and os.path.exists(path):
+                self.reused += 1
+                continue
+            pending.append((counts_items, job.title, path, key, job.file_name))
+        return pending
+
+    def render_pie(self, counts, title, file_name):
+        """
+        Renders one pie chart (if its data changed) and returns its path
+        """
+        return self.render_many([ChartJob(counts, title, file_name)])[0]
+
+    def render_many(self, jobs, processes=None):
+        """
+        Renders several charts in one pass. The charts whose data didn't change are not redrawn
+
+        Parameters
+        ----------
+        jobs : list
+            ChartJob tuples
+        processes : int
+            Render the charts in a pool with this number of processes. None renders them in this process
+
+        Returns
+        -------
+            The paths of the charts, in the order of the jobs
+        """
+        os.makedirs(self.output_folder, exist_ok=True)
+        pending = self._pending(jobs)
+        if processes and len(pending) > 1:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                list(executor.map(render_pie, *zip(*[(items, title, path) for items, title, path, _, _
+                                                     in pending])))
+        else:
+            for counts_items, title, path, _, _ in pending:
+                render_pie(counts_items, title, path)
+        if pending:
+            for _, _, _, key, file_name in pending:
+                self._index[file_name] = key
+            self._save_index()
+            self.rendered += len(pending)
+        return [os.path.join(self.output_folder, job.file_name) for job in jobs]
@@ -0,0 +1,224 @@
+"""
+Persistent cache of the rules results (get_labels_dict) keyed by the normalized mail. Many mails are automated
+notifications with the same sender, subject and body; their labels and clients are found once.
+
+The key is a hash of the normalized subject, body, sender and receiver and of the rules version. The version is
+the modification time and size of the rules workbook, so when a workbook changes its old results are not used and
+are deleted. The cache is an LRU bounded to max_entries, saved in a SQLite file (it can be shared by several
+processes).
+
+Example:
+    cache = ClassificationCache("classification_cache.sqlite",
+                                rules_files={"labels": "Rotulos.xlsx", "clients": "Clientes.xlsx"})
+    result = cache.classify("labels", label_rules_obj, email_items)
+    print(cache.stats())
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+import app.utilities.custom_logger as cl
+
+# Attributes where the rules objects can keep the path of their workbook
+_RULES_FILE_ATTRIBUTES = ("rules_file", "file_path", "excel_file", "path", "file")
+
+
+def normalize_text(text):
+    """Lower case text with the whitespace collapsed"""
+    if text is None:
+        return ""
+    return " ".join(str(text).split()).casefold()
+
+
+def mail_key(email_items, version):
+    """
+    Returns the cache key of a mail
+
+    Parameters
+    ----------
+    email_items : dict
+        {"subject": .., "body": .., "sender": .., "receiver": ..} as passed to get_labels_dict
+    version : str
+        Rules version
+    """
+    fields = sorted((name, normalize_text(value)) for name, value in email_items.items())
+    data = json.dumps([version, fields], ensure_ascii=False)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def file_version(path):
+    """Returns the version of a rules workbook (modification time and size) or None if it doesn't exist"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return "{}:{}".format(stat.st_mtime_ns, stat.st_size)
+
+
+def rules_file_of(rules_obj):
+    """Returns the workbook path of a rules object, if it has one in a known attribute"""
+    for attribute in _RULES_FILE_ATTRIBUTES:
+        value = getattr(rules_obj, attribute, None)
+        if isinstance(value, str) and os.path.isfile(value):
+            return value
+    return None
+
+
+class ClassificationCache(object):
+    """
+    LRU cache of the rules results
+
+    Parameters
+    ----------
+    path : str
+        SQLite file. None keeps the cache in memory
+    rules_files : dict
+        {rule set name: workbook path}. A rule set without a workbook is looked up on the rules object
+        (rules_file_of); if none is found, its results are not cached
+    max_entries : int
+        Maximum number of results kept. The least recently used are evicted
+    """
+
+    log = cl.customLogger(logging.INFO)
+
+    def __init__(self, path=None, rules_files=None, max_entries=20000):
+        self.path = path
+        self.rules_files = dict(rules_files or {})
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.uncached = 0
+
+        if path:
+            folder = os.path.dirname(os.path.abspath(path))
+            os.makedirs(folder, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path or ":memory:", isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, rule_set TEXT, "
+                                 "version TEXT, result TEXT, last_used INTEGER)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self._clock = self._connection.execute("SELECT COALESCE(MAX(last_used), 0) FROM entries").fetchone()[0]
+        self._count = self._connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        self._versions = {}
+
+    def _version(self, rule_set, rules_obj):
+        """Returns the current version of a rule set and deletes its results of other versions"""
+        rules_file = self.rules_files.get(rule_set)
+        if rules_file is None:
+            rules_file = rules_file_of(rules_obj)
+            if rules_file is None:
+                return None
+            self.rules_files[rule_set] = rules_file
+        version = file_version(rules_file)
+        if version is not None and self._versions.get(rule_set) != version:
+            deleted = self._connection.execute("DELETE FROM entries WHERE rule_set = ? AND version != ?",
+                                               (rule_set, version)).rowcount
+            if deleted:
+                self._count -= deleted
+                self.invalidations += deleted
+                self.log.info("Rules {} changed, {} cached results deleted".format(rule_set, deleted))
+            self._versions[rule_set] = version
+        return version
+
+    def _key(self, rule_set, rules_obj, email_items):
+        """Returns (version, key) of a mail. (None, None) if the rule set has no workbook to version it"""
+        with self._lock:
+            version = self._version(rule_set, rules_obj)
+        if version is None:
+            return None, None
+        return version, mail_key(email_items, rule_set + "|" + version)
+
+    def _get(self, key):
+        with self._lock:
+            row = self._connection.execute("SELECT result FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._clock += 1
+            self._connection.execute("UPDATE entries SET last_used = ? WHERE key = ?", (self._clock, key))
+            return json.loads(row[0])
+
+    def _put(self, key, rule_set, version, result):
+        with self._lock:
+            self._clock += 1
+            data = json.dumps(result, default=str)
+            updated = self._connection.execute("UPDATE entries SET result = ?, last_used = ? WHERE key = ?",
+                                               (data, self._clock, key)).rowcount
+            if updated:
+                return
+            # OR REPLACE: another process can insert the same key between the update and the insert
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries (key, rule_set, version, result, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, rule_set, version, data, self._clock))
+            self._count += 1
+            if self._count > self.max_entries:
+                # Other processes sharing the file change it too: count again before evicting
+                self._count = self._connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            if self._count > self.max_entries:
+                # Evict a tenth at once, so the delete doesn't run after every put
+                excess = self._count - self.max_entries + max(1, self.max_entries // 10)
+                deleted = self._connection.execute(
+                    "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY last_used LIMIT ?)",
+                    (excess,)).rowcount
+                self._count -= deleted
+                self.evictions += deleted
+
+    def get(self, rule_set, rules_obj, email_items):
+        """Returns the cached result for a mail or None"""
+        version, key = self._key(rule_set, rules_obj, email_items)
+        return None if key is None else self._get(key)
+
+    def put(self, rule_set, rules_obj, email_items, result):
+        """Saves the result for a mail. The least recently used results are evicted if the cache is full"""
+        version, key = self._key(rule_set, rules_obj, email_items)
+        if key is not None:
+            self._put(key, rule_set, version, result)
+
+    def classify(self, rule_set, rules_obj, email_items):
+        """
+        Returns rules_obj.get_labels_dict(email_details=email_items), from the cache if the mail was classified
+        before with the same rules. The results of a rule set without a workbook (or whose workbook is missing)
+        are not cached and counted as uncached
+
+        Parameters
+        ----------
+        rule_set : str
+            Name of the rule set (e.g. "labels", "clients")
+        rules_obj
+            The rules object
+        email_items : dict
+            The mail fields
+        """
+        version, key = self._key(rule_set, rules_obj, email_items)
+        if key is None:
+            self.uncached += 1
+            return rules_obj.get_labels_dict(email_details=email_items)
+        result = self._get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = rules_obj.get_labels_dict(email_details=email_items)
+        self._put(key, rule_set, version, result)
+        return result
+
+    def stats(self):
+        """Returns the hit/miss counters of the cache"""
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": self._count, "evictions": self.evictions, "invalidations": self.invalidations,
+                "uncached": self.uncached}
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM entries")
+            self._count = 0
+
+    def close(self):
+        self._connection.close()
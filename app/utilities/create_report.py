@@ -1,7 +1,6 @@
-import pandas as pd
 import os
+from collections import OrderedDict
 from shutil import copyfile
-import matplotlib.pyplot as plt
 from datetime import date
 import re
 from app.utilities.database import CursorFromConnectionFromPool
@@ -9,6 +8,16 @@ from app.utilities.database import Database
 import logging
 from app.utilities import custom_logger as cl
 from app.utilities import nice_tools
+from app.utilities.lazy_import import lazy_import
+from app.utilities.charts import ChartJob, ChartRenderer
+from app.utilities.report_filter import ReportFilter
+from app.utilities.report_queries import COUNT_COLUMNS, ReportQueries, ReportSummary, counts_to_html
+from app.utilities.report_diff import ReportIndex, frame_keys, status_updates, update_workbook
+from app.utilities.report_schema import drop_hidden, load_report
+from app.utilities.last_record import LastRecordIndex, newer_record, newest_record
+
+# Imported on first use. A labeling run that doesn't write reports doesn't import it
+pd = lazy_import("pandas")
 
 
 class CreateReport(object):
@@ -27,6 +36,9 @@ class CreateReport(object):
         Path to previous report
     sheet_name : str
         Name of the reports sheet
+    db_table : str
+        Table the report is exported to (excel_to_db). If set, the pies and the summary tables are counted in the
+        database (ReportSummary) instead of loading the report
 
     Methods
     -------
@@ -42,17 +54,28 @@ class CreateReport(object):
         Converts data to  a html table
     filter_report()
         Filters a dataframe by a given condition.
+    filter_report_many()
+        Filters a dataframe by several conditions in one pass
     get_info_from_filename()
         Return the text between "_" and "." from a report filename
     create_pie()
         Creates a pie graph for a given field
+    create_pies()
+        Creates the pie graphs for several fields in one pass
+    summary_html()
+        Returns the html tables of the fields counts
     """
 
     log = cl.customLogger(logging.INFO)
     _dates_column = "date"
     _subject_column = "subject"
+    # Length of the mail bodies kept in df_today, the report file keeps the full bodies. None (default) loads the
+    # full bodies; set it (e.g. 300) only where df_today is filtered and counted, not shown or mailed
+    today_body_max_chars = None
+    # {table: True if it has the unique index on row_key}, checked once per process by write_data_to_db
+    _row_key_tables = {}
 
-    def __init__(self, file_path, last_report_path=None, sheet_name="Sheet1"):
+    def __init__(self, file_path, last_report_path=None, sheet_name="Sheet1", db_table=None):
         """
         Creates a report instance
 
@@ -64,6 +87,8 @@ class CreateReport(object):
             Path to previous report
         sheet_name : str
             Name of the reports sheet
+        db_table : str
+            Table of the exported report. The daily summary is read from it (see db_summary)
         """
         self.file_path = file_path
         self.pies_folder = os.path.join(os.path.dirname(self.file_path), "Pies")
@@ -71,23 +96,42 @@ class CreateReport(object):
         self.last_report_path = last_report_path
         self.backup_excel_file = self.file_path[:self.file_path.rfind(".")] + "_backup.xlsx"
         self.sheet_name = sheet_name
+        self.db_table = db_table.strip('"') if db_table else None
 
-        self.df_today = None
-        self.df_last_report = pd.DataFrame()
+        # The reports are loaded on first use. The last date and subject come from the last record index
+        self._df_today = None
+        self._df_last_report = None
+        self._report_filter = None
 
-        if os.path.exists(self.file_path):
-            self.df_today = pd.read_excel(self.file_path)  # todo sort
-            self.df_today.sort_values("date", ascending=False, inplace=True)
-            self.df_today.reset_index(drop=True, inplace=True)
-        elif self.last_report_path is not None:
+        if not os.path.exists(self.file_path) and self.last_report_path is not None:
             print("Today report dosen't exist. It will be created: " + self.file_path)
             if os.path.exists(self.last_report_path):
-                self.df_last_report = pd.read_excel(self.last_report_path)
-                self.df_last_report.sort_values("date", ascending=False, inplace=True)
-                self.df_last_report.reset_index(drop=True, inplace=True)
                 # todo send email when here
                 print("Raport for today doesn't exists")
 
+    @property
+    def df_today(self):
+        """
+        Today report, sorted by date (newest first), with the bodies truncated to today_body_max_chars if it is set.
+        Loaded on first use, None if it doesn't exist. It is not written back to the report file
+        """
+        if self._df_today is None and os.path.exists(self.file_path):
+            self._df_today = load_report(self.file_path, body_max_chars=self.today_body_max_chars)
+        return self._df_today
+
+    @df_today.setter
+    def df_today(self, df):
+        self._df_today = df
+
+    @property
+    def df_last_report(self):
+        """Previous report without the mail bodies. Loaded on first use, empty if it doesn't exist"""
+        if self._df_last_report is None:
+            self._df_last_report = pd.DataFrame()
+            if self.last_report_path is not None and os.path.exists(self.last_report_path):
+                self._df_last_report = load_report(self.last_report_path, drop_body=True)
+        return self._df_last_report
+
     def backup_report(self):
         """
         Makes a backup for the current report
@@ -104,19 +148,24 @@ class CreateReport(object):
 
     def get_last_email_date_and_subj(self):
         """
-        Returns the date and the subject from the previous report
+        Returns the date and the subject from the previous report. They are read from the last record index (see
+        last_record.py), the reports are not loaded
 
         Returns
         -------
         The date and the subject from the previous report
         """
-        if self.df_today is not None and not self.df_today.empty:
-            last_mail_date = str(self.df_today.at[0, self._dates_column])
-            last_mail_subject = self.df_today.at[0, self._subject_column]
-            return [last_mail_subject, last_mail_date]
-        elif self.df_last_report is not None and not self.df_last_report.empty:
-            last_mail_date = str(self.df_last_report.at[0, self._dates_column])
-            last_mail_subject = self.df_last_report.at[0, self._subject_column]
+        if os.path.exists(self.file_path):
+            record = LastRecordIndex(self.file_path).get()
+            if record is not None:
+                return [record.subject, record.date]
+        elif self.last_report_path is not None and os.path.exists(self.last_report_path):
+            record = LastRecordIndex(self.last_report_path).get()
+        else:
+            record = None
+        if record is not None:
+            last_mail_date = record.date
+            last_mail_subject = record.subject
             print("Couldn't find the report for today. the report from last day will"
                   " be used for start processing time: " + last_mail_date)
             return [last_mail_subject, last_mail_date]
@@ -127,7 +176,9 @@ class CreateReport(object):
 
     def append_df_to_excel(self, data):
         """
-        Appends a dataframe to excel file and saves it. Used in write_data_to_excel method
+        Appends a dataframe to excel file and saves it. Used in write_data_to_excel method. Only the rows whose key
+        (message id or sender + date + subject, see report_diff.py) is not in the report are appended. For the
+        others, the changed status fields are updated
 
         Parameters
         ----------
@@ -138,9 +189,18 @@ class CreateReport(object):
         -------
         None
         """
-        result = pd.concat([self.df_today, data], ignore_index=True)
-        result.drop_duplicates(inplace=True)
-        result.to_excel(self.file_path, index=False)
+        report_index = ReportIndex.load(self.file_path)
+        last_record_index = LastRecordIndex(self.file_path)
+        previous_record = last_record_index.get()
+        new_rows, existing_rows, new_keys = report_index.split(data)
+        changes = status_updates(existing_rows, report_index.positions(frame_keys(existing_rows)))
+        updated = update_workbook(self.file_path, new_rows, changes, self.sheet_name, report_index.rows)
+        # The report changed on disk, it is loaded again on next use
+        self.df_today = None
+        report_index.add(new_keys)
+        report_index.save()
+        last_record_index.save(newer_record(previous_record, newest_record(new_rows)))
+        self.log.info("Report {}: {} new rows, {} updated rows".format(self.file_path, len(new_keys), updated))
 
     def write_data_to_excel(self, data=None):
         """
@@ -158,21 +218,62 @@ class CreateReport(object):
         if os.path.exists(self.file_path):
             self.append_df_to_excel(data)
         else:
-            data.to_excel(self.file_path, index=False)
+            report_index = ReportIndex(self.file_path)
+            new_rows, _, new_keys = report_index.split(data)
+            new_rows.to_excel(self.file_path, index=False)
+            report_index.add(new_keys)
+            report_index.save()
+            LastRecordIndex(self.file_path).update(new_rows)
+
+    def write_data_to_db(self, data, db_table, db_table_columns=None):
+        """
+        Writes report rows to a table. If the table has the unique index on row_key (backfill.py --create-schema),
+        the rows are written like backfill.py: every row gets its key, the report date and the country (from the
+        report file name), and a row already in the table only gets the new status fields. Otherwise the rows are
+        inserted like before, in db_table_columns. The index is checked once per process and table
 
-    def write_data_to_db(self, data, db_table, db_table_columns):
-        try:
-            assert (data.shape[1] == len(db_table_columns.split(","))), "Number of input columns is not equal to db " \
-                                                                        "table columns"
-            for row in range(data.shape[0]):
-                values = ", ".join(data.iloc[row].values.astype(str))
-                insert_statement = f"INSERT INTO {db_table} ({db_table_columns}) VALUES ({values})"
-                with CursorFromConnectionFromPool() as cursor:
-                    cursor.execute(insert_statement)
-        except Exception as e:
-            self.log.error("Failed to add to db: " + repr(e))
+        Parameters
+        ----------
+        data : pandas dataframe
+            Report rows
+        db_table : str
+            Table name. Surrounding double quotes are removed
+        db_table_columns : str
+            Comma separated table columns of the data columns, used by tables without row_key. None uses the columns
+            of backfill.COLUMNS
 
-    def excel_to_db(self, db_table, db_table_columns, error_receiver_address='victor.stanescu@leaseplan.com'):
+        Returns
+        -------
+            (inserted, updated)
+        """
+        from app.main_app.backfill import has_row_key_index, insert_rows, plain_rows, report_file_info, report_rows, \
+            write_rows
+
+        table = db_table.strip('"')
+        report_file = report_file_info(self.file_path)
+        with CursorFromConnectionFromPool() as cursor:
+            if table not in self._row_key_tables:
+                self._row_key_tables[table] = has_row_key_index(cursor, table)
+                if not self._row_key_tables[table]:
+                    self.log.warning("{} has no unique index on row_key, the rows are inserted without keys. Run "
+                                     "backfill.py --create-schema to update them instead".format(table))
+            if self._row_key_tables[table] and report_file is not None:
+                rows = report_rows(data, report_file.country, report_file.date)
+                inserted, updated = write_rows(cursor, table, rows)
+            else:
+                columns = None
+                if db_table_columns:
+                    columns = [column.strip().strip('"') for column in db_table_columns.split(",")]
+                columns, rows = plain_rows(data, columns)
+                inserted, updated = insert_rows(cursor, table, columns, rows), 0
+        self.log.info("{} rows written to {}: {} inserted, {} updated".format(len(rows), table, inserted, updated))
+        return inserted, updated
+
+    def excel_to_db(self, db_table, db_table_columns=None, error_receiver_address='victor.stanescu@leaseplan.com'):
+        """
+        Writes the report to a table (see write_data_to_db). If the table has the row_key index, running it again
+        for the same report updates the status fields of the rows instead of inserting them again
+        """
         try:
             dt = pd.read_excel(self.file_path, sheet_name=self.sheet_name)
         except Exception as e:
@@ -180,25 +281,10 @@ class CreateReport(object):
             raise
         try:
             Database.initialise()
-            excel_columns = dt.columns.values
-            assert (len(excel_columns == len(db_table_columns.split(",")))), "Number of input columns is not equal " \
-                                                                             "to db table columns"
-            excel_columns_text = ", ".join(excel_columns)
-            # print("excel columns: " + excel_columns_text)
-            # print("Db columns: " + db_table_columns)
-            for row in range(dt.shape[0]):
-                clean_row = [i.replace("'", "''") for i in dt.iloc[row].values.astype(str)]
-                values = [f"'{i}'" for i in clean_row]
-                #print("No of values: " + str(len(values)))
-                #print("No of columns: " + str(len(db_table_columns.split(","))))
-                values = ", ".join(values)
-                insert_statement = f'INSERT INTO "{db_table}" ({db_table_columns}) VALUES ({values})'
-                with CursorFromConnectionFromPool() as cursor:
-                    cursor.execute(insert_statement)
+            self.write_data_to_db(dt, db_table, db_table_columns)
         except Exception as e:
             self.log.error("Failed to add to db: " + repr(e))
             print("Failed to add to db: " + repr(e))
-            print("SQL: " + insert_statement)
             nice_tools.send_error_email(error_receiver_address)
 
 
@@ -214,7 +300,7 @@ class CreateReport(object):
         -------
             Converted html table
         """
-        return df.to_html()
+        return drop_hidden(df).to_html()
 
     def filter_report(self, filter_condition, add_to_index=None):
         """
@@ -223,16 +309,31 @@ class CreateReport(object):
         ----------
         filter_condition : str
             Condition for filtering. Check https://pbpython.com/excel-filter-edit.html for info about creating string
+            (e.g. '["status"] == "Label was added"'). DataFrame.query syntax can be used too (see report_filter.py)
         add_to_index
             If dataframe has a header, a number of rows can be skiped by this number
         Returns
         -------
             Filtered dataframe
         """
-        filtered_df = eval("self.df_today.loc[self.df_today" + filter_condition + "]")
-        if add_to_index:
-            filtered_df.index = filtered_df.index + add_to_index
-        return filtered_df
+        return self.report_filter().filter(filter_condition, add_to_index)
+
+    def filter_report_many(self, filter_conditions, add_to_index=None):
+        """
+        Filters a dataframe by several conditions. Equality conditions on the same column are evaluated in one pass
+        Returns
+        -------
+            List of filtered dataframes, in the order of the conditions
+        """
+        return self.report_filter().filter_many(filter_conditions, add_to_index)
+
+    def report_filter(self):
+        """
+        Returns the ReportFilter of today report. It is recreated if df_today was replaced
+        """
+        if self._report_filter is None or self._report_filter.df is not self.df_today:
+            self._report_filter = ReportFilter(self.df_today)
+        return self._report_filter
 
     @staticmethod
     def get_info_from_filename(file):
@@ -249,6 +350,37 @@ class CreateReport(object):
         base_name = os.path.basename(file)
         return base_name[base_name.find("_") + 1:base_name.find(".")]
 
+    def db_summary(self, fields=None):
+        """
+        Returns the ReportSummary of db_table and the (report date, country) of this report, read from the file
+        name. None if there is no db_table or the file name is not a report name: the summary is then counted on
+        df_today. The report must be exported (excel_to_db) before
+
+        Parameters
+        ----------
+        fields : dict
+            {report_field: title}, fields of report_queries.COUNT_COLUMNS. Default all of them
+        """
+        if self.db_table is None:
+            return None
+        from app.main_app.backfill import report_file_info
+
+        report_file = report_file_info(self.file_path)
+        if report_file is None:
+            self.log.warning("The report date can't be read from {}, the summary is counted on the report".format(
+                self.file_path))
+            return None
+        return ReportSummary(ReportQueries(self.db_table), self.pies_folder, fields), report_file.date, \
+            report_file.country
+
+    def field_counts(self, report_field):
+        """Returns the number of mails for every value of a field, from db_table if it is set"""
+        summary = self.db_summary()
+        if summary is None:
+            return self.df_today[report_field].value_counts()
+        report_summary, report_date, country = summary
+        return report_summary.queries.counts(report_field, report_date=report_date, country=country)
+
     def create_pie(self, report_field="status", title="Labels status"):
         """
         Creates a pie graph for a given field
@@ -262,18 +394,55 @@ class CreateReport(object):
         -------
             Pie path
         """
-        plt.style.use("ggplot")
-        plt.clf()
-        self.df_today[report_field].value_counts().plot(kind='pie', startangle=0, title=title, autopct='%1.1f%%')
-        plt.axis("off")
-        # plt.show()
-        if not os.path.exists(self.pies_folder):
-            os.mkdir(self.pies_folder)
         date_and_country = self.get_info_from_filename(self.file_path)
         pie_name = "pie_" + date_and_country + ".png"
-        pie_path = os.path.join(self.pies_folder, pie_name)
-        plt.savefig(pie_path)
-        return pie_path
+        return ChartRenderer(self.pies_folder).render_pie(self.field_counts(report_field), title, pie_name)
+
+    def pie_job(self, report_field="status", title="Labels status", pie_name=None):
+        """
+        Returns the ChartJob for a field. The jobs of several reports (countries) can be rendered together with
+        ChartRenderer.render_many
+        """
+        if pie_name is None:
+            pie_name = "pie_" + self.get_info_from_filename(self.file_path) + "_" + report_field + ".png"
+        return ChartJob(self.field_counts(report_field), title, pie_name)
+
+    def create_pies(self, fields, processes=None):
+        """
+        Creates the pie graphs for several fields in one pass. Pies whose counts didn't change are not redrawn
+        Parameters
+        ----------
+        fields : dict
+            {report_field: title}
+        processes : int
+            Number of processes used for drawing. None draws in this process
+        Returns
+        -------
+            {report_field: pie path}
+        """
+        summary = self.db_summary(fields)
+        if summary is not None:
+            report_summary, report_date, country = summary
+            return report_summary.pies(report_date, country, processes)
+        jobs = [self.pie_job(field, title) for field, title in fields.items()]
+        paths = ChartRenderer(self.pies_folder).render_many(jobs, processes)
+        return dict(zip(fields, paths))
+
+    def summary_html(self, fields=None):
+        """
+        Returns the html tables of the fields counts (the daily mail summary)
+        Parameters
+        ----------
+        fields : dict
+            {report_field: title}. Default report_queries.COUNT_COLUMNS
+        """
+        fields = fields or COUNT_COLUMNS
+        summary = self.db_summary(fields)
+        if summary is not None:
+            report_summary, report_date, country = summary
+            return report_summary.html(report_date, country)
+        return counts_to_html(OrderedDict((title, self.df_today[field].value_counts())
+                                          for field, title in fields.items()))
 
 
 class RecoverReport:
@@ -320,8 +489,11 @@ class TablesUtil(object):
         return new_df
 
     def append_data(self, current_df):
-        result = pd.concat([self.all_data, current_df], ignore_index=True)
-        result.drop_duplicates(inplace=True)
+        """
+        Appends the rows of current_df whose key (see report_diff.py) is not in all_data
+        """
+        new_rows = ReportIndex.from_frame(self.all_data).new_rows(current_df)
+        result = pd.concat([self.all_data, new_rows], ignore_index=True)
         return result
 
 
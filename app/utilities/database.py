@@ -4,7 +4,10 @@
 
 # Enter steps here
 
-from psycopg2 import pool
+from app.utilities.lazy_import import lazy_import
+
+# psycopg2 is imported when the first connection pool is created
+pool = lazy_import("psycopg2.pool")
 
 
 
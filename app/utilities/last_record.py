@@ -0,0 +1,168 @@
+"""
+Last record (newest mail) of a report, without loading the report. CreateReport needs only the date and subject of
+the newest mail to know where to stop on the messages page; reading and sorting the whole xlsx for that takes
+seconds on a large report.
+
+The newest record is saved next to the report in "<report>.last.json" every time the report is written. The
+sidecar stores the modification time and size of the report; if the report was changed by someone else, the newest
+record is found with a streaming (read only) openpyxl pass over the report and the sidecar is rewritten.
+"""
+import json
+import os
+from collections import namedtuple
+
+from app.utilities.report_schema import DATE_COLUMN, parse_report_date, parse_report_dates
+
+LastRecord = namedtuple("LastRecord", ["subject", "date"])
+LastRecord.__doc__ = """
+Newest mail of a report. date is the text of the date cell, as str(df.at[0, "date"]) returned it
+"""
+
+_SUBJECT_COLUMN = "subject"
+
+
+def _date_text(value):
+    if value is None or value != value:  # None or NaN
+        return None
+    return str(value)
+
+
+def _cell_value(value):
+    return None if value != value else value  # NaN
+
+
+def newest_record(df):
+    """
+    Returns the LastRecord of a dataframe (the row with the biggest date, the first one if several rows have it) or
+    None if the dataframe is empty
+    """
+    if df is None or df.empty or DATE_COLUMN not in df.columns:
+        return None
+    parsed = parse_report_dates(df[DATE_COLUMN])
+    if parsed.notna().any():
+        position = int(parsed.reset_index(drop=True).idxmax())
+    else:
+        position = int(df[DATE_COLUMN].astype(str).reset_index(drop=True).idxmax())
+    row = df.iloc[position]
+    subject = row[_SUBJECT_COLUMN] if _SUBJECT_COLUMN in df.columns else None
+    return LastRecord(_cell_value(subject), _date_text(row[DATE_COLUMN]))
+
+
+def scan_report(report_path):
+    """
+    Finds the newest record of a report with a read only openpyxl pass over the first sheet. The rows are streamed,
+    so the memory used doesn't depend on the report size
+
+    Returns
+    -------
+        LastRecord or None if the report has no rows
+    """
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(report_path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if not header or DATE_COLUMN not in header:
+            return None
+        date_position = header.index(DATE_COLUMN)
+        subject_position = header.index(_SUBJECT_COLUMN) if _SUBJECT_COLUMN in header else None
+
+        best, best_key = None, None
+        for row in rows:
+            if date_position >= len(row) or row[date_position] is None:
+                continue
+            value = row[date_position]
+            parsed = parse_report_date(value)
+            # Parsed dates are always newer than the dates that can't be parsed (sort_report puts those last)
+            key = (1, parsed, "") if parsed is not None else (0, None, str(value))
+            if best_key is None or _newer(key, best_key):
+                subject = row[subject_position] if subject_position is not None and subject_position < len(row) \
+                    else None
+                best, best_key = LastRecord(subject, _date_text(value)), key
+        return best
+    finally:
+        workbook.close()
+
+
+def _record_key(record):
+    parsed = parse_report_date(record.date)
+    return (1, parsed, "") if parsed is not None else (0, None, str(record.date))
+
+
+def newer_record(record, other):
+    """Returns the newest of two LastRecords (a record is newer than None)"""
+    if record is None or record.date is None:
+        return other
+    if other is None or other.date is None:
+        return record
+    return record if not _newer(_record_key(other), _record_key(record)) else other
+
+
+def _newer(key, other):
+    if key[0] != other[0]:
+        return key[0] > other[0]
+    if key[0]:
+        return key[1] > other[1]
+    return key[2] > other[2]
+
+
+class LastRecordIndex(object):
+    """
+    The newest record of a report, saved in a sidecar file
+
+    Parameters
+    ----------
+    report_path : str
+        Report path
+    """
+
+    def __init__(self, report_path):
+        self.report_path = report_path
+        self.index_path = report_path + ".last.json"
+
+    def _report_stamp(self):
+        stat = os.stat(self.report_path)
+        return "{} {}".format(stat.st_mtime_ns, stat.st_size)
+
+    def read(self):
+        """Returns the saved LastRecord or None if there is no sidecar or it is outdated"""
+        if not os.path.exists(self.index_path) or not os.path.exists(self.report_path):
+            return None
+        try:
+            with open(self.index_path, encoding="utf-8") as index_file:
+                data = json.load(index_file)
+        except (ValueError, OSError):
+            return None
+        if data.get("stamp") != self._report_stamp():
+            return None
+        return LastRecord(data.get("subject"), data.get("date"))
+
+    def save(self, record):
+        """Saves the newest record. Must be called after the report file was written"""
+        data = {"stamp": self._report_stamp(), "subject": None, "date": None}
+        if record is not None:
+            data["subject"] = None if record.subject is None else str(record.subject)
+            data["date"] = record.date
+        temporary_path = self.index_path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as index_file:
+            json.dump(data, index_file, ensure_ascii=False)
+        os.replace(temporary_path, self.index_path)
+
+    def update(self, df):
+        """Saves the newest record of df, the report that was just written"""
+        self.save(newest_record(df))
+
+    def get(self):
+        """
+        Returns the newest record of the report: from the sidecar or, if it is outdated, from a streaming pass over
+        the report (the sidecar is then rewritten). None if the report doesn't exist or has no rows
+        """
+        if not os.path.exists(self.report_path):
+            return None
+        record = self.read()
+        if record is not None:
+            return record if record.date is not None else None
+        record = scan_report(self.report_path)
+        self.save(record)
+        return record
@@ -0,0 +1,67 @@
+"""
+Lazy imports for the heavy dependencies (pandas, matplotlib, psycopg2, win32com). The module is imported the first
+time one of its attributes is used, so runs that don't need it don't pay for the import.
+
+Example:
+    pd = lazy_import("pandas")
+    ...
+    df = pd.DataFrame()  # pandas is imported here
+"""
+import importlib
+import os
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    Placeholder that imports the real module on first attribute access
+
+    Parameters
+    ----------
+    name : str
+        Full name of the module (e.g. "matplotlib.pyplot")
+    before_import : callable
+        Called once, right before the module is imported
+    """
+
+    def __init__(self, name, before_import=None):
+        super().__init__(name)
+        self.__dict__["_lazy_before_import"] = before_import
+        self.__dict__["_lazy_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_lazy_module"]
+        if module is None:
+            before_import = self.__dict__["_lazy_before_import"]
+            if before_import is not None:
+                before_import()
+            module = importlib.import_module(self.__name__)
+            self.__dict__["_lazy_module"] = module
+        return module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__["_lazy_module"] is not None else "not loaded"
+        return "<lazy module '{}' ({})>".format(self.__name__, state)
+
+
+def lazy_import(name, before_import=None):
+    """
+    Returns a LazyModule for name
+    """
+    return LazyModule(name, before_import)
+
+
+def use_headless_matplotlib():
+    """
+    Selects the Agg backend (no GUI) before pyplot is imported, unless a backend was set with MPLBACKEND
+    """
+    if not os.environ.get("MPLBACKEND"):
+        import matplotlib
+        matplotlib.use("Agg")
+
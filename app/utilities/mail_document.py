@@ -0,0 +1,146 @@
+"""
+A mail prepared once for all the rule sets. The label and client rules get the same mail; the lower case and
+accent folded text, the tokens and the character n-grams of every field are computed on first use and kept, so
+they are computed once per mail, not once per rule set.
+
+MailDocument is a mutable mapping of the raw fields with copy(), like the email_items dict it replaces, so the rules
+objects keep working (get_labels_dict(email_details=document)). Changing a field drops its cached forms.
+
+The rules objects (LabelRules, app.configFiles.rules) still read the raw fields: they don't call folded, tokens or
+contains yet, so the preprocessing is shared only by the code that uses these methods (e.g. the rule profiler
+corpora). Moving LabelRules to contains / has_token is what removes its per rule lower() and normalization.
+
+Example:
+    document = MailDocument(subject="Fatura nº 123", body="...", sender="a@b.pt", receiver="c@d.pt")
+    document["subject"]                      # "Fatura nº 123"
+    document.folded("subject")               # "fatura no 123"
+    document.contains("subject", "FATURA")   # True
+    document.contains_any(["body", "subject"], ["invoice", "fatura"])
+"""
+import re
+import unicodedata
+from collections.abc import MutableMapping
+
+# Fields of the mails read by WebInterations.open_body
+MAIL_FIELDS = ("subject", "body", "sender", "receiver")
+
+_TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def fold_text(text):
+    """Lower case text without accents (e.g. "Fatura Nº" -> "fatura no")"""
+    if text is None:
+        return ""
+    decomposed = unicodedata.normalize("NFKD", str(text))
+    return "".join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+
+
+class MailDocument(MutableMapping):
+    """
+    Fields of a mail with their preprocessed forms cached
+
+    Parameters
+    ----------
+    fields : dict
+        {field name: raw text}, e.g. subject, body, sender, receiver
+    ngram_size : int
+        Length of the character n-grams used by might_contain
+    """
+
+    def __init__(self, fields=None, ngram_size=3, **kwargs):
+        self._fields = dict(fields or {}, **kwargs)
+        self.ngram_size = ngram_size
+        self._lower = {}
+        self._folded = {}
+        self._tokens = {}
+        self._ngrams = {}
+
+    def __getitem__(self, field):
+        return self._fields[field]
+
+    def __setitem__(self, field, value):
+        self._fields[field] = value
+        self._forget(field)
+
+    def __delitem__(self, field):
+        del self._fields[field]
+        self._forget(field)
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __repr__(self):
+        return "MailDocument({!r})".format(self._fields)
+
+    def _forget(self, field):
+        """Drops the cached forms of a field"""
+        for cache in (self._lower, self._folded, self._tokens, self._ngrams):
+            cache.pop(field, None)
+
+    def copy(self):
+        """A new document with the same fields (the cached forms are computed again on use)"""
+        return MailDocument(self._fields, ngram_size=self.ngram_size)
+
+    def text(self, field):
+        """The raw text of a field ("" for missing or None)"""
+        value = self._fields.get(field)
+        return "" if value is None else str(value)
+
+    def lower(self, field):
+        """Lower case text of a field"""
+        if field not in self._lower:
+            self._lower[field] = self.text(field).casefold()
+        return self._lower[field]
+
+    def folded(self, field):
+        """Lower case text of a field without accents"""
+        if field not in self._folded:
+            self._folded[field] = fold_text(self.text(field))
+        return self._folded[field]
+
+    def tokens(self, field):
+        """Words of the folded text of a field, in order"""
+        if field not in self._tokens:
+            self._tokens[field] = tuple(_TOKEN_PATTERN.findall(self.folded(field)))
+        return self._tokens[field]
+
+    def token_set(self, field):
+        return frozenset(self.tokens(field))
+
+    def ngrams(self, field):
+        """Set of the character n-grams of the folded text of a field"""
+        if field not in self._ngrams:
+            text, size = self.folded(field), self.ngram_size
+            self._ngrams[field] = frozenset(text[i:i + size] for i in range(len(text) - size + 1))
+        return self._ngrams[field]
+
+    def might_contain(self, field, text):
+        """
+        False if the folded field surely doesn't contain text (one of the n-grams of text is missing). A quick
+        check before scanning long bodies
+        """
+        text = fold_text(text)
+        size = self.ngram_size
+        if len(text) < size:
+            return True
+        ngrams = self.ngrams(field)
+        return all(text[i:i + size] in ngrams for i in range(len(text) - size + 1))
+
+    def contains(self, field, text):
+        """True if the folded field contains the folded text"""
+        return self.might_contain(field, text) and fold_text(text) in self.folded(field)
+
+    def contains_any(self, fields, texts):
+        """Returns the first of texts contained in one of fields or None"""
+        for text in texts:
+            for field in fields:
+                if self.contains(field, text):
+                    return text
+        return None
+
+    def has_token(self, field, token):
+        """True if the field has the word (folded)"""
+        return fold_text(token) in self.token_set(field)
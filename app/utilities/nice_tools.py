@@ -6,8 +6,12 @@
 import sys
 import traceback
 
-import win32com.client as win32
 import os
+from app.utilities.lazy_import import lazy_import
+from app.utilities.notifications import get_notifier
+
+# Outlook (win32com) is imported only when a mail is sent
+win32 = lazy_import("win32com.client")
 
 class MailUtils:
     """Class for reading, writing emails"""
@@ -130,16 +134,7 @@ class GetPaths:
         -------
             The last file that has been created/modified in the input folder
         """
-        files = os.listdir(folder_path)
-        files_cleaned = list(filter(
-            lambda file: "backup" not in file and os.path.isfile(os.path.join(folder_path, file)), files)
-        )
-        paths = [os.path.join(folder_path, basename) for basename in files_cleaned]
-        if len(paths) > 0:
-            newest_file_path = max(paths, key=os.path.getctime)
-        else:
-            newest_file_path = None
-        return newest_file_path
+        return newest_file(folder_path)
 
 
 def newest_file(folder_path):
@@ -155,27 +150,27 @@ def newest_file(folder_path):
     -------
         The last file that has been created/modified in the input folder
     """
-    files = os.listdir(folder_path)
-    files_cleaned = list(filter(
-        lambda file: "backup" not in file and os.path.isfile(os.path.join(folder_path, file)), files)
-    )
-    paths = [os.path.join(folder_path, basename) for basename in files_cleaned]
-    if len(paths) > 0:
-        newest_file_path = max(paths, key=os.path.getctime)
-    else:
-        newest_file_path = None
+    # os.scandir returns the file type (and on Windows the times) with the listing, no stat call per file
+    newest_file_path, newest_ctime = None, None
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if "backup" in entry.name or not entry.is_file():
+                continue
+            ctime = entry.stat().st_ctime
+            if newest_ctime is None or ctime > newest_ctime:
+                newest_file_path, newest_ctime = entry.path, ctime
     return newest_file_path
 
 def send_error_email(error_receiver_address, excepttion_message=''):
+    """
+    Sends the current exception by mail. The mail is queued and sent in the background (see notifications.py), so
+    the automation is not blocked. The errors from a short interval are sent together in one digest mail
+    """
     error_msg = 'This is the exception:\n {} \n\n Exception message: \n{}'.format(traceback.format_exc(),
                                                                                   excepttion_message)
     print(traceback.format_exc())
 
-    mail_util = MailUtils()
-    mail = mail_util.create_mail(to=error_receiver_address,
-                                 subject="[iController PT] Couldn't run app",
-                                 body=error_msg)
-    mail_util.send_mail(mail)
+    get_notifier().notify_error(error_receiver_address, error_msg)
 
 if __name__ == "__main__":
     mail_util = MailUtils()
@@ -0,0 +1,222 @@
+"""
+Non-blocking error notifications. Errors are put in a queue and sent by a background thread. The errors received
+in digest_interval seconds are sent to each receiver as one digest mail.
+
+The backend is Outlook (MailUtils) on Windows and SMTP everywhere else. The SMTP server is configured with the
+ICONTROLLER_SMTP_HOST, ICONTROLLER_SMTP_PORT, ICONTROLLER_SMTP_SENDER, ICONTROLLER_SMTP_USER and
+ICONTROLLER_SMTP_PASSWORD environment variables. For local testing an aiosmtpd server can be used:
+
+    python -m aiosmtpd -n -l localhost:8025
+    configure_notifier(SmtpBackend("localhost", 8025), digest_interval=5)
+"""
+import atexit
+import logging
+import os
+import queue
+import smtplib
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from email.message import EmailMessage
+
+from app.utilities import custom_logger as cl
+
+
+class OutlookBackend(object):
+    """Sends the mails with the Outlook application (Windows only)"""
+
+    def send(self, to, subject, body):
+        from app.utilities.nice_tools import MailUtils
+        try:
+            # COM has to be initialised in every thread that uses it
+            import pythoncom
+            pythoncom.CoInitialize()
+        except ImportError:
+            pass
+        mail_util = MailUtils()
+        mail_util.send_mail(mail_util.create_mail(to=to, subject=subject, body=body))
+
+
+class SmtpBackend(object):
+    """
+    Sends the mails with a SMTP server
+
+    Parameters
+    ----------
+    host : str
+        SMTP server
+    port : int
+        SMTP port
+    sender : str
+        From address
+    username, password : str
+        Credentials, if the server requires a login
+    use_tls : bool
+        Use STARTTLS
+    timeout : float
+        Connection timeout in seconds
+    """
+
+    def __init__(self, host="localhost", port=25, sender="icontroller-robot@localhost", username=None,
+                 password=None, use_tls=False, timeout=10):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.timeout = timeout
+
+    @classmethod
+    def from_environment(cls):
+        return cls(host=os.environ.get("ICONTROLLER_SMTP_HOST", "localhost"),
+                   port=int(os.environ.get("ICONTROLLER_SMTP_PORT", 25)),
+                   sender=os.environ.get("ICONTROLLER_SMTP_SENDER", "icontroller-robot@localhost"),
+                   username=os.environ.get("ICONTROLLER_SMTP_USER"),
+                   password=os.environ.get("ICONTROLLER_SMTP_PASSWORD"),
+                   use_tls=os.environ.get("ICONTROLLER_SMTP_TLS", "").lower() in ("1", "true", "yes"))
+
+    def send(self, to, subject, body):
+        message = EmailMessage()
+        message["From"] = self.sender
+        message["To"] = to
+        message["Subject"] = subject
+        message.set_content(body)
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            if self.use_tls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+            smtp.send_message(message)
+
+
+class ErrorNotifier(object):
+    """
+    Queues the errors and sends them from a background thread, aggregated in digests
+
+    Parameters
+    ----------
+    backend : object
+        Has a send(to, subject, body) method (OutlookBackend, SmtpBackend)
+    subject : str
+        Subject prefix of the mails
+    digest_interval : float
+        Seconds the errors are collected after the first one, before the digest is sent
+    max_errors_per_digest : int
+        Errors over this number are only counted, not included in the digest
+    """
+
+    log = cl.customLogger(logging.DEBUG)
+
+    def __init__(self, backend, subject="[iController PT] Couldn't run app", digest_interval=60,
+                 max_errors_per_digest=50):
+        self.backend = backend
+        self.subject = subject
+        self.digest_interval = digest_interval
+        self.max_errors_per_digest = max_errors_per_digest
+        self.sent_digests = 0
+        self.failed_digests = 0
+        self._queue = queue.Queue()
+        self._flush_requested = threading.Event()
+        self._thread = threading.Thread(target=self._worker, name="ErrorNotifier", daemon=True)
+        self._thread.start()
+
+    def notify_error(self, receiver, message):
+        """
+        Queues an error. Returns immediately
+        """
+        self._queue.put((receiver, datetime.now(), message))
+
+    def flush(self):
+        """
+        Sends the queued errors now and waits until they are sent
+        """
+        self._flush_requested.set()
+        self._queue.put(None)
+        self._queue.join()
+
+    def close(self):
+        self.flush()
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            pending = OrderedDict()
+            items = 1
+            if item is not None:
+                pending.setdefault(item[0], []).append(item[1:])
+                deadline = time.monotonic() + self.digest_interval
+                while not self._flush_requested.is_set():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    items += 1
+                    if item is None:
+                        break
+                    pending.setdefault(item[0], []).append(item[1:])
+            self._flush_requested.clear()
+            for receiver, errors in pending.items():
+                self._send_digest(receiver, errors)
+            for _ in range(items):
+                self._queue.task_done()
+
+    def _send_digest(self, receiver, errors):
+        if len(errors) == 1:
+            subject = self.subject
+            body = errors[0][1]
+        else:
+            subject = "{} ({} errors)".format(self.subject, len(errors))
+            parts = []
+            for number, (error_time, message) in enumerate(errors[:self.max_errors_per_digest], 1):
+                parts.append("Error {} at {:%Y-%m-%d %H:%M:%S}\n{}".format(number, error_time, message))
+            if len(errors) > self.max_errors_per_digest:
+                parts.append("... and {} more errors".format(len(errors) - self.max_errors_per_digest))
+            body = ("\n\n" + "-" * 70 + "\n\n").join(parts)
+        try:
+            self.backend.send(receiver, subject, body)
+            self.sent_digests += 1
+        except Exception as e:
+            self.failed_digests += 1
+            self.log.error("Couldn't send the error mail to " + receiver + ": " + repr(e))
+            print("Couldn't send the error mail to " + receiver + ": " + repr(e))
+
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+
+def configure_notifier(backend, **kwargs):
+    """
+    Replaces the notifier used by nice_tools.send_error_email. The queued errors of the previous one are sent first
+    """
+    global _notifier
+    with _notifier_lock:
+        if _notifier is not None:
+            _notifier.flush()
+        _notifier = ErrorNotifier(backend, **kwargs)
+    return _notifier
+
+
+def get_notifier():
+    """
+    Returns the notifier used by nice_tools.send_error_email. It is created on first use with the Outlook backend
+    on Windows and the SMTP backend elsewhere
+    """
+    global _notifier
+    with _notifier_lock:
+        if _notifier is None:
+            backend = OutlookBackend() if sys.platform == "win32" else SmtpBackend.from_environment()
+            _notifier = ErrorNotifier(backend)
+    return _notifier
+
+
+@atexit.register
+def _flush_at_exit():
+    if _notifier is not None:
+        _notifier.flush()
@@ -0,0 +1,291 @@
+"""
+Keyed diff between a report and new data. Replaces pd.concat + drop_duplicates over all the columns (including the
+long email_body), which hashes every body on every write.
+
+Every row has a key: the iController message id taken from the url ("msg:155171") or, for the mails without url
+(labels set before), a hash of sender, date and subject. The keys of a report and their row positions are saved
+next to it in "<report>.keys", so they are not recomputed on every run. An append hashes only the incoming rows and
+finds the existing ones by key; the existing rows are not loaded into pandas, concatenated or deduplicated.
+
+The workbook itself is still parsed and saved by openpyxl on every append (update_workbook), because an xlsx sheet
+can't be changed without rewriting it. That part costs the size of the whole report, not of the new rows.
+"""
+import hashlib
+import os
+import re
+
+from app.utilities.lazy_import import lazy_import
+
+pd = lazy_import("pandas")
+
+_MESSAGE_ID = re.compile(r"(?:[?&]msg=|#mail=|/messageId/)(\d+)")
+
+# Fields that can change for a mail between two runs. They are updated in the report (upsert)
+STATUS_FIELDS = ["label", "status", "check", "client", "clients_check_text", "forward", "email_closed"]
+
+
+def _normalize(text):
+    if text is None or text != text:  # None or NaN
+        return ""
+    return " ".join(str(text).split()).lower()
+
+
+def row_key(subject, sender, date, url=None):
+    """
+    Returns the key of a report row
+
+    Parameters
+    ----------
+    subject, sender, date : str
+        Mail details
+    url : str
+        Mail url. If it contains a message id, the id is the key
+    """
+    match = _MESSAGE_ID.search(url) if isinstance(url, str) else None
+    if match:
+        return "msg:" + match.group(1)
+    text = "\x1f".join((_normalize(sender), _normalize(date), _normalize(subject)))
+    return "sha1:" + hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _present(values):
+    """Boolean mask of the non empty values of a series"""
+    return values.notna() & (values.astype(str).str.strip() != "")
+
+
+def _cell(value):
+    """A dataframe value as an openpyxl cell value"""
+    if value is None or value != value:  # None or NaN
+        return None
+    return value.item() if hasattr(value, "item") else value
+
+
+def frame_keys(df):
+    """Returns the keys of the rows of a dataframe, in order"""
+    if df is None or df.empty:
+        return []
+
+    def column(name):
+        return df[name].tolist() if name in df.columns else [None] * len(df)
+
+    return [row_key(subject, sender, date, url)
+            for subject, sender, date, url in zip(column("subject"), column("sender"), column("date"),
+                                                  column("url"))]
+
+
+class ReportIndex(object):
+    """
+    Row keys of a report and their positions in the report file, saved in a sidecar file. The sidecar stores the
+    modification time and size of the report it was written for; if the report was changed by someone else, the
+    keys are rebuilt from it
+
+    Parameters
+    ----------
+    report_path : str
+        The report the keys belong to. None keeps the index only in memory
+
+    Attributes
+    ----------
+    keys : dict
+        {key: position of the row in the report file (0 is the first row after the header)}. A key found in several
+        rows points to the first one
+    rows : int
+        Number of rows of the report
+    """
+
+    def __init__(self, report_path=None):
+        self.report_path = report_path
+        self.index_path = report_path + ".keys" if report_path else None
+        self.keys = {}
+        self.rows = 0
+
+    @classmethod
+    def from_frame(cls, df, report_path=None):
+        """The index of a dataframe in its row order"""
+        index = cls(report_path)
+        index.add(frame_keys(df))
+        return index
+
+    @classmethod
+    def load(cls, report_path, df=None):
+        """
+        Loads the keys of a report from its sidecar. If the sidecar is missing or outdated, the keys are computed
+        from df (the report in file order) or, if df is None, from the key columns read from the report file, and
+        saved
+        """
+        index = cls(report_path)
+        if index._read():
+            return index
+        if df is None and os.path.exists(report_path):
+            df = read_key_columns(report_path)
+        index.add(frame_keys(df))
+        if os.path.exists(report_path):
+            index.save()
+        return index
+
+    def _report_stamp(self):
+        stat = os.stat(self.report_path)
+        return "{} {}".format(stat.st_mtime_ns, stat.st_size)
+
+    def _read(self):
+        if not self.index_path or not os.path.exists(self.index_path) or not os.path.exists(self.report_path):
+            return False
+        with open(self.index_path, encoding="utf-8") as index_file:
+            # "<report mtime> <report size> <rows>". Sidecars without rows have no positions and are rebuilt
+            header = index_file.readline().split()
+            if len(header) != 3 or " ".join(header[:2]) != self._report_stamp():
+                return False
+            keys = {}
+            for line in index_file:
+                key, _, position = line.rstrip("\n").rpartition("\t")
+                if not key:
+                    return False
+                keys[key] = int(position)
+        self.keys, self.rows = keys, int(header[2])
+        return True
+
+    def save(self):
+        """Saves the keys. Must be called after the report file was written"""
+        if not self.index_path:
+            return
+        temporary_path = self.index_path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as index_file:
+            index_file.write("{} {}\n".format(self._report_stamp(), self.rows))
+            index_file.writelines("{}\t{}\n".format(key, position) for key, position in self.keys.items())
+        os.replace(temporary_path, self.index_path)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def split(self, data):
+        """
+        Splits data in the rows that are not in the index and the rows that are
+
+        Returns
+        -------
+            (new rows, existing rows, keys of the new rows). Duplicated keys inside data keep the first row
+        """
+        if data is None or data.empty:
+            return data, data, []
+        keys = frame_keys(data)
+        new_positions, existing_positions, new_keys = [], [], []
+        seen = set()
+        for position, key in enumerate(keys):
+            if key in self.keys:
+                existing_positions.append(position)
+            elif key not in seen:
+                seen.add(key)
+                new_positions.append(position)
+                new_keys.append(key)
+        return data.iloc[new_positions], data.iloc[existing_positions], new_keys
+
+    def new_rows(self, data):
+        """Returns the rows of data that are not in the index"""
+        return self.split(data)[0]
+
+    def add(self, keys):
+        """Adds the keys of rows appended to the report, in order"""
+        for key in keys:
+            self.keys.setdefault(key, self.rows)
+            self.rows += 1
+
+    def positions(self, keys):
+        """Returns the report positions of keys (None for the keys not in the report)"""
+        return [self.keys.get(key) for key in keys]
+
+
+def read_key_columns(report_path, sheet_name=0):
+    """Reads the columns used by the row keys of a report, in file order"""
+    key_columns = ("subject", "sender", "date", "url")
+    return pd.read_excel(report_path, sheet_name=sheet_name, usecols=lambda column: column in key_columns)
+
+
+def status_updates(updates, positions, status_fields=STATUS_FIELDS):
+    """
+    Returns the non empty status fields of updates by report position
+
+    Parameters
+    ----------
+    updates : pandas dataframe
+        Rows of mails already in the report
+    positions : list
+        Report position of every row of updates (ReportIndex.positions), None if the mail is not in the report
+
+    Returns
+    -------
+        {position: {field: value}}
+    """
+    changes = {}
+    if updates is None or updates.empty:
+        return changes
+    positions = pd.Series(positions, index=updates.index, dtype="float64")
+    found = positions.notna()
+    for field in status_fields:
+        if field not in updates.columns:
+            continue
+        valid = found & _present(updates[field])
+        for position, value in zip(positions[valid].astype(int), updates.loc[valid, field]):
+            changes.setdefault(int(position), {})[field] = value
+    return changes
+
+
+def update_workbook(report_path, new_rows, changes, sheet_name=None, first_position=None):
+    """
+    Writes the status changes of existing rows in place and appends the new rows to a report workbook. The columns
+    of new_rows missing from the report are added after the last column. The whole workbook is loaded and saved
+    with openpyxl, so the time grows with the report size
+
+    Parameters
+    ----------
+    report_path : str
+        The report
+    new_rows : pandas dataframe
+        Rows appended after the last row
+    changes : dict
+        {position: {field: value}} (see status_updates)
+    sheet_name : str
+        The first sheet if None or if the workbook has no such sheet
+    first_position : int
+        Position of the first new row (ReportIndex.rows). By default after the last row of the sheet
+
+    Returns
+    -------
+        The number of existing rows that were changed
+    """
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(report_path)
+    try:
+        sheet = workbook[sheet_name] if sheet_name in workbook.sheetnames else workbook.worksheets[0]
+        header = [cell.value for cell in sheet[1]]
+        columns = list(new_rows.columns) if new_rows is not None else []
+        columns += [field for fields in changes.values() for field in fields]
+        for column in columns:
+            if column not in header:
+                header.append(column)
+                sheet.cell(row=1, column=len(header), value=column)
+        positions = {column: header.index(column) + 1 for column in header}
+
+        updated = 0
+        for position, fields in changes.items():
+            changed = False
+            for field, value in fields.items():
+                cell = sheet.cell(row=position + 2, column=positions[field])
+                value = _cell(value)
+                if cell.value != value:
+                    cell.value = value
+                    changed = True
+            updated += changed
+
+        if new_rows is not None and not new_rows.empty:
+            first_row = sheet.max_row + 1 if first_position is None else first_position + 2
+            for offset, row in enumerate(new_rows.itertuples(index=False, name=None)):
+                for column, value in zip(new_rows.columns, row):
+                    sheet.cell(row=first_row + offset, column=positions[column], value=_cell(value))
+        workbook.save(report_path)
+    finally:
+        workbook.close()
+    return updated
@@ -0,0 +1,196 @@
+"""
+Compiled report filters. Replaces the eval of "self.df_today.loc[self.df_today" + condition + "]" from
+CreateReport.filter_report.
+
+A condition can be written in DataFrame.query syntax:
+    status == "Couldn't set the label" and label != ""
+or in the old filter_report syntax (https://pbpython.com/excel-filter-edit.html):
+    ["status"] == "Couldn't set the label"
+    ["status"].isin(["Label was added", "Labels were set before"])
+
+Conditions are compiled once (lru cache). The masks are cached per report. Equality conditions on the same column
+are evaluated together with one groupby over the column.
+
+The gain is in filter_many and in repeated filters (cached masks): a single uncached filter costs about as much as
+the old eval (slightly more on large reports, DataFrame.eval parses the expression). The point of a single filter
+is that no arbitrary code is evaluated.
+"""
+import ast
+import re
+from functools import lru_cache
+
+from app.utilities.lazy_import import lazy_import
+
+pd = lazy_import("pandas")
+
+_COLUMN_REFERENCE = re.compile(r"""(?:self\.df_today|df)?\[\s*(["'])(.+?)\1\s*\]""")
+_EQUALITY = re.compile(r"""^\s*`([^`]+)`\s*==\s*("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|-?\d+(?:\.\d+)?)\s*$""")
+_FORBIDDEN = ("__", "@", "lambda", "import")
+
+
+def _skip_string(text, position):
+    """Returns the position after the string literal that starts at position"""
+    quote = text[position]
+    position += 1
+    while position < len(text):
+        if text[position] == "\\":
+            position += 2
+            continue
+        if text[position] == quote:
+            return position + 1
+        position += 1
+    raise ValueError("Unterminated string in filter condition: " + text)
+
+
+def to_query(condition):
+    """
+    Converts a condition in the old filter_report syntax to DataFrame.query syntax. Conditions already in query
+    syntax are returned unchanged
+
+    Raises
+    ------
+    ValueError
+        If the condition uses something that is not allowed in a filter (dunder attributes, @variables, lambda)
+    """
+    query = []
+    position = 0
+    while position < len(condition):
+        character = condition[position]
+        if character in "\"'":
+            end = _skip_string(condition, position)
+            query.append(condition[position:end])
+            position = end
+            continue
+        match = _COLUMN_REFERENCE.match(condition, position)
+        if match and (match.group(0)[0] != "[" or _is_column_position(condition, position)):
+            query.append("`{}`".format(match.group(2)))
+            position = match.end()
+            continue
+        query.append(character)
+        position += 1
+    query = "".join(query).strip()
+
+    # Strings and `quoted column names` can contain any text (e.g. a column "important")
+    code = re.sub(r"""("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|`[^`]*`)""", "", query)
+    for forbidden in _FORBIDDEN:
+        if forbidden in code:
+            raise ValueError("Not allowed in a filter condition: " + forbidden)
+    return query
+
+
+def _is_column_position(text, position):
+    """
+    A [..] is a column reference if it starts the condition or follows an operator. After a name or a call
+    parenthesis (e.g. isin([...])) it is a list
+    """
+    before = text[:position].rstrip()
+    if not before:
+        return True
+    if before[-1] == "(":
+        before = before[:-1].rstrip()
+        return not before or not (before[-1].isalnum() or before[-1] in "_.")
+    return before[-1] in "&|~=<>!"
+
+
+class CompiledFilter(object):
+    """
+    A filter condition compiled to a DataFrame.eval expression
+
+    Attributes
+    ----------
+    condition : str
+        The original condition
+    query : str
+        The condition in DataFrame.query syntax
+    equality : tuple
+        (column, value) if the condition is a single equality, otherwise None. These filters can be evaluated
+        together (see ReportFilter.filter_many)
+    """
+
+    def __init__(self, condition):
+        self.condition = condition
+        self.query = to_query(condition)
+        self.equality = None
+        match = _EQUALITY.match(self.query)
+        if match:
+            self.equality = (match.group(1), ast.literal_eval(match.group(2)))
+        # numexpr can't evaluate method calls like .str.contains or .isin
+        code = re.sub(r"""("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|`[^`]*`)""", "", self.query)
+        self.engine = "python" if re.search(r"\.\s*[A-Za-z_]", code) else None
+
+    def mask(self, df):
+        """Returns the boolean mask of the rows that match the condition"""
+        mask = df.eval(self.query, engine=self.engine)
+        if not isinstance(mask, pd.Series) or mask.dtype != bool:
+            mask = pd.Series(mask, index=df.index).fillna(False).astype(bool)
+        return mask
+
+
+@lru_cache(maxsize=256)
+def compile_filter(condition):
+    """Returns the CompiledFilter of a condition. The result is cached"""
+    return CompiledFilter(condition)
+
+
+class ReportFilter(object):
+    """
+    Filters a report with compiled conditions. The masks are cached, so the report must not be changed after the
+    ReportFilter was created (create a new one instead)
+
+    Parameters
+    ----------
+    df : pandas dataframe
+        The report
+    """
+
+    def __init__(self, df):
+        self.df = df
+        self._masks = {}
+        self._groups = {}
+
+    def _positions(self, column):
+        """Returns {value: row positions} for a column. Computed with one groupby and cached"""
+        if column not in self._groups:
+            self._groups[column] = self.df.groupby(column, sort=False, observed=True).indices
+        return self._groups[column]
+
+    def mask(self, condition):
+        compiled = compile_filter(condition)
+        if compiled.query not in self._masks:
+            if compiled.equality and compiled.equality[0] in self.df.columns:
+                column, value = compiled.equality
+                mask = pd.Series(False, index=self.df.index)
+                positions = self._positions(column).get(value)
+                if positions is not None:
+                    mask.iloc[positions] = True
+                self._masks[compiled.query] = mask
+            else:
+                self._masks[compiled.query] = compiled.mask(self.df)
+        return self._masks[compiled.query]
+
+    def filter(self, condition, add_to_index=None):
+        """
+        Returns the rows that match a condition
+
+        Parameters
+        ----------
+        condition : str
+            Filter condition (query syntax or the old filter_report syntax)
+        add_to_index : int
+            Added to the index of the result
+        """
+        filtered_df = self.df.loc[self.mask(condition)]
+        if add_to_index:
+            filtered_df.index = filtered_df.index + add_to_index
+        return filtered_df
+
+    def filter_many(self, conditions, add_to_index=None):
+        """
+        Returns the rows that match every condition, as a list in the order of the conditions. Equality conditions
+        on the same column share one groupby pass
+        """
+        for condition in conditions:
+            compiled = compile_filter(condition)
+            if compiled.equality:
+                self._positions(compiled.equality[0])
+        return [self.filter(condition, add_to_index) for condition in conditions]
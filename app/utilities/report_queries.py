@@ -0,0 +1,223 @@
+"""
+Report queries on the database (the tables loaded by excel_to_db / backfill.py) instead of the Excel files. The
+counts are aggregated in SQL, so the daily summary (pies, html table, mail) doesn't load the reports.
+
+Example:
+    Database.initialise()
+    queries = ReportQueries("lpsc_pt_iController")
+    queries.ensure_indexes()
+    summary = ReportSummary(queries, pies_folder)
+    html = summary.html("2020-10-22", country="PT")
+    pies = summary.pies("2020-10-22", country="PT")
+
+CreateReport uses it for the daily pies and summary tables when it is created with db_table (the report must be
+exported with excel_to_db first):
+    report = CreateReport(report_path, db_table="lpsc_pt_iController")
+    report.excel_to_db("lpsc_pt_iController")
+    pies, html = report.create_pies(COUNT_COLUMNS), report.summary_html()
+
+excel_to_db and backfill.py write the same rows (with report_date and country). The rows inserted by excel_to_db
+before it used the backfill rows have no report_date and are not returned by the date queries.
+"""
+import html as html_escape
+from collections import OrderedDict
+
+from app.utilities.charts import ChartJob, ChartRenderer, chart_key
+from app.utilities.database import CursorFromConnectionFromPool
+from app.utilities.lazy_import import lazy_import
+
+pd = lazy_import("pandas")
+sql = lazy_import("psycopg2.sql")
+
+# Columns that can be counted (GROUP BY) and their titles
+COUNT_COLUMNS = OrderedDict([("status", "Labels status"), ("label", "Labels"), ("client", "Clients"),
+                             ("forward", "Forward"), ("email_closed", "Closed emails")])
+# Columns returned by ReportQueries.rows. email_body is left out, it is most of the table size
+ROW_COLUMNS = ["report_date", "country", "subject", "sender", "date", "label", "status", "label_check", "url",
+               "client", "client_check", "forward", "email_closed"]
+INDEXES = [("report_date",), ("country", "report_date"), ("report_date", "status"), ("report_date", "label")]
+
+
+class ReportQueries(object):
+    """
+    Queries on a report table. The database must be initialised (Database.initialise)
+
+    Parameters
+    ----------
+    table : str
+        Table name (e.g. lpsc_pt_iController)
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def ensure_indexes(self):
+        """Creates the indexes used by the date and count queries, if they don't exist"""
+        with CursorFromConnectionFromPool() as cursor:
+            for columns in INDEXES:
+                name = "{}_{}".format(self.table, "_".join(columns))
+                cursor.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} ({})").format(
+                    sql.Identifier(name), sql.Identifier(self.table),
+                    sql.SQL(", ").join(sql.Identifier(column) for column in columns)))
+
+    @staticmethod
+    def _where(report_date=None, since=None, until=None, country=None):
+        """Returns the WHERE clause and its parameters. The dates are YYYY-MM-DD"""
+        conditions, parameters = [], []
+        if report_date is not None:
+            conditions.append(sql.SQL("report_date = %s"))
+            parameters.append(report_date)
+        if since is not None:
+            conditions.append(sql.SQL("report_date >= %s"))
+            parameters.append(since)
+        if until is not None:
+            conditions.append(sql.SQL("report_date <= %s"))
+            parameters.append(until)
+        if country is not None:
+            conditions.append(sql.SQL("country = %s"))
+            parameters.append(country.upper())
+        if not conditions:
+            return sql.SQL(""), parameters
+        return sql.SQL(" WHERE ") + sql.SQL(" AND ").join(conditions), parameters
+
+    def counts(self, column, report_date=None, since=None, until=None, country=None):
+        """
+        Returns the number of mails for every value of a column, like value_counts on the report
+
+        Parameters
+        ----------
+        column : str
+            One of COUNT_COLUMNS
+        report_date : str
+            Only this day (YYYY-MM-DD)
+        since, until : str
+            Only the days in this range (inclusive)
+        country : str
+            Only this country
+
+        Returns
+        -------
+            OrderedDict {value: count}, biggest count first
+        """
+        if column not in COUNT_COLUMNS:
+            raise ValueError("Can't count column: " + column)
+        where, parameters = self._where(report_date, since, until, country)
+        statement = sql.SQL("SELECT COALESCE({column}, ''), COUNT(*) FROM {table}{where} GROUP BY 1 "
+                            "ORDER BY 2 DESC, 1").format(column=sql.Identifier(column),
+                                                         table=sql.Identifier(self.table), where=where)
+        with CursorFromConnectionFromPool() as cursor:
+            cursor.execute(statement, parameters)
+            return OrderedDict(cursor.fetchall())
+
+    def status_counts(self, **filters):
+        return self.counts("status", **filters)
+
+    def label_counts(self, **filters):
+        return self.counts("label", **filters)
+
+    def date_range(self, country=None):
+        """Returns (first report date, last report date), (None, None) if there are no reports"""
+        where, parameters = self._where(country=country)
+        statement = sql.SQL("SELECT MIN(report_date), MAX(report_date) FROM {}{}").format(
+            sql.Identifier(self.table), where)
+        with CursorFromConnectionFromPool() as cursor:
+            cursor.execute(statement, parameters)
+            return tuple(cursor.fetchone())
+
+    def daily_totals(self, since=None, until=None, country=None):
+        """Returns OrderedDict {report date: number of mails}, in date order"""
+        where, parameters = self._where(since=since, until=until, country=country)
+        statement = sql.SQL("SELECT report_date, COUNT(*) FROM {}{} GROUP BY 1 ORDER BY 1").format(
+            sql.Identifier(self.table), where)
+        with CursorFromConnectionFromPool() as cursor:
+            cursor.execute(statement, parameters)
+            return OrderedDict(cursor.fetchall())
+
+    def rows(self, report_date=None, since=None, until=None, country=None, status=None):
+        """
+        Returns the mails of a date range as a dataframe (without the mail bodies), newest report first
+
+        Parameters
+        ----------
+        status : str
+            Only the mails with this status
+        """
+        where, parameters = self._where(report_date, since, until, country)
+        if status is not None:
+            where = where + (sql.SQL(" AND ") if parameters else sql.SQL(" WHERE ")) + sql.SQL("status = %s")
+            parameters.append(status)
+        statement = sql.SQL("SELECT {} FROM {}{} ORDER BY report_date DESC, date DESC").format(
+            sql.SQL(", ").join(sql.Identifier(column) for column in ROW_COLUMNS), sql.Identifier(self.table), where)
+        with CursorFromConnectionFromPool() as cursor:
+            cursor.execute(statement, parameters)
+            return pd.DataFrame(cursor.fetchall(), columns=ROW_COLUMNS)
+
+
+def counts_to_html(counts_by_column):
+    """
+    Converts counts to html tables, one table per column
+
+    Parameters
+    ----------
+    counts_by_column : dict
+        {title: {value: count}}
+    """
+    tables = []
+    for title, counts in counts_by_column.items():
+        rows = "".join("<tr><td>{}</td><td>{}</td></tr>".format(html_escape.escape(str(value)), count)
+                       for value, count in counts.items())
+        tables.append('<table border="1" class="dataframe"><thead><tr><th>{}</th><th>count</th></tr></thead>'
+                      "<tbody>{}</tbody></table>".format(html_escape.escape(title), rows))
+    return "\n".join(tables)
+
+
+class ReportSummary(object):
+    """
+    Daily summary (pies and html tables) from the database. The pies are redrawn and the html rebuilt only when the
+    counts changed
+
+    Parameters
+    ----------
+    queries : ReportQueries
+        Queries of the report table
+    output_folder : str
+        Folder of the pies
+    columns : dict
+        {column: title} of the counts shown in the summary. Default COUNT_COLUMNS
+    """
+
+    def __init__(self, queries, output_folder, columns=None):
+        self.queries = queries
+        self.renderer = ChartRenderer(output_folder)
+        self.columns = columns or COUNT_COLUMNS
+        self._html_cache = {}
+
+    def counts(self, report_date=None, country=None):
+        """Returns {column: {value: count}} for the summary columns"""
+        return OrderedDict((column, self.queries.counts(column, report_date=report_date, country=country))
+                           for column in self.columns)
+
+    def html(self, report_date=None, country=None):
+        """Returns the html tables of the summary counts"""
+        counts = self.counts(report_date, country)
+        counts_by_title = OrderedDict((self.columns[column], column_counts)
+                                      for column, column_counts in counts.items())
+        key = chart_key([[title, list(column_counts.items())] for title, column_counts in counts_by_title.items()],
+                        "html")
+        if key not in self._html_cache:
+            self._html_cache[key] = counts_to_html(counts_by_title)
+        return self._html_cache[key]
+
+    def pies(self, report_date=None, country=None, processes=None):
+        """
+        Renders the pies of the summary columns
+
+        Returns
+        -------
+            {column: pie path}
+        """
+        counts = self.counts(report_date, country)
+        suffix = "_".join(part for part in (country, report_date) if part) or "all"
+        jobs = [ChartJob(column_counts, self.columns[column], "pie_{}_{}.png".format(suffix, column))
+                for column, column_counts in counts.items()]
+        return dict(zip(counts, self.renderer.render_many(jobs, processes)))
@@ -0,0 +1,144 @@
+"""
+Schema of the daily reports. The columns with few distinct values are loaded as categoricals and the mail bodies
+can be truncated or not loaded at all. The categoricals alone save little memory (the bodies are most of it), the
+truncated bodies (opt-in with CreateReport.today_body_max_chars) make a loaded report about three times smaller.
+
+The date column keeps the text shown by iController (it is compared with the dates from the messages page). The
+dates are parsed once, when the report is loaded, into the hidden column PARSED_DATE_COLUMN which is used for
+sorting. drop_hidden removes it before a report is shown or written.
+"""
+from datetime import datetime
+
+from app.utilities.lazy_import import lazy_import
+
+pd = lazy_import("pandas")
+
+REPORT_COLUMNS = ["subject", "sender", "date", "label", "status", "email_body", "check", "url", "client",
+                  "clients_check_text", "forward", "email_closed"]
+CATEGORICAL_COLUMNS = ["label", "status", "client", "forward", "email_closed", "country"]
+BODY_COLUMN = "email_body"
+DATE_COLUMN = "date"
+# Parsed dates added by apply_schema, not part of the report file
+PARSED_DATE_COLUMN = "_parsed_date"
+HIDDEN_COLUMNS = [PARSED_DATE_COLUMN]
+
+# Tried in order when parsing the dates
+DATE_FORMATS = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M", "%d-%m-%Y %H:%M",
+                "%d.%m.%Y %H:%M", "%Y-%m-%d", "%d/%m/%Y"]
+
+
+def parse_report_date(value):
+    """
+    Parses a report date. Returns a datetime or None if the value is not a known date format
+    """
+    if isinstance(value, datetime):
+        return value
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    return None
+
+
+def parse_report_dates(dates):
+    """
+    Vectorized parse_report_date. Returns a datetime64 series (NaT for unknown formats)
+    """
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return dates
+    texts = dates.astype("string").str.strip()
+    parsed = pd.to_datetime(texts, format=DATE_FORMATS[0], errors="coerce")
+    for date_format in DATE_FORMATS[1:]:
+        missing = parsed.isna() & texts.notna()
+        if not missing.any():
+            break
+        parsed[missing] = pd.to_datetime(texts[missing], format=date_format, errors="coerce")
+    return parsed
+
+
+def drop_hidden(df):
+    """Returns the report without the hidden columns (e.g. before to_html or to_excel)"""
+    hidden = [column for column in HIDDEN_COLUMNS if column in df.columns]
+    return df.drop(columns=hidden) if hidden else df
+
+
+def sort_report(df):
+    """
+    Sorts a report by date, newest first, and resets the index. Dates that can't be parsed are put last. If no
+    date can be parsed, the report is sorted by the date text (like before). The dates are parsed only if the
+    report has no PARSED_DATE_COLUMN (see apply_schema)
+    """
+    if df.empty or DATE_COLUMN not in df.columns:
+        return df.reset_index(drop=True)
+    if PARSED_DATE_COLUMN in df.columns:
+        parsed = df[PARSED_DATE_COLUMN]
+    else:
+        parsed = parse_report_dates(df[DATE_COLUMN])
+    if parsed.isna().all():
+        return df.sort_values(DATE_COLUMN, ascending=False).reset_index(drop=True)
+    order = parsed.sort_values(ascending=False, na_position="last", kind="stable").index
+    return df.loc[order].reset_index(drop=True)
+
+
+def apply_schema(df, body_max_chars=None, drop_body=False):
+    """
+    Converts a report to the compact representation
+
+    Parameters
+    ----------
+    df : pandas dataframe
+        The report as read by pd.read_excel
+    body_max_chars : int
+        Truncate the mail bodies to this length. None keeps the full bodies
+    drop_body : bool
+        Remove the email_body column. Use it only for reports that are not written back (e.g. previous report)
+
+    Returns
+    -------
+        The converted report with the hidden PARSED_DATE_COLUMN (the input is not changed)
+    """
+    df = df.copy()
+    for column in CATEGORICAL_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype("category")
+    if DATE_COLUMN in df.columns:
+        df[PARSED_DATE_COLUMN] = parse_report_dates(df[DATE_COLUMN])
+    if BODY_COLUMN in df.columns:
+        if drop_body:
+            df = df.drop(columns=[BODY_COLUMN])
+        elif body_max_chars is not None:
+            # The column is float (all NaN) when no mail has a body, e.g. a report of "Labels were set before" rows.
+            # Empty bodies are written as "" by get_emails_details
+            df[BODY_COLUMN] = df[BODY_COLUMN].fillna("").astype(str).str.slice(0, body_max_chars)
+    return df
+
+
+def load_report(path, sheet_name=0, body_max_chars=None, drop_body=False):
+    """
+    Reads a report with the compact representation and sorts it by date (newest first)
+
+    Parameters
+    ----------
+    path : str
+        Report path
+    sheet_name : str, int
+        Report sheet
+    body_max_chars : int
+        See apply_schema
+    drop_body : bool
+        Don't load the email_body column. See apply_schema
+    """
+    usecols = None
+    if drop_body:
+        usecols = lambda column: column != BODY_COLUMN
+    df = pd.read_excel(path, sheet_name=sheet_name, usecols=usecols)
+    return sort_report(apply_schema(df, body_max_chars=body_max_chars, drop_body=drop_body))
+
+
+def memory_mb(df):
+    """Returns the memory used by a dataframe in MB, including the python strings"""
+    return df.memory_usage(deep=True).sum() / 1024 ** 2
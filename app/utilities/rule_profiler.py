@@ -0,0 +1,363 @@
+"""
+Cost and hit rate of the label and client rules. The rules objects are wrapped so every get_labels_dict call is
+timed and the rule that matched (its check text) is counted, during a run or offline over a corpus of mails from
+the reports or the logs.
+
+The rules are evaluated in workbook order and the first match wins, so a mail costs roughly the number of rules
+evaluated before its match. When the rule order is known, the time of one rule evaluation is estimated from the
+call times and the first-match positions and the report lists:
+    - reorder: often matched rules late in the workbook. Moving them up saves the evaluations before them
+    - merge: rules with different check texts and the same labels, forward and close
+    - remove: rules that never matched over the corpus
+Mails without a match evaluate every rule, their share of the time is reported too.
+
+Example:
+    profiler = RuleProfiler()
+    interactions = WebInterations(driver, profiler.wrap("labels", label_rules_obj),
+                                  profiler.wrap("clients", clients_rules_obj))
+    ...
+    print(profiler.report())
+
+    python -m app.utilities.rule_profiler --rules Clientes.xlsx --order-column check_text \
+        --reports Reports/report_2020-10-*.xlsx --logs iController_Logs/automation_2020-10-*.log
+"""
+import argparse
+import glob
+import logging
+import re
+import threading
+import time
+
+import app.utilities.custom_logger as cl
+from app.utilities.mail_document import MailDocument
+
+# Results of get_labels_dict without a match
+_NO_MATCH_VALUES = ("", "nan", "none")
+
+
+def rule_key(result):
+    """Returns the check text of the rule that matched or None if no rule matched"""
+    if not result:
+        return None
+    labels, check_text = result.get("labels"), result.get("check_text")
+    if labels is None or str(labels).strip().lower() in _NO_MATCH_VALUES:
+        return None
+    if check_text is None or str(check_text).strip().lower() in _NO_MATCH_VALUES:
+        return None
+    return str(check_text)
+
+
+class RuleStats(object):
+    """Matches and call times of one rule"""
+
+    def __init__(self, key, outcome):
+        self.key = key
+        self.outcome = outcome
+        self.matches = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    @property
+    def mean_seconds(self):
+        return self.seconds / self.matches if self.matches else 0.0
+
+
+class RuleSetProfile(object):
+    """
+    Profile of one rule set
+
+    Parameters
+    ----------
+    name : str
+        Rule set name (e.g. "labels", "clients")
+    order : list
+        Check texts of the rules in evaluation order. None if unknown
+    """
+
+    def __init__(self, name, order=None):
+        self.name = name
+        self.rules = {}
+        self.calls = 0
+        self.seconds = 0.0
+        self.no_match_calls = 0
+        self.no_match_seconds = 0.0
+        self.order = None
+        self.positions = {}
+        self._xy = 0.0
+        self._xx = 0.0
+        self.set_order(order)
+
+    def set_order(self, order):
+        """Sets the evaluation order of the rules (their check texts)"""
+        if order is None:
+            return
+        self.order = [str(check_text) for check_text in order]
+        self.positions = {}
+        for position, check_text in enumerate(self.order):
+            self.positions.setdefault(check_text, position)
+
+    def evaluated_rules(self, key):
+        """Number of rules evaluated for a mail matched by key (all of them without a match). None if unknown"""
+        if self.order is None:
+            return None
+        if key is None:
+            return len(self.order)
+        position = self.positions.get(key)
+        return None if position is None else position + 1
+
+    def record(self, key, result, seconds):
+        self.calls += 1
+        self.seconds += seconds
+        if key is None:
+            self.no_match_calls += 1
+            self.no_match_seconds += seconds
+        else:
+            stats = self.rules.get(key)
+            if stats is None:
+                outcome = tuple(str(result.get(field)) for field in ("labels", "forward", "close"))
+                stats = self.rules[key] = RuleStats(key, outcome)
+            stats.matches += 1
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+        evaluated = self.evaluated_rules(key)
+        if evaluated:
+            # Least squares of seconds = cost * evaluated rules
+            self._xy += evaluated * seconds
+            self._xx += evaluated * evaluated
+
+    @property
+    def seconds_per_rule(self):
+        """Estimated time of one rule evaluation or None if the rule order is unknown"""
+        return self._xy / self._xx if self._xx else None
+
+    def reorder(self, top=20):
+        """
+        Returns [(saved seconds, check text, position, new position, matches)] of the rules worth moving up: the
+        rules sorted by matches (most matched first) and the time saved over the profiled mails
+        """
+        cost = self.seconds_per_rule
+        if cost is None:
+            return []
+        matched = [key for key in self.order if key in self.rules]
+        matched.sort(key=lambda key: -self.rules[key].matches)
+        moves = []
+        for new_position, key in enumerate(matched):
+            position = self.positions[key]
+            if position > new_position:
+                stats = self.rules[key]
+                moves.append((stats.matches * (position - new_position) * cost, key, position, new_position,
+                              stats.matches))
+        moves.sort(reverse=True)
+        return moves[:top]
+
+    def merge(self):
+        """Returns [(outcome, [check texts])] of the matched rules with the same labels, forward and close"""
+        outcomes = {}
+        for stats in self.rules.values():
+            outcomes.setdefault(stats.outcome, []).append(stats.key)
+        return sorted(((outcome, sorted(keys)) for outcome, keys in outcomes.items() if len(keys) > 1),
+                      key=lambda item: -len(item[1]))
+
+    def unmatched(self):
+        """Returns the check texts of the rules that never matched (empty if the rule order is unknown)"""
+        if self.order is None:
+            return []
+        return [key for key in self.order if key not in self.rules]
+
+
+class RuleProfiler(object):
+    """
+    Collects the profiles of the rule sets
+
+    Parameters
+    ----------
+    rule_orders : dict
+        {rule set name: check texts in evaluation order}. See read_rule_order
+    """
+
+    log = cl.customLogger(logging.INFO)
+
+    def __init__(self, rule_orders=None):
+        self.profiles = {}
+        self._lock = threading.Lock()
+        for name, order in (rule_orders or {}).items():
+            self.profiles[name] = RuleSetProfile(name, order)
+
+    def profile(self, rule_set):
+        if rule_set not in self.profiles:
+            self.profiles[rule_set] = RuleSetProfile(rule_set)
+        return self.profiles[rule_set]
+
+    def wrap(self, rule_set, rules_obj):
+        """Returns rules_obj with its get_labels_dict calls profiled"""
+        return ProfiledRules(self, rule_set, rules_obj)
+
+    def record(self, rule_set, result, seconds):
+        with self._lock:
+            self.profile(rule_set).record(rule_key(result), result, seconds)
+
+    def profile_corpus(self, rule_set, rules_obj, mails):
+        """
+        Classifies a corpus of mails offline
+
+        Parameters
+        ----------
+        rule_set : str
+            Rule set name
+        rules_obj
+            The rules object
+        mails : iterable
+            email_items dicts or MailDocuments (see report_mails and log_mails)
+
+        Returns
+        -------
+            The number of mails classified
+        """
+        profiled = self.wrap(rule_set, rules_obj)
+        count = 0
+        for email_items in mails:
+            profiled.get_labels_dict(email_details=email_items)
+            count += 1
+        self.log.info("Profiled {} mails with the {} rules".format(count, rule_set))
+        return count
+
+    def report(self, top=20):
+        """Returns the profile of every rule set as text"""
+        lines = []
+        for profile in self.profiles.values():
+            if not profile.calls:
+                continue
+            lines.append("=== {} rules: {} calls, {:.3f} s, {:.2f} ms per mail ===".format(
+                profile.name, profile.calls, profile.seconds, 1000 * profile.seconds / profile.calls))
+            lines.append("No match: {} mails ({:.0%}), {:.3f} s ({:.0%} of the time)".format(
+                profile.no_match_calls, profile.no_match_calls / profile.calls, profile.no_match_seconds,
+                profile.no_match_seconds / profile.seconds if profile.seconds else 0.0))
+            cost = profile.seconds_per_rule
+            if cost is not None:
+                lines.append("Rules: {}, estimated {:.3f} ms per rule evaluation".format(len(profile.order),
+                                                                                       1000 * cost))
+
+            lines.append("Most matched rules (matches, mean ms, max ms, position, check text):")
+            ranked = sorted(profile.rules.values(), key=lambda stats: -stats.matches)
+            for stats in ranked[:top]:
+                position = profile.positions.get(stats.key, "-")
+                lines.append("  {:>6} {:>8.2f} {:>8.2f} {:>6} {}".format(
+                    stats.matches, 1000 * stats.mean_seconds, 1000 * stats.max_seconds, position, stats.key))
+
+            moves = profile.reorder(top)
+            if moves:
+                lines.append("Reorder (saves {:.3f} s over these mails if the rules don't overlap):".format(
+                    sum(move[0] for move in moves)))
+                for saved, key, position, new_position, matches in moves:
+                    lines.append("  {} -> {} ({} matches, saves {:.3f} s): {}".format(position, new_position,
+                                                                                    matches, saved, key))
+            merges = profile.merge()
+            if merges:
+                lines.append("Merge (same labels, forward and close):")
+                for outcome, keys in merges[:top]:
+                    lines.append("  {} <- {} rules: {}".format(outcome[0], len(keys), " | ".join(keys[:10])))
+            unmatched = profile.unmatched()
+            if unmatched:
+                lines.append("Remove: {} rules never matched, e.g. {}".format(len(unmatched),
+                                                                             " | ".join(unmatched[:top])))
+        return "\n".join(lines)
+
+
+class ProfiledRules(object):
+    """A rules object whose get_labels_dict calls are recorded by a RuleProfiler. Other attributes are forwarded"""
+
+    def __init__(self, profiler, rule_set, rules_obj):
+        self.profiler = profiler
+        self.rule_set = rule_set
+        self.rules_obj = rules_obj
+
+    def get_labels_dict(self, email_details):
+        start = time.perf_counter()
+        result = self.rules_obj.get_labels_dict(email_details=email_details)
+        self.profiler.record(self.rule_set, result, time.perf_counter() - start)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.rules_obj, name)
+
+
+def read_rule_order(rules_file, column, sheet_name=None):
+    """
+    Returns the values of a column of a rules workbook (the check texts in evaluation order)
+
+    Parameters
+    ----------
+    rules_file : str
+        Rules workbook
+    column : str
+        Header of the check text column
+    sheet_name : str
+        The first sheet if None
+    """
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(rules_file, read_only=True, data_only=True)
+    try:
+        sheet = workbook[sheet_name] if sheet_name else workbook.worksheets[0]
+        rows = sheet.iter_rows(values_only=True)
+        header = [str(value).strip() for value in next(rows)]
+        index = header.index(column)
+        return [str(row[index]) for row in rows if row[index] is not None]
+    finally:
+        workbook.close()
+
+
+def report_mails(path):
+    """Yields the mails (MailDocument) of a report. The reports have no receiver"""
+    from app.utilities.report_schema import load_report
+
+    df = load_report(path)
+    columns = [column for column in ("subject", "sender", "email_body") if column in df.columns]
+    for row in df[columns].itertuples(index=False):
+        values = dict(zip(columns, row))
+        yield MailDocument(subject=_text(values.get("subject")), body=_text(values.get("email_body")),
+                           sender=_text(values.get("sender")), receiver="")
+
+
+def log_mails(path, separator="-@"):
+    """
+    Yields the mails (MailDocument) logged by get_all_emails_from_page (see RecoverReport). The logs have the
+    subject and the sender only
+    """
+    with open(path, encoding="utf-8", errors="replace") as rf:
+        for line in rf:
+            fields = re.split(separator, line)[1:-1]
+            if len(fields) >= 2:
+                yield MailDocument(subject=fields[0], body="", sender=fields[1], receiver="")
+
+
+def _text(value):
+    return "" if value is None or value != value else str(value)
+
+
+def main():
+    from app.main_app.multi_tenant import load_rules
+
+    parser = argparse.ArgumentParser(description="Profiles a rules workbook over the mails of reports and logs")
+    parser.add_argument("--rules", required=True, help="rules workbook")
+    parser.add_argument("--order-column", help="header of the check text column, gives the rule order")
+    parser.add_argument("--reports", nargs="*", default=[], help="report files (glob patterns)")
+    parser.add_argument("--logs", nargs="*", default=[], help="log files (glob patterns)")
+    parser.add_argument("--separator", default="-@")
+    parser.add_argument("--top", type=int, default=20)
+    arguments = parser.parse_args()
+
+    order = read_rule_order(arguments.rules, arguments.order_column) if arguments.order_column else None
+    profiler = RuleProfiler({"rules": order})
+    rules_obj = load_rules(arguments.rules)
+    for pattern in arguments.reports:
+        for path in sorted(glob.glob(pattern)):
+            profiler.profile_corpus("rules", rules_obj, report_mails(path))
+    for pattern in arguments.logs:
+        for path in sorted(glob.glob(pattern)):
+            profiler.profile_corpus("rules", rules_obj, log_mails(path, arguments.separator))
+    print(profiler.report(arguments.top))
+
+
+if __name__ == "__main__":
+    main()